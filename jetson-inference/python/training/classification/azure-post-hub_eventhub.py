@@ -5,28 +5,123 @@ import jetson.utils
 
 import argparse
 import sys
+import time
 
 import os
 import asyncio
 from azure.iot.device.aio import IoTHubDeviceClient
 from azure.eventhub.aio import EventHubConsumerClient
 from azure.eventhub.extensions.checkpointstoreblobaio import BlobCheckpointStore
+from concurrent.futures import ThreadPoolExecutor
+from event_dispatcher import EventDispatcher
 
-async def on_event(partition_context, event):
-	# Print the event data.
-	print("Received the event:\"{}\" from the partition with ID: \"{}\"".format(event.body_as_str(encoding='UTF-8'), partition_context.partition_id))
-
-	messageBody = event.body_as_str(encoding='UTF-8')
-	print("message body="+ messageBody)
+# Requests are <id>|<class name>|<threshold in percent>|<key>. Returns the
+# class name and the threshold, None for a malformed request.
+def parse_request(messageBody):
 	messageArray = messageBody.split("|")
-	
-	for messageContent in messageArray:
-		print(messageContent)
-	classForObjectDetection = messageArray[1]
-	thresholdForObjectDetection=messageArray[2]
-	print("Class and threshhold" + classForObjectDetection + thresholdForObjectDetection)
-
-	# Code for object detection
+	if len(messageArray) != 4 or not messageArray[1] or not messageArray[2].isdigit():
+		return None
+	return messageArray[1], int(messageArray[2])
+
+
+# Looks for the objects requested through the Event Hub.
+# The network, video source and device client are loaded once when the
+# worker opens. The event dispatcher hands every event to handle(), several
+# requests can be looked for at once and take turns on the one inference
+# thread. A request whose object is not found within --requestTimeout seconds
+# is answered with a timeout, so it gives its worker back.
+class DetectionWorker:
+	def __init__(self, opt):
+		self.opt = opt
+		# all CUDA work runs on this one thread so the event loop keeps receiving
+		self.executor = ThreadPoolExecutor(max_workers=1)
+
+	async def open(self):
+		loop = asyncio.get_event_loop()
+		await loop.run_in_executor(self.executor, self._load)
+
+		# Fetch the connection string from an environment variable
+		conn_str = os.getenv("IOTHUB_DEVICE_CONNECTION_STRING")
+		self.device_client = IoTHubDeviceClient.create_from_connection_string(conn_str)
+		await self.device_client.connect()
+
+	def _load(self):
+		# load the recognition network
+		self.net = jetson.inference.imageNet(self.opt.network, sys.argv)
+		print('Loaded network')
+		# create the video source and, unless running headless, the display
+		self.font = jetson.utils.cudaFont()
+		self.display = None if self.opt.headless else jetson.utils.glDisplay()
+		self.input = jetson.utils.videoSource(self.opt.input_URI, argv=sys.argv)
+		print('Loaded display')
+
+	async def close(self):
+		await self.device_client.disconnect()
+		self.executor.shutdown()
+
+	async def handle(self, event):
+		messageBody = event.body_as_str(encoding='UTF-8')
+		print("Received the event:\"{}\"".format(messageBody))
+		request = parse_request(messageBody)
+		if request is None:
+			# retrying cannot fix it, the event is finished and checkpointed
+			print("Malformed request, skipping it")
+			return
+		classForObjectDetection, thresholdForObjectDetection = request
+		print("Class and threshhold " + classForObjectDetection + " " + str(thresholdForObjectDetection))
+
+		loop = asyncio.get_event_loop()
+		deadline = time.monotonic() + self.opt.requestTimeout
+		# process frames until the object is found or the request times out
+		while time.monotonic() < deadline:
+			message = await loop.run_in_executor(self.executor, self._process_frame, classForObjectDetection, thresholdForObjectDetection)
+			if message is not None:
+				await self.device_client.send_message(message)
+				print("Message sent for found object")
+				return
+		await self.device_client.send_message("Timed out looking for " + classForObjectDetection)
+		print("Request for " + classForObjectDetection + " timed out")
+
+	# Classifies one frame, returns the message to send once the object is found.
+	def _process_frame(self, classForObjectDetection, thresholdForObjectDetection):
+		net, font, display = self.net, self.font, self.display
+
+		# capture the image
+		img = self.input.Capture()
+
+		# classify the image
+		class_idx, confidence = net.Classify(img)
+
+		# find the object description
+		class_desc = net.GetClassDesc(class_idx)
+
+		# nothing is drawn for frames that are not shown when running headless
+		if display is not None:
+			# overlay the result on the image	
+			font.OverlayText(img, img.width, img.height, "{:05.2f}% {:s}".format(confidence * 100, class_desc), 15, 50, font.Green, font.Gray40)
+
+			# render the image
+			display.RenderOnce(img, img.width, img.height)
+
+			# update the title bar
+			display.SetTitle("{:s} | Network {:.0f} FPS | Looking for {:s}".format(net.GetNetworkName(), net.GetNetworkFPS(), classForObjectDetection))
+
+		# print out performance info
+		net.PrintProfilerTimes()
+		if class_desc != classForObjectDetection or (confidence*100) < thresholdForObjectDetection:
+			return None
+
+		if display is None:
+			font.OverlayText(img, img.width, img.height, "{:05.2f}% {:s}".format(confidence * 100, class_desc), 15, 50, font.Green, font.Gray40)
+		font.OverlayText(img, img.width, img.height, "Found {:s} at {:05.2f}% confidence".format(class_desc, confidence * 100), 775, 50, font.Blue, font.Gray40)
+		if display is not None:
+			display.RenderOnce(img, img.width, img.height)
+		jetson.utils.saveImageRGBA('test.jpg',img, img.width,img.height)
+		print("Saved image")
+		return "Found " + class_desc + " with confidence : " + str(confidence*100)
+
+
+async def main():
 	# parse the command line
 	parser = argparse.ArgumentParser(description="Classifying an object from a live camera feed and once successfully classified a message is sent to Azure IoT Hub", 
 						   formatter_class=argparse.RawTextHelpFormatter, epilog=jetson.inference.imageNet.Usage())
@@ -38,6 +133,14 @@ async def on_event(partition_context, event):
 	parser.add_argument("--height", type=int, default=720, help="desired height of camera stream (default is 720 pixels)")
 	parser.add_argument("--classNameForTargetObject", type=str, default="", help="class name of the object that is required to be detected. Once object is detected and threshhold limit has crossed, the message would be sent to Azure IoT Hub")
 	parser.add_argument("--detectionThreshold", type=int, default=90, help="The threshold value 'in percentage' for object detection")
+	parser.add_argument("--headless", action="store_true", help="run without a display window, skipping overlays and rendering that are not needed for a detection image")
+	parser.add_argument("--checkpointEvery", type=int, default=100, help="number of handled events of a partition after which a checkpoint is written")
+	parser.add_argument("--checkpointInterval", type=float, default=10.0, help="seconds after which handled events of a partition are checkpointed even if fewer than --checkpointEvery")
+	parser.add_argument("--maxInFlight", type=int, default=4, help="number of events of one partition that are received but not yet handled before receiving from it pauses")
+	parser.add_argument("--concurrentRequests", type=int, default=2, help="number of requests looked for at the same time, taking turns on the camera frames")
+	parser.add_argument("--retryDelay", type=float, default=5.0, help="seconds after which an event that could not be handled, e.g. because IoT Hub was unreachable, is handled again.\nThe checkpoint only moves past an event that was not handled once it is given up after --maxRetries")
+	parser.add_argument("--maxRetries", type=int, default=3, help="number of times an event that could not be handled is handled again before it is given up and checkpointed")
+	parser.add_argument("--requestTimeout", type=int, default=30, help="seconds a request is looked for before it is answered with a timeout")
 
 	try:
 		opt = parser.parse_known_args()[0]
@@ -46,89 +149,24 @@ async def on_event(partition_context, event):
 		parser.print_help()
 		sys.exit(0)
 
-	# load the recognition network
-	net = jetson.inference.imageNet(opt.network, sys.argv)
-	print('Loaded network')
-	# create the camera and display
-	font = jetson.utils.cudaFont()
-	camera = jetson.utils.gstCamera(opt.width, opt.height, opt.camera)
-	display = jetson.utils.glDisplay()
-	input = jetson.utils.videoSource(opt.input_URI, argv=sys.argv)
-	print('Loaded display')
-	print(display)
-	print(camera)
-	# Fetch the connection string from an environment variable
-	conn_str = os.getenv("IOTHUB_DEVICE_CONNECTION_STRING")
-	print("Connection string as: ")
-	print(conn_str)
-
-	device_client = IoTHubDeviceClient.create_from_connection_string(conn_str)
-	await device_client.connect()
-
-	counter = 1
-	stillLooking = True
-
-	# process frames until user exits
-	while False:
-		print('About to capture image')
-		# capture the image
-		# img, width, height = camera.CaptureRGBA()
-		img = input.Capture()
-
-		# classify the image
-		class_idx, confidence = net.Classify(img)
-		print('Classified image')
-
-		# find the object description
-		class_desc = net.GetClassDesc(class_idx)
-		print('Got class description')
-
-		# overlay the result on the image	
-		font.OverlayText(img, img.width, img.height, "{:05.2f}% {:s}".format(confidence * 100, class_desc), 15, 50, font.Green, font.Gray40)
-		print('Set font overlay')
-
-		# render the image
-		display.RenderOnce(img, img.width, img.height)
-		print('Rendered once')
+	worker = DetectionWorker(opt)
+	await worker.open()
+	dispatcher = EventDispatcher(worker.handle, opt.concurrentRequests, opt.maxInFlight, opt.checkpointEvery, opt.checkpointInterval, retry_delay=opt.retryDelay, max_retries=opt.maxRetries)
+	dispatcher.start()
 
-		# update the title bar
-		display.SetTitle("{:s} | Network {:.0f} FPS | Looking for {:s}".format(net.GetNetworkName(), net.GetNetworkFPS(), opt.classNameForTargetObject))
-		print('Display is set')
-
-		# print out performance info
-		net.PrintProfilerTimes()
-		if class_desc == classForObjectDetection and (confidence*100) >= int(thresholdForObjectDetection):
-			message = "Found " + class_desc + " with confidence : " + str(confidence*100)
-			font.OverlayText(img, img.width, img.height, "Found {:s} at {:05.2f}% confidence".format(class_desc, confidence * 100), 775, 50, font.Blue, font.Gray40)
-			display.RenderOnce(img, img.width, img.height)
-			jetson.utils.saveImageRGBA('test.jpg',img, img.width,img.height)
-			print("Saved image")
-			await device_client.send_message(message)
-			print("Message sent for found object")
-			print(conn_str)
-			stillLooking = False
-			#del input
-			#del display
-			#del camera
-			
-	await device_client.disconnect()
-
-
-	# Update the checkpoint so that the program does not read the events that it has already read
-	await partition_context.update_checkpoint(event)
-	
-
-async def main():
 	# Code for listening to EventHub
 	checkpoint_store = BlobCheckpointStore.from_connection_string("", "jetson-nano-object-classification-events-container")
 
 	client=EventHubConsumerClient.from_connection_string("", consumer_group="$Default",eventhub_name="jetson-nano-object-classification", checkpoint_store=checkpoint_store)
 	print('Waiting for request events')
-	async with client:
-		# Call the receive method
-		await client.receive(on_event=on_event, starting_position="-1")
-
-
+	try:
+		async with client:
+			# Call the receive method
+			# max_wait_time lets idle partitions write checkpoints that are due by time
+			await client.receive(on_event=dispatcher.on_event, on_partition_close=dispatcher.on_partition_close, starting_position="-1", max_wait_time=opt.checkpointInterval)
+	finally:
+		await dispatcher.close()
+		await worker.close()
 
 
 if __name__ == "__main__":
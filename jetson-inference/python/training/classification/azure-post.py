@@ -9,6 +9,7 @@ import sys
 import os
 import asyncio
 from azure.iot.device.aio import IoTHubDeviceClient
+from motion_gate import MotionGate
 
 async def main():
 
@@ -23,6 +24,10 @@ async def main():
 	parser.add_argument("--height", type=int, default=720, help="desired height of camera stream (default is 720 pixels)")
 	parser.add_argument("--classNameForTargetObject", type=str, default="", help="class name of the object that is required to be detected. Once object is detected and threshhold limit has crossed, the message would be sent to Azure IoT Hub")
 	parser.add_argument("--detectionThreshold", type=int, default=90, help="The threshold value 'in percentage' for object detection")
+	parser.add_argument("--headless", action="store_true", help="run without a display window, skipping overlays and rendering that are not needed for a detection image")
+	parser.add_argument("--motionThreshold", type=float, default=1.0, help="percentage of a shrunk frame that has to change for the scene to count as moving, 0 classifies every frame")
+	parser.add_argument("--minSampleRate", type=float, default=1.0, help="frames per second classified while the scene is still")
+	parser.add_argument("--motionHold", type=float, default=2.0, help="seconds frames are classified at full rate after the last motion")
 
 	try:
 		opt = parser.parse_known_args()[0]
@@ -36,18 +41,19 @@ async def main():
 	print('Loaded network')
 	# create the camera and display
 	font = jetson.utils.cudaFont()
-	camera = jetson.utils.gstCamera(opt.width, opt.height, opt.camera)
-	display = jetson.utils.glDisplay()
+	display = None if opt.headless else jetson.utils.glDisplay()
 	input = jetson.utils.videoSource(opt.input_URI, argv=sys.argv)
 	print('Loaded display')
 	print(display)
-	print(camera)
 	# Fetch the connection string from an environment variable
 	# conn_str = os.getenv("IOTHUB_DEVICE_CONNECTION_STRING")
 
 	# device_client = IoTHubDeviceClient.create_from_connection_string(conn_str)
 	# await device_client.connect()
 
+	# frames of a still scene are not classified
+	gate = MotionGate(opt.motionThreshold / 100, 1 / opt.minSampleRate if opt.minSampleRate > 0 else None, opt.motionHold)
+
 	counter = 1
 	# process frames until user exits
 	while True:
@@ -56,27 +62,36 @@ async def main():
 		# img, width, height = camera.CaptureRGBA()
 		img = input.Capture()
 
+		if not gate.admit(img):
+			# keep the view live without classifying
+			if display is not None:
+				display.RenderOnce(img, img.width, img.height)
+			continue
+
 		# classify the image
 		class_idx, confidence = net.Classify(img)
 
 		# find the object description
 		class_desc = net.GetClassDesc(class_idx)
 
-		# overlay the result on the image	
-		font.OverlayText(img, img.width, img.height, "{:05.2f}% {:s}".format(confidence * 100, class_desc), 15, 50, font.Green, font.Gray40)
+		# nothing is drawn for frames that are not shown when running headless
+		if display is not None:
+			# overlay the result on the image	
+			font.OverlayText(img, img.width, img.height, "{:05.2f}% {:s}".format(confidence * 100, class_desc), 15, 50, font.Green, font.Gray40)
 
-		# render the image
-		display.RenderOnce(img, img.width, img.height)
+			# render the image
+			display.RenderOnce(img, img.width, img.height)
 
-		# update the title bar
-		display.SetTitle("{:s} | Network {:.0f} FPS | Looking for {:s}".format(net.GetNetworkName(), net.GetNetworkFPS(), opt.classNameForTargetObject))
+			# update the title bar
+			display.SetTitle("{:s} | Network {:.0f} FPS | Looking for {:s}".format(net.GetNetworkName(), net.GetNetworkFPS(), opt.classNameForTargetObject))
 
 		# print out performance info
 		net.PrintProfilerTimes()
 		if class_desc == opt.classNameForTargetObject and (confidence*100) >= opt.detectionThreshold:
 			message = "Found " + class_desc + " with confidence : " + str(confidence*100)
-			font.OverlayText(img, img.width, img.height, "Found {:s} at {:05.2f}% confidence".format(class_desc, confidence * 100), 775, 50, font.Blue, font.Gray40)
-			display.RenderOnce(img, img.width, img.height)
+			if display is not None:
+				font.OverlayText(img, img.width, img.height, "Found {:s} at {:05.2f}% confidence".format(class_desc, confidence * 100), 775, 50, font.Blue, font.Gray40)
+				display.RenderOnce(img, img.width, img.height)
 			# await device_client.send_message(message)
 			print("Message sent for found object")
 	# await device_client.disconnect()
@@ -0,0 +1,108 @@
+import collections
+import time
+
+# An event worth telling the hub about.
+#   kind        "entered" when the class came into view, "present" for a
+#               keep-alive while it stays in view, "left" once it is gone
+#   confidence  the last confidence in percent above the leave threshold
+DetectionEvent = collections.namedtuple("DetectionEvent", "kind class_desc confidence")
+
+
+def event_message(event):
+	if event.kind == "entered":
+		return "Found " + event.class_desc + " with confidence : " + str(event.confidence)
+	if event.kind == "present":
+		return "Still found " + event.class_desc + " with confidence : " + str(event.confidence)
+	return "Lost " + event.class_desc
+
+
+# Allows rate events per second on average with bursts of up to capacity.
+class TokenBucket:
+	def __init__(self, rate, capacity, clock=time.monotonic):
+		self.rate = rate
+		self.capacity = capacity
+		self.clock = clock
+		self.tokens = capacity
+		self.updated = clock()
+
+	def try_take(self):
+		now = self.clock()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		if self.tokens < 1:
+			return False
+		self.tokens -= 1
+		return True
+
+
+class ClassState:
+	def __init__(self):
+		self.present = False
+		self.hits = 0
+		self.misses = 0
+		self.confidence = 0.0
+		self.last_sent = None
+
+
+# Turns the per-frame classification of the watched classes into a few events.
+# A class enters after enter_frames consecutive frames at or above
+# enter_threshold and only leaves after leave_frames consecutive frames below
+# leave_threshold, so a confidence flickering around the threshold does not
+# produce a stream of events. While a class stays in view a keep-alive is sent
+# every keep_alive_interval seconds.
+# Two events of one class are at least min_interval seconds apart and all
+# events share the token bucket. An event that is not allowed yet is not lost,
+# the state change waits for the next frame that may send it.
+class DetectionDebouncer:
+	def __init__(self, classes, enter_threshold, leave_threshold, enter_frames=2, leave_frames=15, keep_alive_interval=30.0, min_interval=1.0, bucket=None, clock=time.monotonic):
+		self.enter_threshold = enter_threshold
+		self.leave_threshold = leave_threshold
+		self.enter_frames = enter_frames
+		self.leave_frames = leave_frames
+		self.keep_alive_interval = keep_alive_interval
+		self.min_interval = min_interval
+		self.bucket = bucket
+		self.clock = clock
+		self.states = {class_desc: ClassState() for class_desc in classes}
+		self.deferred = 0
+
+	# Takes the top class of a frame and its confidence in percent, returns
+	# the events to send for the frame.
+	def update(self, class_desc, confidence):
+		now = self.clock()
+		events = []
+		for watched, state in self.states.items():
+			frame_confidence = confidence if class_desc == watched else 0.0
+			if not state.present:
+				state.hits = state.hits + 1 if frame_confidence >= self.enter_threshold else 0
+				if state.hits >= self.enter_frames and self._allow(state, now):
+					state.present = True
+					state.misses = 0
+					state.confidence = frame_confidence
+					events.append(DetectionEvent("entered", watched, frame_confidence))
+				continue
+
+			if frame_confidence >= self.leave_threshold:
+				state.misses = 0
+				state.confidence = frame_confidence
+			else:
+				state.misses += 1
+
+			if state.misses >= self.leave_frames:
+				if self._allow(state, now):
+					state.present = False
+					state.hits = 0
+					events.append(DetectionEvent("left", watched, state.confidence))
+			elif now - state.last_sent >= self.keep_alive_interval and self._allow(state, now):
+				events.append(DetectionEvent("present", watched, state.confidence))
+		return events
+
+	def _allow(self, state, now):
+		if state.last_sent is not None and now - state.last_sent < self.min_interval:
+			self.deferred += 1
+			return False
+		if self.bucket is not None and not self.bucket.try_take():
+			self.deferred += 1
+			return False
+		state.last_sent = now
+		return True
@@ -0,0 +1,193 @@
+import asyncio
+import collections
+import time
+
+
+# Tracks the events of one partition from the moment they are received until
+# they have been handled, and writes checkpoints for them in batches.
+# Events may finish out of order when several are handled at once, so the
+# checkpoint only ever moves up to the last event before which every event
+# has finished. A checkpoint is written once checkpoint_every events have
+# finished since the last one, or once checkpoint_interval seconds have
+# passed with finished events not yet checkpointed.
+class PartitionTracker:
+	def __init__(self, partition_context, max_in_flight=4, checkpoint_every=100, checkpoint_interval=10.0, clock=time.monotonic):
+		self.partition_context = partition_context
+		self.checkpoint_every = checkpoint_every
+		self.checkpoint_interval = checkpoint_interval
+		self.clock = clock
+		# received events in order, each entry is [event, finished, attempts]
+		self.in_flight = collections.deque()
+		# admitted events waiting for a worker
+		self.pending = collections.deque()
+		self.slots = asyncio.Semaphore(max_in_flight)
+		self.finished_event = None
+		self.uncheckpointed = 0
+		self.last_checkpoint = clock()
+		self.handled = 0
+		self.retries = 0
+		self.failed = 0
+		self.checkpoints = 0
+		self.closed = False
+
+	# Waits until the partition has a free in-flight slot.
+	async def admit(self, event):
+		await self.slots.acquire()
+		entry = [event, False, 0]
+		self.in_flight.append(entry)
+		self.pending.append(entry)
+		return entry
+
+	async def complete(self, entry):
+		entry[1] = True
+		self.handled += 1
+		self.slots.release()
+		while self.in_flight and self.in_flight[0][1]:
+			self.finished_event = self.in_flight.popleft()[0]
+			self.uncheckpointed += 1
+		await self.checkpoint_if_due()
+
+	async def checkpoint_if_due(self):
+		if not self.uncheckpointed:
+			return
+		if self.uncheckpointed >= self.checkpoint_every or self.clock() - self.last_checkpoint >= self.checkpoint_interval:
+			await self.checkpoint()
+
+	async def checkpoint(self):
+		if self.closed or not self.uncheckpointed:
+			return
+		await self.partition_context.update_checkpoint(self.finished_event)
+		self.uncheckpointed = 0
+		self.last_checkpoint = self.clock()
+		self.checkpoints += 1
+
+	def stats(self):
+		return {
+			"in_flight": len(self.in_flight),
+			"pending": len(self.pending),
+			"handled": self.handled,
+			"retries": self.retries,
+			"failed": self.failed,
+			"uncheckpointed": self.uncheckpointed,
+			"checkpoints": self.checkpoints,
+		}
+
+
+# Feeds the events of all partitions to a fixed number of workers.
+# Every partition has at most max_in_flight events between receiving and
+# finishing, which pauses receiving on a busy partition, and workers take
+# the next event from the partitions in turn so a busy partition cannot
+# starve the others.
+#
+# Delivery is at least once. An event whose handle() raises is not finished:
+# it keeps its in-flight slot and is handled again after retry_delay seconds,
+# and the checkpoint does not move past it. After max_retries failed retries
+# the event is given up and finished, so one event that can never be handled
+# cannot stall its partition. An event still unfinished when its partition
+# closes or the process stops is handled again by the next owner, so a
+# request can be answered twice. handle() has to end on its own, e.g. with a
+# timeout response, or the partition stops receiving once max_in_flight
+# events are stuck.
+#
+# handle(event) is a coroutine. The dispatcher only uses partition_id and
+# update_checkpoint() of the partition contexts and never looks into the
+# events, so it runs against an in-memory checkpoint store and a consumer
+# that calls on_event() directly just as well as against the Event Hub.
+class EventDispatcher:
+	def __init__(self, handle, workers=1, max_in_flight=4, checkpoint_every=100, checkpoint_interval=10.0, clock=time.monotonic, retry_delay=5.0, max_retries=3):
+		self.handle = handle
+		self.workers = workers
+		self.max_in_flight = max_in_flight
+		self.checkpoint_every = checkpoint_every
+		self.checkpoint_interval = checkpoint_interval
+		self.clock = clock
+		self.retry_delay = retry_delay
+		self.max_retries = max_retries
+		self.partitions = collections.OrderedDict()
+		self.ready = asyncio.Condition()
+		self.tasks = []
+		self.retrying = set()
+
+	def start(self):
+		self.tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+	async def close(self):
+		tasks = self.tasks + list(self.retrying)
+		for task in tasks:
+			task.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+		for tracker in self.partitions.values():
+			await tracker.checkpoint()
+
+	# Event Hub callback. With max_wait_time set on receive() the event is
+	# None when nothing arrived in time, which still writes a checkpoint that
+	# is due by time.
+	async def on_event(self, partition_context, event):
+		tracker = self._tracker(partition_context)
+		if event is None:
+			await tracker.checkpoint_if_due()
+			return
+		await tracker.admit(event)
+		async with self.ready:
+			self.ready.notify()
+
+	# Events that were not started yet are left to the next owner of the
+	# partition, events still being handled finish without a checkpoint.
+	async def on_partition_close(self, partition_context, reason):
+		tracker = self.partitions.get(partition_context.partition_id)
+		if tracker is None or tracker.partition_context is not partition_context:
+			return
+		del self.partitions[partition_context.partition_id]
+		tracker.pending.clear()
+		await tracker.checkpoint()
+		tracker.closed = True
+
+	def stats(self):
+		return {partition_id: tracker.stats() for partition_id, tracker in self.partitions.items()}
+
+	def _tracker(self, partition_context):
+		tracker = self.partitions.get(partition_context.partition_id)
+		if tracker is None or tracker.partition_context is not partition_context:
+			tracker = PartitionTracker(partition_context, self.max_in_flight, self.checkpoint_every, self.checkpoint_interval, self.clock)
+			self.partitions[partition_context.partition_id] = tracker
+		return tracker
+
+	# Takes the next event round-robin over the partitions.
+	async def _next(self):
+		async with self.ready:
+			while True:
+				for partition_id, tracker in self.partitions.items():
+					if tracker.pending:
+						self.partitions.move_to_end(partition_id)
+						return tracker, tracker.pending.popleft()
+				await self.ready.wait()
+
+	async def _work(self):
+		while True:
+			tracker, entry = await self._next()
+			try:
+				await self.handle(entry[0])
+			except Exception as ex:
+				if entry[2] >= self.max_retries:
+					print("Unable to handle event, giving it up after %d retries: %s" % (entry[2], ex))
+					tracker.failed += 1
+					await tracker.complete(entry)
+					continue
+				print("Unable to handle event, retrying it in %s s: %s" % (self.retry_delay, ex))
+				entry[2] += 1
+				tracker.retries += 1
+				task = asyncio.ensure_future(self._retry(tracker, entry))
+				self.retrying.add(task)
+				task.add_done_callback(self.retrying.discard)
+				continue
+			await tracker.complete(entry)
+
+	# Queues a failed event again. Once its partition is closed the event is
+	# left to the next owner, which starts after the last checkpoint.
+	async def _retry(self, tracker, entry):
+		await asyncio.sleep(self.retry_delay)
+		if tracker.closed:
+			return
+		tracker.pending.append(entry)
+		async with self.ready:
+			self.ready.notify()
@@ -0,0 +1,131 @@
+import asyncio
+import collections
+import json
+import time
+
+
+# A single message goes out as it is, so consumers of the plain string
+# messages keep working. A batch of several goes out as one message holding a
+# JSON array of the messages, which consumers have to expect.
+def encode_batch(messages):
+	if len(messages) == 1:
+		return messages[0]
+	return json.dumps(messages)
+
+
+# Sends telemetry from a background task so the frame loop never waits for a
+# round-trip to the hub.
+# post() only queues the message. By default every message is sent on its own.
+# With a max_batch_size above 1 the sender gathers queued messages into a
+# batch until max_batch_size messages are waiting or the oldest one has waited
+# max_delay seconds, and sends the batch as one message. A failed send is
+# retried up to retries times with a doubling delay before the batch is
+# given up. When more than max_queue messages are waiting the oldest is
+# dropped.
+#
+# Only send_message() of the device client is used, so any object with that
+# coroutine can stand in for IoTHubDeviceClient.
+class TelemetryOutbox:
+	def __init__(self, device_client, max_batch_size=1, max_delay=1.0, max_queue=100, retries=3, retry_delay=1.0, encode=encode_batch):
+		self.device_client = device_client
+		self.max_batch_size = max_batch_size
+		self.max_delay = max_delay
+		self.max_queue = max_queue
+		self.retries = retries
+		self.retry_delay = retry_delay
+		self.encode = encode
+		# queued messages with the time they were posted
+		self.queue = collections.deque()
+		self.posted = asyncio.Event()
+		self.task = None
+		# the batch being sent, sent again by close() if the sender is stopped mid-send
+		self.sending = None
+
+		self.sent_messages = 0
+		self.sent_batches = 0
+		self.retried = 0
+		self.failed_messages = 0
+		self.dropped_messages = 0
+		self.total_send_latency = 0.0
+		self.max_send_latency = 0.0
+
+	def start(self):
+		self.task = asyncio.ensure_future(self._run())
+
+	# Never blocks, returns False when an older message had to be dropped.
+	def post(self, message):
+		dropped = len(self.queue) >= self.max_queue
+		if dropped:
+			self.queue.popleft()
+			self.dropped_messages += 1
+		self.queue.append((message, time.monotonic()))
+		self.posted.set()
+		return not dropped
+
+	# Sends what is still queued, then stops the sender.
+	async def close(self):
+		if self.task is not None:
+			self.task.cancel()
+			await asyncio.gather(self.task, return_exceptions=True)
+		if self.sending:
+			await self._send(self.sending)
+		while self.queue:
+			await self._send(self._take())
+
+	def stats(self):
+		average = self.total_send_latency / self.sent_batches if self.sent_batches else 0.0
+		return {
+			"depth": len(self.queue),
+			"sent_messages": self.sent_messages,
+			"sent_batches": self.sent_batches,
+			"retried": self.retried,
+			"failed_messages": self.failed_messages,
+			"dropped_messages": self.dropped_messages,
+			"avg_send_ms": round(average * 1000, 2),
+			"max_send_ms": round(self.max_send_latency * 1000, 2),
+		}
+
+	async def _run(self):
+		while True:
+			if not self.queue:
+				self.posted.clear()
+				await self.posted.wait()
+			# wait for a full batch or for the oldest message to be due
+			while len(self.queue) < self.max_batch_size:
+				remaining = self.queue[0][1] + self.max_delay - time.monotonic()
+				if remaining <= 0:
+					break
+				self.posted.clear()
+				try:
+					await asyncio.wait_for(self.posted.wait(), remaining)
+				except asyncio.TimeoutError:
+					break
+			self.sending = self._take()
+			await self._send(self.sending)
+			self.sending = None
+
+	def _take(self):
+		count = min(self.max_batch_size, len(self.queue))
+		return [self.queue.popleft()[0] for _ in range(count)]
+
+	async def _send(self, batch):
+		delay = self.retry_delay
+		for attempt in range(self.retries + 1):
+			started = time.monotonic()
+			try:
+				await self.device_client.send_message(self.encode(batch))
+			except Exception as ex:
+				if attempt == self.retries:
+					print("Unable to send %d telemetry messages: %s" % (len(batch), ex))
+					self.failed_messages += len(batch)
+					return
+				self.retried += 1
+				await asyncio.sleep(delay)
+				delay *= 2
+			else:
+				latency = time.monotonic() - started
+				self.sent_messages += len(batch)
+				self.sent_batches += 1
+				self.total_send_latency += latency
+				self.max_send_latency = max(self.max_send_latency, latency)
+				return
@@ -9,6 +9,9 @@ import sys
 import os
 import asyncio
 from azure.iot.device.aio import IoTHubDeviceClient
+from detection_debouncer import DetectionDebouncer, TokenBucket, event_message
+from motion_gate import MotionGate
+from telemetry_outbox import TelemetryOutbox
 
 async def main():
 
@@ -22,6 +25,18 @@ async def main():
 	parser.add_argument("--height", type=int, default=720, help="desired height of camera stream (default is 720 pixels)")
 	parser.add_argument("--classNameForTargetObject", type=str, default="", help="class name of the object that is required to be detected. Once object is detected and threshhold limit has crossed, the message would be sent to Azure IoT Hub")
 	parser.add_argument("--detectionThreshold", type=int, default=90, help="The threshold value 'in percentage' for object detection")
+	parser.add_argument("--headless", action="store_true", help="run without a display window, skipping overlays and rendering that are not needed for a detection image")
+	parser.add_argument("--enterFrames", type=int, default=2, help="consecutive frames at or above the detection threshold before the object counts as found")
+	parser.add_argument("--leaveFrames", type=int, default=15, help="consecutive frames below the leave threshold before a found object counts as lost")
+	parser.add_argument("--leaveMargin", type=int, default=10, help="percentage points below the detection threshold down to which a found object still counts as in view")
+	parser.add_argument("--keepAliveInterval", type=float, default=30.0, help="seconds between messages while the object stays in view")
+	parser.add_argument("--minMessageInterval", type=float, default=1.0, help="minimum seconds between two messages")
+	parser.add_argument("--maxMessagesPerMinute", type=float, default=12, help="average number of messages per minute, with bursts of up to 3 messages")
+	parser.add_argument("--telemetryBatchSize", type=int, default=1, help="maximum number of messages sent to Azure IoT Hub together as one JSON array, 1 sends every message on its own")
+	parser.add_argument("--telemetryMaxDelay", type=float, default=1.0, help="seconds a message may wait for others to be sent with it")
+	parser.add_argument("--motionThreshold", type=float, default=1.0, help="percentage of a shrunk frame that has to change for the scene to count as moving, 0 classifies every frame")
+	parser.add_argument("--minSampleRate", type=float, default=1.0, help="frames per second classified while the scene is still")
+	parser.add_argument("--motionHold", type=float, default=2.0, help="seconds frames are classified at full rate after the last motion")
 
 	try:
 		opt = parser.parse_known_args()[0]
@@ -36,18 +51,36 @@ async def main():
 	# create the camera and display
 	font = jetson.utils.cudaFont()
 	camera = jetson.utils.gstCamera(opt.width, opt.height, opt.camera)
-	display = jetson.utils.glDisplay()
+	display = None if opt.headless else jetson.utils.glDisplay()
 
 	# Fetch the connection string from an environment variable
 	conn_str = os.getenv("IOTHUB_EDGE_DEVICE_CONNECTION_STRING")
 	device_client = IoTHubDeviceClient.create_from_connection_string(conn_str)
 	await device_client.connect()
 
+	# messages are sent in the background, the frame loop only queues them
+	outbox = TelemetryOutbox(device_client, opt.telemetryBatchSize, opt.telemetryMaxDelay)
+	outbox.start()
+
+	# one message when the object comes into view, keep-alives while it stays
+	# and one once it is gone, instead of a message for every frame
+	debouncer = DetectionDebouncer([opt.classNameForTargetObject], opt.detectionThreshold, opt.detectionThreshold - opt.leaveMargin, opt.enterFrames, opt.leaveFrames, opt.keepAliveInterval, opt.minMessageInterval, TokenBucket(opt.maxMessagesPerMinute / 60, 3))
+
+	# frames of a still scene are not classified
+	gate = MotionGate(opt.motionThreshold / 100, 1 / opt.minSampleRate if opt.minSampleRate > 0 else None, opt.motionHold)
+
 	counter = 1
 	# process frames until user exits
-	while display.IsOpen():
-		# capture the image
-		img, width, height = camera.CaptureRGBA()
+	while display is None or display.IsOpen():
+		# capture the image, mapped so the motion gate can read it
+		img, width, height = camera.CaptureRGBA(zeroCopy=1)
+
+		if not gate.admit(img, width, height):
+			# keep the view live without classifying
+			if display is not None:
+				display.RenderOnce(img, width, height)
+			await asyncio.sleep(0)
+			continue
 
 		# classify the image
 		class_idx, confidence = net.Classify(img, width, height)
@@ -55,21 +88,29 @@ async def main():
 		# find the object description
 		class_desc = net.GetClassDesc(class_idx)
 
-		# overlay the result on the image	
-		font.OverlayText(img, width, height, "{:05.2f}% {:s}".format(confidence * 100, class_desc), 15, 50, font.Green, font.Gray40)
-	
-		# render the image
-		display.RenderOnce(img, width, height)
+		# nothing is drawn for frames that are not shown when running headless
+		if display is not None:
+			# overlay the result on the image	
+			font.OverlayText(img, width, height, "{:05.2f}% {:s}".format(confidence * 100, class_desc), 15, 50, font.Green, font.Gray40)
+
+			# render the image
+			display.RenderOnce(img, width, height)
 
-		# update the title bar
-		display.SetTitle("{:s} | Network {:.0f} FPS | Looking for {:s}".format(net.GetNetworkName(), net.GetNetworkFPS(), opt.classNameForTargetObject))
+			# update the title bar
+			display.SetTitle("{:s} | Network {:.0f} FPS | Looking for {:s}".format(net.GetNetworkName(), net.GetNetworkFPS(), opt.classNameForTargetObject))
 
 		# print out performance info
 		net.PrintProfilerTimes()
-		if class_desc == opt.classNameForTargetObject and (confidence*100) >= opt.detectionThreshold:
-			message = "Found " + class_desc + " with confidence : " + str(confidence*100)
-			await device_client.send_message(message)
-			print("Message sent for found object")
+		for event in debouncer.update(class_desc, confidence*100):
+			message = event_message(event)
+			outbox.post(message)
+			print("Message queued: " + message)
+
+		# let the outbox send in the background
+		await asyncio.sleep(0)
+	await outbox.close()
+	print("Telemetry", outbox.stats())
+	print("Motion gate", gate.stats())
 	await device_client.disconnect()
 if __name__ == "__main__":
 	#asyncio.run(main())
@@ -4,6 +4,7 @@
 
 import json
 import time
+import collections
 import os, uuid
 import sys
 import asyncio
@@ -12,11 +13,22 @@ import threading
 from azure.iot.device.aio import IoTHubModuleClient
 from azure.iot.device import MethodResponse
 from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
-
-# global counters
-TEMPERATURE_THRESHOLD = 25
-TWIN_CALLBACKS = 0
-RECEIVED_MESSAGES = 0
+from module_metrics import DEFAULT_METRICS_PORT, MetricsServer, ModuleMetrics
+from runtime_config import RuntimeConfig, parse_float
+
+# Metrics served for Prometheus, replacing the global counters
+METRICS = ModuleMetrics("request_processor_module")
+METHOD_REQUESTS = METRICS.counter("method_requests_total", "Direct method requests by method and response status", ("method", "status"))
+METHOD_REQUEST_SECONDS = METRICS.summary("method_request_seconds", "Time from receiving a direct method request to answering it", ("method",))
+METHOD_RESPONSE_SECONDS = METRICS.summary("method_response_seconds", "Time to send a direct method response")
+STORAGE_SECONDS = METRICS.summary("storage_seconds", "Time spent on blob storage for one direct method request")
+TWIN_PATCHES = METRICS.counter("twin_patches_total", "Desired properties patches received")
+
+# Settings the module twin changes while the module runs
+ModuleSettings = collections.namedtuple("ModuleSettings", "temperature_threshold")
+TWIN_SETTINGS = {
+    "TemperatureThreshold": ("temperature_threshold", parse_float()),
+}
 
 async def main():
     try:
@@ -30,13 +42,26 @@ async def main():
         # connect the client.
         await module_client.connect()
 
+        # Settings start from their defaults and follow the module twin
+        config = RuntimeConfig(ModuleSettings(temperature_threshold=25), TWIN_SETTINGS)
+        twin = await module_client.get_twin()
+        await config.apply_and_report(module_client, twin.get("desired", {}))
+
+        # metrics_port=0 turns the metrics endpoint off
+        metrics_server = None
+        metrics_port = int(os.getenv("metrics_port", DEFAULT_METRICS_PORT))
+        if metrics_port:
+            metrics_server = MetricsServer(METRICS, port=metrics_port)
+            await metrics_server.start()
+
         # define behavior for receiving an input message on input1
         async def input1_listener(module_client):
-            global RECEIVED_MESSAGES
-            global TEMPERATURE_THRESHOLD
             while True:
+                method_name = "unknown"
                 try:
                     method_request = await module_client.receive_method_request()
+                    method_name = method_request.name
+                    started = time.monotonic()
                     print (
                         "\nMethod callback called with:\nrequestID={request_id}\nmethodName = {method_name}\npayload = {payload}".format(
                             request_id=method_request.request_id,
@@ -52,6 +77,8 @@ async def main():
                     connect_str = "DefaultEndpointsProtocol=http;BlobEndpoint=http://azureblobstorageoniotedge:11002/request-processor;AccountName=request-processor;AccountKey=xq77wbfp+KwI77bonG5MziCuaUEOaYCym61goRX/Swk="
                     connect_str = "DefaultEndpointsProtocol=http;BlobEndpoint=http://azureblobstorageoniotedge:11002/metadatastore;AccountName=metadatastore;AccountKey=iYMKd+VQXJDxNwGInLuzl9tA5oUlxTcZnIVhfcGoUnRkXgGl7CROA7fYjOvXd+qFulujnhqjsdtYZpfNHqAVPg=="
                     print("Going for Connection establishment")
+                    # the blob client blocks the event loop, see event_loop_lag_seconds
+                    storage_started = time.monotonic()
                     # Create the BlobServiceClient object which will be used to create a container client
                     try:
                         blob_service_client = BlobServiceClient.from_connection_string(connect_str, api_version='2019-07-07')
@@ -95,6 +122,7 @@ async def main():
                     #print(blob_service_client.get_service_properties())
                     #print(blob_service_client.get_account_information())
                     print("Connection established")
+                    STORAGE_SECONDS.observe(time.monotonic() - storage_started)
 
                     # # Create a unique name for the container
                     # container_name = "quickstart" + str(uuid.uuid4())
@@ -130,25 +158,26 @@ async def main():
                     methodResponse = MethodResponse.create_from_method_request(method_request, response_status, response_payload)
 
                     # Responding back to the direct method call.
-                    await module_client.send_method_response(methodResponse)
+                    with METHOD_RESPONSE_SECONDS.time():
+                        await module_client.send_method_response(methodResponse)
+                    METHOD_REQUESTS.inc(method=method_name, status=response_status)
+                    METHOD_REQUEST_SECONDS.observe(time.monotonic() - started, method=method_name)
 
 
                 except Exception as ex:
+                    METHOD_REQUESTS.inc(method=method_name, status="error")
                     print ("Unexpected error in input1_listener: %s" % ex)
 
 
         # twin_patch_listener is invoked when the module twin's desired properties are updated.
         async def twin_patch_listener(module_client):
-            global TWIN_CALLBACKS
-            global TEMPERATURE_THRESHOLD
             while True:
                 try:
                     data = await module_client.receive_twin_desired_properties_patch()  # blocking call
                     print( "The data in the desired properties patch was: %s" % data)
-                    if "TemperatureThreshold" in data:
-                        TEMPERATURE_THRESHOLD = data["TemperatureThreshold"]
-                    TWIN_CALLBACKS += 1
-                    print ( "Total calls confirmed: %d\n" % TWIN_CALLBACKS )
+                    await config.apply_and_report(module_client, data)
+                    TWIN_PATCHES.inc()
+                    print ( "Total calls confirmed: %d\n" % TWIN_PATCHES.value() )
                 except Exception as ex:
                     print ( "Unexpected error in twin_patch_listener: %s" % ex )
 
@@ -177,6 +206,8 @@ async def main():
 
         # Cancel listening
         listeners.cancel()
+        if metrics_server is not None:
+            await metrics_server.stop()
 
         # Finally, disconnect
         await module_client.disconnect()
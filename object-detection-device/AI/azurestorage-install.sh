@@ -1,2 +1,3 @@
 sudo pip3 install azure-storage-queue==12.1.5
 sudo pip3 install azure-storage-blob==12.7.1
+sudo pip3 install pillow
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Measures the throughput of the inference engine per batch size on the CPU,
+# with ONNX Runtime running the exported classification model on images of a
+# dataset, so batching can be compared without a Jetson:
+#
+#   python3 benchmark-batching.py --model=gil_background_hulk/resnet18.onnx \
+#       --labels=$DATASET/labels.txt --images=$DATASET/test
+#
+# A model exported with a batch size of 1 runs every batch image by image, so
+# all batch sizes should come out about the same. Export the model with a
+# dynamic batch dimension to see the gain of batching.
+
+import argparse
+import os
+import time
+
+import numpy
+from PIL import Image
+
+from inference_engine import InferenceEngine
+from onnx_classifier import OnnxClassifier
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def load_images(directory, limit):
+    paths = []
+    for root, _, names in os.walk(directory):
+        paths += [
+            os.path.join(root, name)
+            for name in names
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+    images = []
+    for path in sorted(paths)[:limit]:
+        with Image.open(path) as image:
+            images.append(numpy.asarray(image.convert("RGB")))
+    return images
+
+
+def images_per_second(engine, images, top_k, rounds):
+    # the first batch pays for the session warming up
+    engine.classify(images[: engine.max_batch_size], top_k)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        engine.classify(images, top_k)
+    return rounds * len(images) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Throughput of the inference engine per batch size with ONNX Runtime"
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default="gil_background_hulk/resnet18.onnx",
+        help="ONNX classification model",
+    )
+    parser.add_argument(
+        "--labels", type=str, required=True, help="labels.txt of the dataset"
+    )
+    parser.add_argument(
+        "--images",
+        type=str,
+        required=True,
+        help="Directory searched for images, e.g. the test folder of the dataset",
+    )
+    parser.add_argument(
+        "--maxImages",
+        type=int,
+        default=64,
+        help="Number of images classified per round",
+    )
+    parser.add_argument("--rounds", type=int, default=3, help="Rounds per batch size")
+    parser.add_argument(
+        "--batchSizes", type=str, default="1,2,4,8", help="Batch sizes to compare"
+    )
+    parser.add_argument("--topK", type=int, default=5, help="Classes per image")
+    parser.add_argument("--input_blob", type=str, default="input_0")
+    parser.add_argument("--output_blob", type=str, default="output_0")
+    opt = parser.parse_args()
+
+    classifier = OnnxClassifier(opt.model, opt.labels, opt.input_blob, opt.output_blob)
+    images = load_images(opt.images, opt.maxImages)
+    if not images:
+        parser.error("No images in %s" % opt.images)
+    print(
+        "%d images, model batch size %s"
+        % (len(images), classifier.max_batch_size or "dynamic")
+    )
+
+    baseline = None
+    for batch_size in (int(size) for size in opt.batchSizes.split(",")):
+        engine = InferenceEngine(classifier, batch_size)
+        rate = images_per_second(engine, images, opt.topK, opt.rounds)
+        baseline = baseline or rate
+        print(
+            "batch {:3d} (runs {:3d}) {:8.1f} images/s {:6.2f}x".format(
+                batch_size, engine.max_batch_size, rate, rate / baseline
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
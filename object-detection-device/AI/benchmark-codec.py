@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+# Measures how fast requests are parsed: the pipe-delimited split of earlier
+# versions against MessageCodec in every encoding whose package is installed,
+# and how fast malformed messages are rejected.
+
+import argparse
+import time
+import uuid
+
+from message_codec import (
+    ENCODINGS,
+    JSON_ENCODING,
+    ClassTarget,
+    MessageCodec,
+    MessageError,
+    RequestMessage,
+)
+
+MALFORMED_MESSAGES = [
+    "",
+    "not a request",
+    "{",
+    '{"v":2,"id":"x","c":[["hulk",95]],"k":"key"}',
+    '{"v":1,"id":"x","c":[],"k":"key"}',
+    '{"v":1,"id":"x","c":[["hulk","high"]],"k":"key"}',
+    "x|hulk|95",
+    "x|hulk|high|key",
+]
+
+
+def legacy_split(content):
+    parts = content.split("|")
+    return parts[0], parts[1], int(parts[2]), parts[3]
+
+
+def per_second(parse, messages, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for message in messages:
+            parse(message)
+    return iterations * len(messages) / (time.perf_counter() - started)
+
+
+def rejected_per_second(codec, iterations):
+    def reject(message):
+        try:
+            codec.decode_request(message)
+        except MessageError:
+            return
+        raise AssertionError("accepted malformed message %r" % message)
+
+    return per_second(reject, MALFORMED_MESSAGES, iterations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Request parsing throughput")
+    parser.add_argument(
+        "--iterations", type=int, default=20000, help="Passes over the sample messages"
+    )
+    parser.add_argument(
+        "--classes", type=int, default=1, help="Classes per request for the codec"
+    )
+    opt = parser.parse_args()
+
+    module_key = hex(uuid.getnode())
+    requests = [
+        RequestMessage(
+            str(uuid.uuid4()),
+            [ClassTarget("class%d" % n, 90) for n in range(opt.classes)],
+            module_key,
+        )
+        for _ in range(16)
+    ]
+    legacy = ["|".join([r.correlation_id, "class0", "90", module_key]) for r in requests]
+
+    print(
+        "{:8s} {:>12.0f} msg/s {:>4d} bytes".format(
+            "pipe", per_second(legacy_split, legacy, opt.iterations), len(legacy[0])
+        )
+    )
+    for encoding in ENCODINGS:
+        try:
+            codec = MessageCodec(encoding)
+        except ImportError as ex:
+            print("{:8s} skipped, {}".format(encoding, ex))
+            continue
+        encoded = [codec.encode_request(r) for r in requests]
+        print(
+            "{:8s} {:>12.0f} msg/s {:>4d} bytes".format(
+                encoding,
+                per_second(codec.decode_request, encoded, opt.iterations),
+                len(encoded[0]),
+            )
+        )
+    print(
+        "{:8s} {:>12.0f} msg/s".format(
+            "rejected",
+            rejected_per_second(MessageCodec(JSON_ENCODING), opt.iterations),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+# Compares the frame rate of FrameProcessor with a display against headless
+# mode on real frames, the real network and the real overlays of a backend:
+#
+#   python3 benchmark-headless.py --backend=cpu \
+#       --model=gil_background_hulk/resnet18.onnx --labels=$DATASET/labels.txt \
+#       --input=$DATASET/test/background
+#
+# The request is never satisfied, so every frame takes the path of a frame
+# that does not match, which is what headless mode saves on. On the jetson
+# backend the display is the videoOutput window. The cpu backend has no
+# window, there the display converts every frame to the RGBA buffer a window
+# uploads, so the overlays are measured in full and rendering roughly.
+
+import argparse
+import json
+import sys
+import time
+
+import numpy
+
+from frame_processor import FrameProcessor
+from inference_backend import BACKENDS, CPU, create_backend
+from instrumentation import Instrumentation
+from request_table import DetectionRequest, RequestTarget
+
+
+# Stands in for the window on the cpu backend.
+class OffscreenDisplay:
+    def __init__(self):
+        self.buffer = None
+
+    def RenderOnce(self, img, width, height):
+        if self.buffer is None or self.buffer.shape[:2] != (height, width):
+            self.buffer = numpy.full((height, width, 4), 255, numpy.uint8)
+        self.buffer[:, :, :3] = img.array
+
+    def SetTitle(self, title):
+        pass
+
+
+def run(backend, net, source, display, opt):
+    instrumentation = Instrumentation()
+    frame_processor = FrameProcessor(
+        net,
+        backend.create_font(),
+        display,
+        "nothing",
+        top_k=opt.topK,
+        instrumentation=instrumentation,
+        encode=backend.encode,
+    )
+    # no class index reaches a confidence of 101%
+    requests = [DetectionRequest(None, "benchmark", [RequestTarget("", 0, 101)])]
+    for _ in range(opt.warmup):
+        frame_processor.process(source.Capture(), requests)
+    instrumentation.collect()
+    started = time.perf_counter()
+    for _ in range(opt.frames):
+        frame_processor.process(source.Capture(), requests)
+    seconds = time.perf_counter() - started
+    return opt.frames / seconds, instrumentation.collect()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Frame rate of FrameProcessor with a display and in headless mode"
+    )
+    parser.add_argument("--backend", choices=BACKENDS, default=CPU)
+    parser.add_argument("--network", type=str, default="", help="Unused with --model")
+    parser.add_argument(
+        "--input",
+        type=str,
+        required=True,
+        help="Frames to classify, e.g. a folder of images or a video file",
+    )
+    parser.add_argument("--frames", type=int, default=300, help="Frames per run")
+    parser.add_argument(
+        "--warmup", type=int, default=10, help="Frames processed before timing"
+    )
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--topK", type=int, default=5)
+    # --model, --labels, --input_blob and --output_blob are read by the backend
+    opt = parser.parse_known_args()[0]
+
+    backend = create_backend(opt.backend, sys.argv)
+    net = backend.load_network(opt.network)
+    source = backend.open_source(opt.input, (opt.width, opt.height))
+    display = backend.create_display() or OffscreenDisplay()
+
+    with_display, display_spans = run(backend, net, source, display, opt)
+    headless, headless_spans = run(backend, net, source, None, opt)
+    source.Close()
+
+    print(json.dumps({"display": display_spans, "headless": headless_spans}, indent=1))
+    print("display  {:8.1f} FPS".format(with_display))
+    print("headless {:8.1f} FPS".format(headless))
+    print("speedup  {:8.2f}x".format(headless / with_display))
+
+
+if __name__ == "__main__":
+    main()
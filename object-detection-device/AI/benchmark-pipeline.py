@@ -0,0 +1,198 @@
+#!/usr/bin/python
+
+# Load test of the request -> detect -> upload path of detect-post-object.py on
+# any Linux machine. The cpu backend classifies image folders or video files
+# with the exported ONNX model, requests are submitted at a fixed rate and the
+# upload and send stages only spend the configured time, so the detector is
+# measured without a camera, a Jetson or Azure:
+#
+#   python3 benchmark-pipeline.py --model=gil_background_hulk/resnet18.onnx \
+#       --labels=$DATASET/labels.txt --className=hulk \
+#       --stream=front=$DATASET/test/hulk --stream=back=$DATASET/test/gil
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from class_index import ClassIndex
+from frame_processor import FrameProcessor
+from inference_backend import CpuBackend
+from inference_engine import (
+    DEFAULT_BATCH_DELAY,
+    DEFAULT_MAX_BATCH_SIZE,
+    InferenceEngine,
+)
+from instrumentation import Instrumentation
+from motion_gate import MotionGate
+from pipeline import DetectionPipeline
+from request_table import DetectionRequest, RequestTable, RequestTarget
+from roi_tiler import grid_regions
+from video_streams import StreamScheduler, VideoStream, parse_assignments
+
+
+async def run(opt):
+    backend = CpuBackend(sys.argv)
+    net = backend.load_network("")
+    class_idx = ClassIndex.from_network(net).resolve(opt.className)
+    if class_idx is None:
+        raise ValueError("The network has no class %s" % opt.className)
+
+    # every frame is classified, a still folder of images would otherwise
+    # only be looked at once a second
+    streams = [
+        VideoStream(
+            stream_id,
+            uri,
+            backend.open_source,
+            MotionGate(0),
+            (opt.width, opt.height),
+        )
+        for stream_id, uri in parse_assignments(opt.stream).items()
+    ]
+    for stream in streams:
+        # the images are scaled to the resolution once, when they are loaded
+        stream.source = backend.open_source(stream.uri, stream.resolution)
+    scheduler = StreamScheduler(streams)
+
+    def capture():
+        stream = scheduler.next_stream()
+        frame = stream.capture(opt.width, opt.height)
+        return None if frame is None else (stream, frame)
+
+    regions = []
+    if opt.tileGrid:
+        columns, rows = (int(n) for n in opt.tileGrid.lower().split("x"))
+        regions = grid_regions(columns, rows, 0.2)
+    cropper = backend.create_cropper(regions) if regions else None
+
+    instrumentation = Instrumentation()
+    engine = InferenceEngine(net, opt.maxBatchSize * max(1, len(regions)))
+    frame_processor = FrameProcessor(
+        net,
+        backend.create_font(),
+        None,
+        opt.className,
+        top_k=opt.topK,
+        cropper=cropper,
+        instrumentation=instrumentation,
+        engine=engine,
+        encode=backend.encode,
+    )
+
+    def infer(stream_frames, requests):
+        return frame_processor.process_batch(
+            [(frame, stream.stream_id) for stream, frame in stream_frames], requests
+        )
+
+    submitted = {}
+    outcomes = {"found": 0, "timeout": 0, "error": 0}
+    finished = asyncio.Event()
+
+    def finish(outcome):
+        outcomes[outcome] += 1
+        if sum(outcomes.values()) == opt.requests:
+            finished.set()
+
+    async def upload(detection):
+        await asyncio.sleep(opt.uploadMs / 1000)
+
+    async def send(detection):
+        await asyncio.sleep(opt.sendMs / 1000)
+        correlation_id = detection.request.correlation_id
+        instrumentation.record("request", time.monotonic() - submitted[correlation_id])
+        finish("found")
+
+    async def on_error(detection, ex):
+        print("Detection failed: %s" % ex)
+        finish("error")
+
+    async def on_timeout(request):
+        finish("timeout")
+
+    pipeline = DetectionPipeline(
+        RequestTable(opt.requestTimeout),
+        capture,
+        infer,
+        upload,
+        send,
+        on_error,
+        on_timeout,
+        delivery_queue_size=opt.requests,
+        instrumentation=instrumentation,
+        batch_size=opt.maxBatchSize,
+        batch_delay=opt.batchDelay / 1000,
+    )
+    pipeline.start()
+
+    started = time.monotonic()
+    target = RequestTarget(opt.className, class_idx, opt.threshold)
+    for index in range(opt.requests):
+        correlation_id = "benchmark-%d" % index
+        submitted[correlation_id] = time.monotonic()
+        pipeline.submit(DetectionRequest(None, correlation_id, [target]))
+        await asyncio.sleep(1 / opt.requestRate)
+    await finished.wait()
+    elapsed = time.monotonic() - started
+    await pipeline.stop()
+
+    stats = pipeline.stats()
+    print(json.dumps(instrumentation.collect(), indent=1))
+    print("requests   %s" % outcomes)
+    print("frames     %8.1f per second" % (stats["inference"]["processed"] / elapsed))
+    print("requests   %8.1f per second" % (outcomes["found"] / elapsed))
+    print("batches    %s" % engine.stats())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Requests per second and latency of the detection pipeline on the CPU"
+    )
+    parser.add_argument(
+        "--stream",
+        type=str,
+        action="append",
+        required=True,
+        help="ID=URI of an image file, folder of images or video file, repeated per camera",
+    )
+    parser.add_argument(
+        "--className", type=str, required=True, help="Class every request looks for"
+    )
+    parser.add_argument(
+        "--threshold", type=int, default=50, help="Confidence in percent requests need"
+    )
+    parser.add_argument("--requests", type=int, default=100, help="Requests submitted")
+    parser.add_argument(
+        "--requestRate", type=float, default=10.0, help="Requests submitted per second"
+    )
+    parser.add_argument(
+        "--requestTimeout",
+        type=int,
+        default=30,
+        help="Seconds before a request times out",
+    )
+    parser.add_argument(
+        "--uploadMs", type=float, default=50.0, help="Simulated time of an upload"
+    )
+    parser.add_argument(
+        "--sendMs", type=float, default=20.0, help="Simulated time of a response"
+    )
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--topK", type=int, default=5)
+    parser.add_argument("--tileGrid", type=str, default="", help="e.g. 3x2")
+    parser.add_argument("--maxBatchSize", type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument(
+        "--batchDelay", type=float, default=DEFAULT_BATCH_DELAY * 1000, help="ms"
+    )
+    # --model, --labels, --input_blob and --output_blob are read by the backend
+    opt = parser.parse_known_args()[0]
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(opt))
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+
+# Compares the precisions the custom model can run at: accuracy on a labelled
+# split of the dataset against images per second, so the fastest precision
+# that still clears the detection threshold can be picked for
+# detect-post-object.py --precision:
+#
+#   python3 calibrate-int8.py --model=gil_background_hulk/resnet18.onnx \
+#       --images=$DATASET/train
+#   python3 benchmark-precision.py --model=gil_background_hulk/resnet18.onnx \
+#       --labels=$DATASET/labels.txt --images=$DATASET/test \
+#       --detectionThreshold=95
+#
+# The split has one folder per class, named as in labels.txt. Per precision
+# the report gives the top-1 accuracy, per class the share of its images
+# detected at the threshold (recall) and the images of other classes detected
+# as it (false positives), and the images classified per second, timing the
+# network only. On the cpu backend fp16 is skipped, ONNX Runtime has no fast
+# fp16 there; on the Jetson Nano int8 fails, the GPU has no fast INT8.
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from calibration import DEFAULT, FP16, FP32, INT8, PRECISIONS, sample_images
+from class_index import ClassIndex
+from engine_cache import DEFAULT_ENGINE_CACHE_DIRECTORY, EngineCache
+from inference_backend import BACKENDS, CPU, JETSON, create_backend
+from inference_engine import DEFAULT_MAX_BATCH_SIZE, InferenceEngine
+
+
+# Images of the split with the name of their class folder.
+def labelled_images(directory, limit):
+    return [
+        (path, os.path.basename(os.path.dirname(path)))
+        for path in sample_images(directory, limit)
+    ]
+
+
+def evaluate(backend, engine_cache, images, opt):
+    net = backend.load_network(opt.network, engine_cache)
+    class_index = ClassIndex.from_network(net)
+    engine = InferenceEngine(net, opt.batchSize)
+    threshold = opt.detectionThreshold / 100
+    names = sorted({name for _, name in images})
+    counts = {
+        name: {"images": 0, "detected": 0, "false_positives": 0} for name in names
+    }
+    correct = 0
+    seconds = 0.0
+    for start in range(0, len(images), opt.batchSize):
+        batch = images[start : start + opt.batchSize]
+        frames = [backend.load_image(path) for path, _ in batch]
+        started = time.monotonic()
+        predictions = engine.classify(frames, opt.topK)
+        seconds += time.monotonic() - started
+        for (_, name), image_predictions in zip(batch, predictions):
+            class_idx, confidence = image_predictions[0]
+            predicted = net.GetClassDesc(class_idx)
+            counts[name]["images"] += 1
+            if class_index.resolve(name) == class_idx:
+                correct += 1
+                if confidence >= threshold:
+                    counts[name]["detected"] += 1
+            elif confidence >= threshold and predicted in counts:
+                counts[predicted]["false_positives"] += 1
+    classes = {
+        name: {
+            "recall": count["detected"] / count["images"],
+            "false_positives": count["false_positives"],
+        }
+        for name, count in counts.items()
+    }
+    return {
+        "engine": backend.startup.engine,
+        "load_s": round(backend.startup.seconds, 2),
+        "accuracy": correct / len(images),
+        "images_per_second": len(images) / seconds if seconds else 0.0,
+        "classes": classes,
+    }
+
+
+# The fastest precision whose accuracy and recall of every class stay within
+# max_drop of the most precise one measured.
+def recommend(results, max_drop):
+    reference = next(
+        (results[p] for p in (FP32, DEFAULT, FP16, INT8) if p in results), None
+    )
+    if reference is None:
+        return None
+    candidates = [
+        precision
+        for precision, result in results.items()
+        if result["accuracy"] >= reference["accuracy"] - max_drop
+        and all(
+            result["classes"][name]["recall"] >= metrics["recall"] - max_drop
+            for name, metrics in reference["classes"].items()
+        )
+    ]
+    return max(candidates, key=lambda p: results[p]["images_per_second"], default=None)
+
+
+def print_report(results, threshold):
+    names = sorted({name for result in results.values() for name in result["classes"]})
+    header = "%-9s %-9s %9s %10s" % ("precision", "engine", "images/s", "accuracy")
+    header += "".join(" %16s" % ("%s@%d%%" % (name, threshold)) for name in names)
+    print(header)
+    for precision, result in results.items():
+        line = "%-9s %-9s %9.1f %9.1f%%" % (
+            precision,
+            result["engine"],
+            result["images_per_second"],
+            result["accuracy"] * 100,
+        )
+        for name in names:
+            metrics = result["classes"][name]
+            line += " %8.1f%% fp %4d" % (
+                metrics["recall"] * 100,
+                metrics["false_positives"],
+            )
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Accuracy against throughput of the model per precision"
+    )
+    parser.add_argument("--backend", choices=BACKENDS, default=JETSON)
+    parser.add_argument("--network", type=str, default="", help="Unused with --model")
+    parser.add_argument(
+        "--precisions",
+        type=str,
+        default="fp32,fp16,int8",
+        help="Comma separated precisions to compare, of %s" % ", ".join(PRECISIONS),
+    )
+    parser.add_argument(
+        "--images",
+        type=str,
+        default=os.path.join(os.environ.get("DATASET", "."), "test"),
+        help="Labelled split with one folder of images per class",
+    )
+    parser.add_argument(
+        "--maxImages", type=int, default=0, help="Images used, 0 for all of them"
+    )
+    parser.add_argument(
+        "--detectionThreshold",
+        type=int,
+        default=95,
+        help="Confidence in percent a class needs to count as detected",
+    )
+    parser.add_argument("--topK", type=int, default=1)
+    parser.add_argument("--batchSize", type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument(
+        "--maxAccuracyDrop",
+        type=float,
+        default=1.0,
+        help="Percentage points of accuracy and recall a faster precision may lose",
+    )
+    parser.add_argument(
+        "--engineCache",
+        type=str,
+        default=DEFAULT_ENGINE_CACHE_DIRECTORY,
+        help="Directory of built engines, an empty value disables it",
+    )
+    parser.add_argument("--json", type=str, default="", help="Also write the results")
+    # --model, --labels, --calibrationCache, --input_blob and --output_blob
+    # are read by the backend
+    opt = parser.parse_known_args()[0]
+
+    images = labelled_images(opt.images, opt.maxImages)
+    if not images:
+        raise ValueError("No images in %s" % opt.images)
+    engine_cache = EngineCache(opt.engineCache) if opt.engineCache else None
+
+    results = {}
+    for precision in opt.precisions.split(","):
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision %s" % precision)
+        if precision == FP16 and opt.backend == CPU:
+            print("Skipping fp16, the cpu backend runs fp32 and int8")
+            continue
+        # the last --precision is the one the backend reads
+        argv = sys.argv + ["--precision=" + precision]
+        print("Measuring %s on %d images" % (precision, len(images)))
+        try:
+            results[precision] = evaluate(
+                create_backend(opt.backend, argv), engine_cache, images, opt
+            )
+        except ValueError as ex:
+            print("Skipping %s: %s" % (precision, ex))
+
+    print_report(results, opt.detectionThreshold)
+    best = recommend(results, opt.maxAccuracyDrop / 100)
+    if best is not None:
+        print(
+            "Fastest within %.1f points of %s: --precision=%s"
+            % (opt.maxAccuracyDrop, FP32 if FP32 in results else "the reference", best)
+        )
+    if opt.json:
+        with open(opt.json, "w") as report:
+            json.dump({"recommended": best, "precisions": results}, report, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/python
+
+# Compares the storage access pattern used by detect-post-object.py before and
+# after the storage clients were pooled: polls per second against the request
+# queue and upload latency for the detection image. It then uploads content of
+# each of --sizes in a single request and as parallel staged blocks, and
+# times the commit of an upload resumed after half of its blocks were staged.
+#
+# By default it runs against a local Azurite emulator, e.g.
+#   docker run -p 10000:10000 -p 10001:10001 mcr.microsoft.com/azure-storage/azurite
+# Set STORAGE_CONNECTION_STRING to point it at any other account.
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.queue.aio import QueueClient
+from azure.storage.blob.aio import BlobServiceClient
+
+from storage_helper import (
+    REQUEST_QUEUE_NAME,
+    RESPONSE_CONTAINER_NAME,
+    StorageHelperAsync,
+    _block_id,
+)
+
+# Well-known development account exposed by Azurite.
+AZURITE_CONNECTION_STRING = (
+    "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;"
+    "AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;"
+    "BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;"
+    "QueueEndpoint=http://127.0.0.1:10001/devstoreaccount1;"
+)
+
+
+# The pre-pooling behaviour: a new client for every single call.
+async def per_call_receive(connection_string):
+    queue_client = QueueClient.from_connection_string(
+        connection_string, REQUEST_QUEUE_NAME
+    )
+    async with queue_client:
+        response = queue_client.receive_messages(messages_per_page=1)
+        async for message in response:
+            await queue_client.delete_message(message)
+            return message
+
+
+async def per_call_upload(connection_string, upload_path, data):
+    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+    async with blob_service_client:
+        container_client = blob_service_client.get_container_client(
+            RESPONSE_CONTAINER_NAME
+        )
+        blob_client = container_client.get_blob_client(blob=upload_path)
+        await blob_client.upload_blob(data)
+
+
+async def ensure_resources(connection_string):
+    async with QueueClient.from_connection_string(
+        connection_string, REQUEST_QUEUE_NAME
+    ) as queue_client:
+        try:
+            await queue_client.create_queue()
+        except ResourceExistsError:
+            pass
+    async with BlobServiceClient.from_connection_string(
+        connection_string
+    ) as blob_service_client:
+        try:
+            await blob_service_client.create_container(RESPONSE_CONTAINER_NAME)
+        except ResourceExistsError:
+            pass
+
+
+async def time_calls(count, call):
+    latencies = []
+    started = time.perf_counter()
+    for index in range(count):
+        call_started = time.perf_counter()
+        await call(index)
+        latencies.append(time.perf_counter() - call_started)
+    return time.perf_counter() - started, latencies
+
+
+def report(name, count, elapsed, latencies):
+    latencies = sorted(latencies)
+    print(
+        "{:<24s} {:>9.1f} ops/s  p50 {:>7.2f} ms  p95 {:>7.2f} ms".format(
+            name,
+            count / elapsed,
+            statistics.median(latencies) * 1000,
+            latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        )
+    )
+
+
+# Stages the first half of the blocks of an upload, as an attempt that was
+# interrupted part way would have left them.
+async def stage_first_half(storage_helper, upload_path, data):
+    blob_client = storage_helper._container_client.get_blob_client(blob=upload_path)
+    block_size = storage_helper.block_size
+    offsets = list(range(0, len(data), block_size))
+    for index, offset in enumerate(offsets[: len(offsets) // 2]):
+        block = data[offset : offset + block_size]
+        await blob_client.stage_block(_block_id(index, block), block)
+
+
+async def compare_sizes(connection_string, opt, run_id):
+    block_size = opt.blockSize * 1024
+    for size_kb in [int(size) for size in opt.sizes.split(",")]:
+        data = os.urandom(size_kb * 1024)
+        count = max(1, opt.sizeIterations)
+        # A block as large as the content means a single request.
+        async with StorageHelperAsync(
+            connection_string, max_connections=opt.maxConnections, block_size=len(data)
+        ) as single:
+            elapsed, latencies = await time_calls(
+                count,
+                lambda index: single.block_blob_upload_async(
+                    "benchmark/{}/single-{}k-{}.bin".format(run_id, size_kb, index), data
+                ),
+            )
+            report("{} KiB single".format(size_kb), count, elapsed, latencies)
+
+        async with StorageHelperAsync(
+            connection_string,
+            max_connections=max(opt.maxConnections, opt.uploadConcurrency + 1),
+            block_size=block_size,
+            upload_concurrency=opt.uploadConcurrency,
+        ) as staged:
+            elapsed, latencies = await time_calls(
+                count,
+                lambda index: staged.block_blob_upload_async(
+                    "benchmark/{}/staged-{}k-{}.bin".format(run_id, size_kb, index), data
+                ),
+            )
+            report("{} KiB staged".format(size_kb), count, elapsed, latencies)
+
+            if len(data) < 2 * block_size:
+                continue
+            latencies = []
+            for index in range(count):
+                upload_path = "benchmark/{}/resumed-{}k-{}.bin".format(
+                    run_id, size_kb, index
+                )
+                await stage_first_half(staged, upload_path, data)
+                started = time.perf_counter()
+                await staged.block_blob_upload_async(upload_path, data)
+                latencies.append(time.perf_counter() - started)
+            report("{} KiB resumed".format(size_kb), count, sum(latencies), latencies)
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark per-call storage clients against the pooled StorageHelperAsync session"
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=200, help="Number of polls and uploads per run"
+    )
+    parser.add_argument(
+        "--image", type=str, default="test.jpg", help="File uploaded as the detection image"
+    )
+    parser.add_argument(
+        "--maxConnections",
+        type=int,
+        default=4,
+        help="Size of the connection pool used by the pooled session",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=str,
+        default="64,1024,8192,32768",
+        help="Comma separated content sizes in KiB compared between single and staged uploads",
+    )
+    parser.add_argument(
+        "--sizeIterations",
+        type=int,
+        default=5,
+        help="Number of uploads per content size",
+    )
+    parser.add_argument(
+        "--blockSize", type=int, default=4096, help="Block size in KiB of staged uploads"
+    )
+    parser.add_argument(
+        "--uploadConcurrency",
+        type=int,
+        default=4,
+        help="Blocks staged at the same time by staged uploads",
+    )
+    opt = parser.parse_args()
+
+    connection_string = os.getenv("STORAGE_CONNECTION_STRING", AZURITE_CONNECTION_STRING)
+    await ensure_resources(connection_string)
+    # Blob names are unique per run so repeated runs never collide.
+    run_id = int(time.time())
+    with open(opt.image, "rb") as image_file:
+        image = image_file.read()
+
+    elapsed, latencies = await time_calls(
+        opt.iterations, lambda index: per_call_receive(connection_string)
+    )
+    report("poll (per call)", opt.iterations, elapsed, latencies)
+
+    elapsed, latencies = await time_calls(
+        opt.iterations,
+        lambda index: per_call_upload(
+            connection_string, "benchmark/{}/per-call-{}.jpg".format(run_id, index), image
+        ),
+    )
+    report("upload (per call)", opt.iterations, elapsed, latencies)
+
+    async with StorageHelperAsync(
+        connection_string, max_connections=opt.maxConnections
+    ) as storage_helper:
+        async def pooled_receive(index):
+            for lease in await storage_helper.queue_receive_leases_async():
+                await lease.complete()
+
+        elapsed, latencies = await time_calls(opt.iterations, pooled_receive)
+        report("poll (pooled)", opt.iterations, elapsed, latencies)
+
+        elapsed, latencies = await time_calls(
+            opt.iterations,
+            lambda index: storage_helper.block_blob_upload_async(
+                "benchmark/{}/pooled-{}.jpg".format(run_id, index), image
+            ),
+        )
+        report("upload (pooled)", opt.iterations, elapsed, latencies)
+
+    await compare_sizes(connection_string, opt, run_id)
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
+    loop.close()
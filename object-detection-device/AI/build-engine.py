@@ -0,0 +1,68 @@
+#!/usr/bin/python
+
+# Builds the TensorRT engine of the exported model at a chosen precision, for
+# programs that hand --model straight to jetson.inference.imageNet, like the
+# azure-post samples. imageNet loads the .engine file given as --model:
+#
+#   python3 build-engine.py --model=gil_background_hulk/resnet18.onnx \
+#       --precision=fp16
+#   python3 custom-model-azure-post.py \
+#       --model=gil_background_hulk/resnet18.fp16.engine ...
+#
+# int8 takes the ranges of the calibration cache made by calibrate-int8.py.
+# Only on the Jetson the engine is to run on, an engine does not load on
+# another GPU or TensorRT version. detect-post-object.py builds and caches its
+# engine itself with --precision.
+
+import argparse
+import os
+import time
+
+from calibration import FP16, FP32, INT8, CalibrationCache, default_calibration_cache
+from engine_builder import build_engine
+from engine_cache import ENGINE_EXTENSION
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Builds a TensorRT engine of an ONNX model at a precision"
+    )
+    parser.add_argument("--model", type=str, required=True, help="ONNX model")
+    parser.add_argument(
+        "--precision", type=str, default=FP16, choices=(FP32, FP16, INT8)
+    )
+    parser.add_argument(
+        "--calibrationCache",
+        type=str,
+        default="",
+        help="Calibration cache for int8, by default <model>.calibration.json",
+    )
+    parser.add_argument(
+        "--batchSize", type=int, default=1, help="Largest batch of the engine"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="",
+        help="Engine to write, by default resnet18.<precision>.engine for resnet18.onnx",
+    )
+    opt = parser.parse_args()
+
+    calibration = None
+    if opt.precision == INT8:
+        path = opt.calibrationCache or default_calibration_cache(opt.model)
+        calibration = CalibrationCache.load(path)
+        calibration.check_model(opt.model)
+    # apart from the <model>.*.engine files imageNet saves next to the model
+    stem = os.path.splitext(opt.model)[0]
+    output = opt.output or "%s.%s%s" % (stem, opt.precision, ENGINE_EXTENSION)
+
+    started = time.monotonic()
+    engine = build_engine(opt.model, opt.precision, opt.batchSize, calibration)
+    with open(output, "wb") as engine_file:
+        engine_file.write(engine)
+    print("%s built in %.1f s" % (output, time.monotonic() - started))
+
+
+if __name__ == "__main__":
+    main()
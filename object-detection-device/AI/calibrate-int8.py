@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+# Calibrates the exported classification model for INT8 on sample frames, e.g.
+# the train split of the dataset it was trained on:
+#
+#   python3 calibrate-int8.py --model=gil_background_hulk/resnet18.onnx \
+#       --images=$DATASET/train
+#
+# Writes the calibration cache (resnet18.calibration.json next to the model)
+# with the range of every tensor, which detect-post-object.py --precision=int8
+# builds the TensorRT engine from on the Jetson, and the INT8 model
+# (resnet18.int8.onnx) the cpu backend runs at int8. Calibrate again after the
+# model is retrained, the cache only fits the model it was made from.
+# Calibration runs with ONNX Runtime, on any machine.
+
+import argparse
+import os
+import time
+
+from calibration import (
+    DEFAULT_CALIBRATION_IMAGES,
+    METHODS,
+    calibrate,
+    default_calibration_cache,
+    quantize_int8,
+    sample_images,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Calibrates an ONNX classification model for INT8"
+    )
+    parser.add_argument("--model", type=str, required=True, help="ONNX model")
+    parser.add_argument(
+        "--images",
+        type=str,
+        default=os.path.join(os.environ.get("DATASET", "."), "train"),
+        help="Directory of sample frames, searched recursively",
+    )
+    parser.add_argument(
+        "--maxImages",
+        type=int,
+        default=DEFAULT_CALIBRATION_IMAGES,
+        help="Sample frames used, spread evenly over the directory",
+    )
+    parser.add_argument(
+        "--method",
+        type=str,
+        default="minmax",
+        choices=METHODS,
+        help="How the ranges are taken from the activations",
+    )
+    parser.add_argument(
+        "--calibrationCache",
+        type=str,
+        default="",
+        help="Cache to write, by default <model>.calibration.json",
+    )
+    parser.add_argument(
+        "--cpuModel",
+        type=str,
+        default="",
+        help="INT8 ONNX model to write for the cpu backend, by default <model>.int8.onnx",
+    )
+    opt = parser.parse_args()
+
+    paths = sample_images(opt.images, opt.maxImages)
+    if not paths:
+        raise ValueError("No images in %s" % opt.images)
+    cache_path = opt.calibrationCache or default_calibration_cache(opt.model)
+    cpu_model = opt.cpuModel or os.path.splitext(opt.model)[0] + ".int8.onnx"
+
+    print("Calibrating %s on %d images of %s" % (opt.model, len(paths), opt.images))
+    started = time.monotonic()
+    cache = calibrate(opt.model, paths, opt.method)
+    seconds = time.monotonic() - started
+    print("%d tensor ranges in %.1f s" % (len(cache.ranges), seconds))
+
+    started = time.monotonic()
+    quantize_int8(opt.model, cpu_model, paths, opt.method)
+    print("INT8 model %s in %.1f s" % (cpu_model, time.monotonic() - started))
+
+    cache.cpu_model = cpu_model
+    cache.save(cache_path)
+    print("Calibration cache %s" % cache_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy
+from PIL import Image
+
+from engine_cache import file_sha256
+from onnx_classifier import DEFAULT_INPUT_SIZE, preprocess
+
+# Precisions the network can run at. DEFAULT leaves the choice to the runtime,
+# which on the Jetson is the fastest precision the GPU supports.
+DEFAULT = "default"
+FP32 = "fp32"
+FP16 = "fp16"
+INT8 = "int8"
+PRECISIONS = (DEFAULT, FP32, FP16, INT8)
+
+# Calibration methods of ONNX Runtime: min/max ranges are quick, percentile
+# and entropy ranges ignore outliers and usually lose less accuracy.
+METHODS = ("minmax", "percentile", "entropy")
+
+DEFAULT_CALIBRATION_IMAGES = 300
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+CALIBRATION_EXTENSION = ".calibration.json"
+
+
+# Where calibrate-int8.py puts the cache of a model by default, e.g.
+# resnet18.calibration.json next to resnet18.onnx.
+def default_calibration_cache(model_path):
+    return os.path.splitext(model_path)[0] + CALIBRATION_EXTENSION
+
+
+# Picks up to limit images of a directory tree, e.g. the train split of
+# gil_background_hulk with one folder per class. Images are taken at even
+# steps through the sorted paths, so every class is represented in proportion
+# and the same directory always gives the same sample.
+def sample_images(directory, limit=DEFAULT_CALIBRATION_IMAGES):
+    paths = []
+    for root, _, names in os.walk(directory):
+        paths += [
+            os.path.join(root, name)
+            for name in names
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+    paths.sort()
+    if limit and len(paths) > limit:
+        step = len(paths) / limit
+        paths = [paths[int(index * step)] for index in range(limit)]
+    return paths
+
+
+def load_image(path):
+    with Image.open(path) as image:
+        return numpy.asarray(image.convert("RGB"))
+
+
+# Feeds sample images to the ONNX Runtime calibrator and quantizer, decoding
+# them again on every pass instead of keeping the whole sample in memory. The
+# images go through the same preprocessing as the frames of the cpu backend.
+# Implements onnxruntime.quantization.CalibrationDataReader.
+class ImageBatchReader:
+    def __init__(
+        self,
+        paths,
+        input_name,
+        width=DEFAULT_INPUT_SIZE,
+        height=DEFAULT_INPUT_SIZE,
+        batch_size=1,
+    ):
+        self.paths = paths
+        self.input_name = input_name
+        self.width = width
+        self.height = height
+        self.batch_size = batch_size
+        self._next = 0
+
+    def get_next(self):
+        if self._next >= len(self.paths):
+            return None
+        batch = self.paths[self._next : self._next + self.batch_size]
+        self._next += len(batch)
+        images = [load_image(path) for path in batch]
+        return {self.input_name: preprocess(images, self.width, self.height)}
+
+    def rewind(self):
+        self._next = 0
+
+    def __iter__(self):
+        self.rewind()
+        return iter(self.get_next, None)
+
+
+# The INT8 ranges of every tensor of one model, kept as JSON next to the model
+# so the network can be rebuilt at INT8 without calibrating again. The
+# TensorRT engine builder sets them as dynamic ranges, and cpu_model names the
+# INT8 ONNX model quantized with them for ONNX Runtime.
+class CalibrationCache:
+    def __init__(self, model_sha256, method, images, ranges, cpu_model=None):
+        self.model_sha256 = model_sha256
+        self.method = method
+        self.images = images
+        self.ranges = ranges
+        self.cpu_model = cpu_model
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as cache_file:
+            cache = json.load(cache_file)
+        cpu_model = cache.get("cpu_model")
+        if cpu_model:
+            # stored relative to the cache
+            cpu_model = os.path.join(os.path.dirname(path), cpu_model)
+        return cls(
+            cache["model_sha256"],
+            cache["method"],
+            cache["images"],
+            {name: tuple(bounds) for name, bounds in cache["ranges"].items()},
+            cpu_model,
+        )
+
+    def save(self, path):
+        cache = {
+            "model_sha256": self.model_sha256,
+            "method": self.method,
+            "images": self.images,
+            "ranges": {name: list(bounds) for name, bounds in self.ranges.items()},
+        }
+        if self.cpu_model:
+            cache["cpu_model"] = os.path.relpath(
+                self.cpu_model, os.path.dirname(os.path.abspath(path))
+            )
+        temporary = path + ".tmp"
+        with open(temporary, "w") as cache_file:
+            json.dump(cache, cache_file, indent=1, sort_keys=True)
+        os.replace(temporary, path)
+
+    # Raises ValueError when the cache was made for another model, e.g. before
+    # the model was retrained.
+    def check_model(self, model_path):
+        if file_sha256(model_path) != self.model_sha256:
+            raise ValueError(
+                "The calibration cache was made for another version of %s, "
+                "calibrate it again" % model_path
+            )
+
+    # Identifies the ranges, for telling engines built with different
+    # calibrations apart.
+    def digest(self):
+        ranges = json.dumps(sorted(self.ranges.items())).encode("utf-8")
+        return hashlib.sha256(ranges).hexdigest()[:16]
+
+
+def _calibration_method(method):
+    from onnxruntime.quantization import CalibrationMethod
+
+    return {
+        "minmax": CalibrationMethod.MinMax,
+        "percentile": CalibrationMethod.Percentile,
+        "entropy": CalibrationMethod.Entropy,
+    }[method]
+
+
+def _input_name(model_path):
+    import onnxruntime
+
+    session = onnxruntime.InferenceSession(
+        model_path, providers=["CPUExecutionProvider"]
+    )
+    return session.get_inputs()[0].name
+
+
+# Runs the sample images through the model with ONNX Runtime and returns the
+# range of every tensor as a CalibrationCache.
+def calibrate(model_path, paths, method="minmax"):
+    from onnxruntime.quantization.calibrate import create_calibrator
+
+    with tempfile.TemporaryDirectory() as work:
+        calibrator = create_calibrator(
+            model_path,
+            augmented_model_path=os.path.join(work, "augmented.onnx"),
+            calibrate_method=_calibration_method(method),
+        )
+        calibrator.collect_data(ImageBatchReader(paths, _input_name(model_path)))
+        if hasattr(calibrator, "compute_data"):
+            data = calibrator.compute_data()
+        else:
+            # ONNX Runtime before 1.16
+            data = calibrator.compute_range()
+        ranges = {}
+        for name, value in data.items():
+            low, high = getattr(value, "range_value", value)
+            ranges[name] = (float(numpy.min(low)), float(numpy.max(high)))
+    return CalibrationCache(file_sha256(model_path), method, len(paths), ranges)
+
+
+# Writes the INT8 model for ONNX Runtime: QDQ format, weights quantized per
+# channel, as recommended for CPUs. The quantizer calibrates on the same
+# sample images.
+def quantize_int8(model_path, output_path, paths, method="minmax"):
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+
+    quantize_static(
+        model_path,
+        output_path,
+        ImageBatchReader(paths, _input_name(model_path)),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        calibrate_method=_calibration_method(method),
+    )
@@ -0,0 +1,24 @@
+# Maps class names to the class indices of the loaded network.
+# Built once at startup so requests are resolved to an index when they arrive
+# and frames are matched by index instead of comparing class name strings.
+class ClassIndex:
+    def __init__(self, class_names):
+        self.class_names = list(class_names)
+        self._indices = {name: index for index, name in enumerate(self.class_names)}
+
+    @classmethod
+    def from_network(cls, net):
+        return cls(net.GetClassDesc(index) for index in range(net.GetNumClasses()))
+
+    # One class name per line, as in the labels.txt of a dataset.
+    @classmethod
+    def from_labels_file(cls, path):
+        with open(path) as labels:
+            return cls(line.strip() for line in labels if line.strip())
+
+    def __len__(self):
+        return len(self.class_names)
+
+    # Returns None for a class the network does not know.
+    def resolve(self, class_name):
+        return self._indices.get(class_name)
@@ -36,6 +36,7 @@ async def main():
 	parser.add_argument("--height", type=int, default=720, help="desired height of camera stream (default is 720 pixels)")
 	parser.add_argument("--classNameForTargetObject", type=str, default="", help="class name of the object that is required to be detected. Once object is detected and threshhold limit has crossed, the message would be sent to Azure IoT Hub")
 	parser.add_argument("--detectionThreshold", type=int, default=90, help="The threshold value 'in percentage' for object detection")
+	parser.add_argument("--headless", action="store_true", help="run without a display window, skipping overlays and rendering that are not needed for a detection image")
 
 	try:
 		opt = parser.parse_known_args()[0]
@@ -49,12 +50,10 @@ async def main():
 	print('Loaded network')
 	# create the camera and display
 	font = jetson.utils.cudaFont()
-	camera = jetson.utils.gstCamera(opt.width, opt.height, opt.camera)
-	display = jetson.utils.glDisplay()
+	display = None if opt.headless else jetson.utils.glDisplay()
 	input = jetson.utils.videoSource(opt.input_URI, argv=sys.argv)
 	print('Loaded display')
 	print(display)
-	print(camera)
 	# Fetch the connection string from an environment variable
 	conn_str = os.getenv("IOTHUB_DEVICE_CONNECTION_STRING")
 	print("Connection string as: ")
@@ -109,24 +108,29 @@ async def main():
 				class_desc = net.GetClassDesc(class_idx)
 				print('Got class description')
 
-				# overlay the result on the image	
-				font.OverlayText(img, img.width, img.height, "{:05.2f}% {:s}".format(confidence * 100, class_desc), 15, 50, font.Green, font.Gray40)
-				print('Set font overlay')
+				# nothing is drawn for frames that are not shown when running headless
+				if display is not None:
+					# overlay the result on the image	
+					font.OverlayText(img, img.width, img.height, "{:05.2f}% {:s}".format(confidence * 100, class_desc), 15, 50, font.Green, font.Gray40)
+					print('Set font overlay')
 
-				# render the image
-				display.RenderOnce(img, img.width, img.height)
-				print('Rendered once')
+					# render the image
+					display.RenderOnce(img, img.width, img.height)
+					print('Rendered once')
 
-				# update the title bar
-				display.SetTitle("{:s} | Network {:.0f} FPS | Looking for {:s}".format(net.GetNetworkName(), net.GetNetworkFPS(), opt.classNameForTargetObject))
-				print('Display is set')
+					# update the title bar
+					display.SetTitle("{:s} | Network {:.0f} FPS | Looking for {:s}".format(net.GetNetworkName(), net.GetNetworkFPS(), opt.classNameForTargetObject))
+					print('Display is set')
 
 				# print out performance info
 				net.PrintProfilerTimes()
 				if class_desc == classForObjectDetection and (confidence*100) >= int(thresholdForObjectDetection):
 					message = requestContent + "|" + str(confidence*100)
+					if display is None:
+						font.OverlayText(img, img.width, img.height, "{:05.2f}% {:s}".format(confidence * 100, class_desc), 15, 50, font.Green, font.Gray40)
 					font.OverlayText(img, img.width, img.height, "Found {:s} at {:05.2f}% confidence".format(class_desc, confidence * 100), 775, 50, font.Blue, font.Gray40)
-					display.RenderOnce(img, img.width, img.height)
+					if display is not None:
+						display.RenderOnce(img, img.width, img.height)
 					savedFile='imageWithDetection.jpg'
 					jetson.utils.saveImageRGBA(savedFile,img, img.width,img.height)
 
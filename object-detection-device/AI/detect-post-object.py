@@ -1,61 +1,123 @@
 #!/usr/bin/python
 
-import jetson.inference
-import jetson.utils
-
 import argparse
 import sys
 
 import os
 import asyncio
+import collections
+import time
+from azure.iot.device import Message
 from azure.iot.device.aio import IoTHubDeviceClient
-from azure.storage.queue.aio import QueueClient
-from azure.storage.blob.aio import BlobServiceClient, BlobClient, ContainerClient
-
-# A helper class to support async blob and queue actions.
-class StorageHelperAsync:
-    async def block_blob_upload_async(self, upload_path, savedFile):
-        blob_service_client = BlobServiceClient.from_connection_string(
-            os.getenv("STORAGE_CONNECTION_STRING")
-        )
-        container_name = "iot-edge-object-classification-responses"
-
-        async with blob_service_client:
-            # Instantiate a new ContainerClient
-            container_client = blob_service_client.get_container_client(container_name)
-
-            # Instantiate a new BlobClient
-            blob_client = container_client.get_blob_client(blob=upload_path)
-
-            # Upload content to block blob
-            with open(savedFile, "rb") as data:
-                await blob_client.upload_blob(data)
-                # [END upload_a_blob]
-
-    # Code for listening to Storage queue
-    async def queue_receive_message_async(self):
-        # from azure.storage.queue.aio import QueueClient
-        queue_client = QueueClient.from_connection_string(
-            os.getenv("STORAGE_CONNECTION_STRING"),
-            "iot-edge-object-classification-requests",
-        )
 
-        async with queue_client:
-            response = queue_client.receive_messages(messages_per_page=1)
-            async for message in response:
-                queue_message = message
-                await queue_client.delete_message(message)
-                return queue_message
+from calibration import DEFAULT, PRECISIONS
+from class_index import ClassIndex
+from engine_cache import DEFAULT_ENGINE_CACHE_DIRECTORY, EngineCache
+from frame_processor import FrameProcessor
+from idle_scheduler import IdleScheduler
+from inference_backend import BACKENDS, JETSON, create_backend
+from inference_engine import (
+    DEFAULT_BATCH_DELAY,
+    DEFAULT_MAX_BATCH_SIZE,
+    InferenceEngine,
+    classifies_batches,
+)
+from instrumentation import (
+    DEFAULT_STATS_PORT,
+    Instrumentation,
+    StatsServer,
+    SummaryReporter,
+)
+from message_codec import (
+    ENCODINGS,
+    MESSAGE_TYPE_PROPERTY,
+    RESPONSE_MESSAGE_TYPE,
+    STATS_MESSAGE_TYPE,
+    STATUS_CLASS_NOT_ALLOWED,
+    STATUS_FOUND,
+    STATUS_TIMEOUT,
+    STATUS_UNKNOWN_CLASS,
+    MessageCodec,
+    MessageError,
+    ResponseMessage,
+)
+from motion_gate import MotionGate
+from pipeline import DetectionPipeline, frames_held
+from request_table import DetectionRequest, RequestTable, RequestTarget
+from roi_tiler import FULL_FRAME_REGION, grid_regions, parse_regions
+from runtime_config import (
+    RuntimeConfig,
+    parse_int,
+    parse_string_list,
+    parse_thresholds,
+)
+from spool import (
+    BLOB_RECORD,
+    FSYNC_POLICIES,
+    TELEMETRY_RECORD,
+    Spool,
+    SpoolDrainer,
+)
+from storage_helper import DEFAULT_MAX_CONNECTIONS, StorageHelperAsync
+from video_streams import (
+    ROUND_ROBIN,
+    SCHEDULES,
+    StreamScheduler,
+    VideoStream,
+    parse_assignments,
+)
+
+# Settings that desired properties of the device twin change while the
+# detector runs, without reloading the network.
+#   target_classes    classes requests may ask for, any class when empty
+#   class_thresholds  lowest threshold in percent accepted for a class
+#   frame_skip        camera frames dropped between two classified frames
+DetectorSettings = collections.namedtuple(
+    "DetectorSettings",
+    [
+        "target_classes",
+        "class_thresholds",
+        "frame_skip",
+        "width",
+        "height",
+        "top_k",
+        "jpeg_quality",
+        "queue_batch_size",
+        "max_open_requests",
+    ],
+)
+
+# Desired property name -> (settings field, parser)
+TWIN_SETTINGS = {
+    "targetClasses": ("target_classes", parse_string_list),
+    "classThresholds": ("class_thresholds", parse_thresholds),
+    "frameSkip": ("frame_skip", parse_int(0, 100)),
+    "width": ("width", parse_int(64, 4096)),
+    "height": ("height", parse_int(64, 4096)),
+    "topK": ("top_k", parse_int(1, 100)),
+    "jpegQuality": ("jpeg_quality", parse_int(1, 100)),
+    "queueBatchSize": ("queue_batch_size", parse_int(1, 32)),
+    "maxOpenRequests": ("max_open_requests", parse_int(1, 1000)),
+}
 
 
 async def main():
+    process_started = time.monotonic()
+
+    # The backend runs the network and handles the frames: jetson.inference
+    # on the device, ONNX Runtime and numpy anywhere else. It is picked first
+    # as the usage of its network options ends the help.
+    backend_parser = argparse.ArgumentParser(add_help=False)
+    backend_parser.add_argument("--backend", choices=BACKENDS, default=JETSON)
+    backend_name = backend_parser.parse_known_args()[0].backend
+    backend = create_backend(backend_name, sys.argv)
 
     # Code for object detection
     # parse the command line
     parser = argparse.ArgumentParser(
         description="Classifying an object from a live camera feed and once successfully classified a message is sent to Azure IoT Hub",
         formatter_class=argparse.RawTextHelpFormatter,
-        epilog=jetson.inference.imageNet.Usage(),
+        epilog=backend.usage(),
     )
     parser.add_argument(
         "input_URI", type=str, default="", nargs="?", help="URI of the input stream"
@@ -63,6 +125,13 @@ async def main():
     parser.add_argument(
         "output_URI", type=str, default="", nargs="?", help="URI of the output stream"
     )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default=JETSON,
+        choices=BACKENDS,
+        help="Where the network runs: jetson.inference on the device, or ONNX Runtime on the CPU\nof any machine with the exported ONNX model and image folders or video files as inputs",
+    )
     parser.add_argument(
         "--network",
         type=str,
@@ -99,6 +168,218 @@ async def main():
         default=90,
         help="The threshold value 'in percentage' for object detection",
     )
+    parser.add_argument(
+        "--queueBatchSize",
+        type=int,
+        default=4,
+        help="Maximum number of requests pulled from the storage queue per poll",
+    )
+    parser.add_argument(
+        "--visibilityTimeout",
+        type=int,
+        default=30,
+        help="Seconds a received request stays hidden from other consumers, renewed while detection runs",
+    )
+    parser.add_argument(
+        "--minPollInterval",
+        type=float,
+        default=0.2,
+        help="Seconds to wait after the first empty poll of the request queue",
+    )
+    parser.add_argument(
+        "--maxPollInterval",
+        type=float,
+        default=30.0,
+        help="Upper bound in seconds for the backoff between empty polls of the request queue",
+    )
+    parser.add_argument(
+        "--maxOpenRequests",
+        type=int,
+        default=8,
+        help="Maximum number of requests looked for at the same time",
+    )
+    parser.add_argument(
+        "--requestTimeout",
+        type=int,
+        default=120,
+        help="Seconds after which an unanswered request gets a timeout response",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="Run without a display window, only drawing overlays on detection images",
+    )
+    parser.add_argument(
+        "--jpegQuality",
+        type=int,
+        default=90,
+        help="JPEG quality of the uploaded detection images",
+    )
+    parser.add_argument(
+        "--saveDetectionImages",
+        type=str,
+        default="",
+        help="Directory in which a copy of every detection image is kept, one folder per correlation id.\nBy default detection images are only uploaded.",
+    )
+    parser.add_argument(
+        "--topK",
+        type=int,
+        default=5,
+        help="Number of most confident classes of a frame that requests are matched against",
+    )
+    parser.add_argument(
+        "--messageEncoding",
+        type=str,
+        default="json",
+        choices=ENCODINGS,
+        help="Encoding of the responses sent to Azure IoT Hub. Requests are read in any encoding.",
+    )
+    parser.add_argument(
+        "--frameSkip",
+        type=int,
+        default=0,
+        help="Number of camera frames dropped between two classified frames",
+    )
+    parser.add_argument(
+        "--motionThreshold",
+        type=float,
+        default=1.0,
+        help="Percentage of a shrunk frame that has to change for the scene to count as moving.\n0 classifies every frame.",
+    )
+    parser.add_argument(
+        "--minSampleRate",
+        type=float,
+        default=1.0,
+        help="Frames per second classified while the scene is still",
+    )
+    parser.add_argument(
+        "--motionHold",
+        type=float,
+        default=2.0,
+        help="Seconds frames are classified at full rate after the last motion",
+    )
+    parser.add_argument(
+        "--regions",
+        type=str,
+        default="",
+        help="Regions of the frame classified on their own instead of the whole frame, as\nname=left,top,width,height;... in fractions of the frame, e.g. door=0.6,0.2,0.3,0.5",
+    )
+    parser.add_argument(
+        "--tileGrid",
+        type=str,
+        default="",
+        help="Classify the frame in COLUMNSxROWS overlapping tiles instead of as a whole, e.g. 3x2",
+    )
+    parser.add_argument(
+        "--tileOverlap",
+        type=float,
+        default=0.2,
+        help="Fraction of a tile shared with its neighbours",
+    )
+    parser.add_argument(
+        "--tileFullFrame",
+        action="store_true",
+        help="Classify the whole frame as well as the regions or tiles",
+    )
+    parser.add_argument(
+        "--stream",
+        type=str,
+        action="append",
+        help="ID=URI of a video input, repeated for every camera served by the one network.\nThe id tags the detections and blobs of the stream. Replaces input_URI.",
+    )
+    parser.add_argument(
+        "--streamPriority",
+        type=str,
+        action="append",
+        help="ID=PRIORITY of a stream for the priority schedule, 1 when not given",
+    )
+    parser.add_argument(
+        "--streamSchedule",
+        type=str,
+        default=ROUND_ROBIN,
+        choices=SCHEDULES,
+        help="How the next stream to classify is picked: in turn, or in proportion to the priorities",
+    )
+    parser.add_argument(
+        "--maxBatchSize",
+        type=int,
+        default=DEFAULT_MAX_BATCH_SIZE,
+        help="Maximum number of waiting frames classified together in one pass of the network.\nOnly for networks that classify batches, like the ONNX model of the cpu backend;\nimageNet on the jetson backend classifies one frame at a time and ignores it, as well as --batchDelay.",
+    )
+    parser.add_argument(
+        "--batchDelay",
+        type=float,
+        default=DEFAULT_BATCH_DELAY * 1000,
+        help="Milliseconds to wait for more frames once the first frame of a batch is there",
+    )
+    parser.add_argument(
+        "--statsInterval",
+        type=float,
+        default=60.0,
+        help="Seconds between two summaries of the stage latencies, sent as telemetry",
+    )
+    parser.add_argument(
+        "--statsPort",
+        type=int,
+        default=DEFAULT_STATS_PORT,
+        help="Port on which the latest summary is served as JSON, 0 disables it",
+    )
+    parser.add_argument(
+        "--statsHost",
+        type=str,
+        default="127.0.0.1",
+        help="Address the summary is served on",
+    )
+    parser.add_argument(
+        "--uploadBlockSize",
+        type=int,
+        default=4096,
+        help="Size in KiB of the blocks larger detection images and clips are staged in",
+    )
+    parser.add_argument(
+        "--uploadConcurrency",
+        type=int,
+        default=4,
+        help="Maximum number of blocks of one upload staged at the same time",
+    )
+    parser.add_argument(
+        "--spoolDirectory",
+        type=str,
+        default="spool",
+        help="Directory in which detection images and responses that cannot be delivered are kept until the uplink returns.\nAn empty value disables the spool, undelivered requests are then retried from the queue.",
+    )
+    parser.add_argument(
+        "--spoolFsync",
+        type=str,
+        default="interval",
+        choices=FSYNC_POLICIES,
+        help="When spooled records are forced to disk: on every record, once a second, or when the OS decides",
+    )
+    parser.add_argument(
+        "--spoolDrainConcurrency",
+        type=int,
+        default=4,
+        help="Maximum number of spooled records delivered at the same time once the uplink returns",
+    )
+    parser.add_argument(
+        "--engineCache",
+        type=str,
+        default=DEFAULT_ENGINE_CACHE_DIRECTORY,
+        help="Directory in which built engines of --model are kept by model hash, precision, batch size and device,\nso later starts skip building them. An empty value disables the cache.",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default=DEFAULT,
+        choices=PRECISIONS,
+        help="Precision the engine of --model is built at. default leaves it to imageNet, the fastest the GPU supports.\nint8 needs a calibration cache made by calibrate-int8.py, compare the precisions with benchmark-precision.py first.",
+    )
+    parser.add_argument(
+        "--calibrationCache",
+        type=str,
+        default="",
+        help="Calibration cache of --model for int8, by default <model>.calibration.json next to the model",
+    )
 
     try:
         opt = parser.parse_known_args()[0]
@@ -106,14 +387,149 @@ async def main():
         parser.print_help()
         sys.exit(0)
 
-    # load the recognition network
-    net = jetson.inference.imageNet(opt.network, sys.argv)
+    # load the recognition network, from a cached engine when there is one
+    engine_cache = EngineCache(opt.engineCache) if opt.engineCache else None
+    net = backend.load_network(opt.network, engine_cache)
+    print(
+        "Network loaded in %.2f s (%s engine, %.2f s hashing the model)"
+        % (
+            backend.startup.seconds,
+            backend.startup.engine,
+            backend.startup.hash_seconds,
+        )
+    )
 
-    # create the camera and display
-    font = jetson.utils.cudaFont()
-    camera = jetson.utils.gstCamera(opt.width, opt.height, opt.camera)
-    display = jetson.utils.glDisplay()
-    input = jetson.utils.videoSource(opt.input_URI, argv=sys.argv)
+    # Class names of requests are resolved against the network labels once
+    class_index = ClassIndex.from_network(net)
+
+    # The command line gives the initial settings, the device twin can change
+    # them later on
+    config = RuntimeConfig(
+        DetectorSettings(
+            target_classes=(),
+            class_thresholds={},
+            frame_skip=opt.frameSkip,
+            width=opt.width,
+            height=opt.height,
+            top_k=opt.topK,
+            jpeg_quality=opt.jpegQuality,
+            queue_batch_size=opt.queueBatchSize,
+            max_open_requests=opt.maxOpenRequests,
+        ),
+        TWIN_SETTINGS,
+    )
+
+    # create the video source and, unless running headless, the display
+    font = backend.create_font()
+    display = None if opt.headless else backend.create_display()
+
+    # Frames of a still scene are not classified
+    def motion_gate():
+        return MotionGate(
+            opt.motionThreshold / 100,
+            1 / opt.minSampleRate if opt.minSampleRate > 0 else None,
+            opt.motionHold,
+            sampler=backend.create_sampler(),
+        )
+
+    # Every camera is served by the one network loaded above
+    stream_uris = parse_assignments(opt.stream)
+    priorities = parse_assignments(opt.streamPriority, int)
+    if not stream_uris:
+        stream_uris = {None: opt.input_URI}
+    streams = [
+        VideoStream(
+            stream_id,
+            uri,
+            backend.open_source,
+            motion_gate(),
+            (opt.width, opt.height),
+            priorities.get(stream_id, 1),
+        )
+        for stream_id, uri in stream_uris.items()
+    ]
+    for stream in streams:
+        stream.open()
+    scheduler = StreamScheduler(streams, opt.streamSchedule)
+
+    # imageNet classifies one image per call, batches of frames would only
+    # wait for each other
+    batch_size, batch_delay = opt.maxBatchSize, opt.batchDelay / 1000
+    if not classifies_batches(net):
+        batch_size, batch_delay = 1, 0.0
+
+    # The video source reuses its capture buffers while frames still wait to
+    # be classified, overlaid and encoded, so frames are copied into buffers
+    # of a pool that the pipeline gives back once it is done with a frame
+    frame_pool = backend.create_frame_pool(frames_held(batch_size=batch_size))
+
+    # Runs on the capture thread. Video sources are reopened there when the
+    # resolution changes, and skipped or still frames never reach inference.
+    def capture():
+        settings = config.current()
+        stream = scheduler.next_stream()
+        frame = stream.capture(settings.width, settings.height, settings.frame_skip)
+        if frame is None:
+            return None
+        if frame_pool is not None:
+            frame = frame_pool.copy(frame)
+            if frame is None:
+                return None
+        return stream, frame
+
+    def release(stream_frames):
+        if frame_pool is not None:
+            for _, frame in stream_frames:
+                frame_pool.release(frame)
+
+    # Small objects are found in regions or tiles of the frame that are
+    # classified on their own
+    regions = parse_regions(opt.regions)
+    if opt.tileGrid:
+        columns, rows = (int(n) for n in opt.tileGrid.lower().split("x"))
+        regions += grid_regions(columns, rows, opt.tileOverlap)
+    cropper = None
+    if regions:
+        if opt.tileFullFrame:
+            regions.insert(0, FULL_FRAME_REGION)
+        cropper = backend.create_cropper(regions)
+        print("Classifying regions", ", ".join(region.name for region in regions))
+
+    # Latency histograms of every stage, summarized periodically
+    instrumentation = Instrumentation()
+
+    # Runs the frames that are waiting together in batches, a batch holding
+    # every region of its frames
+    engine = InferenceEngine(net, batch_size * max(1, len(regions)))
+
+    # Classifies frames on the inference thread of the pipeline
+    frame_processor = FrameProcessor(
+        net,
+        font,
+        display,
+        opt.classNameForTargetObject,
+        opt.jpegQuality,
+        opt.saveDetectionImages,
+        opt.topK,
+        cropper,
+        instrumentation,
+        engine,
+        backend.encode,
+    )
+
+    # Runs on the inference thread, which is the only reader of these
+    # frame processor settings.
+    def infer(stream_frames, requests):
+        settings = config.current()
+        frame_processor.top_k = settings.top_k
+        frame_processor.jpeg_quality = settings.jpeg_quality
+        frame_processor.target_description = ", ".join(settings.target_classes)
+        return frame_processor.process_batch(
+            [(frame, stream.stream_id) for stream, frame in stream_frames], requests
+        )
+
+    # Decodes the requests and encodes the responses
+    codec = MessageCodec(opt.messageEncoding)
 
     # Fetch the connection string from an environment variable
     conn_str = os.getenv("IOTHUB_DEVICE_CONNECTION_STRING")
@@ -121,103 +537,291 @@ async def main():
     device_client = IoTHubDeviceClient.create_from_connection_string(conn_str)
     await device_client.connect()
 
-    counter = 1
-    still_looking = True
-    # process frames until user exits
-    while still_looking:
-        storage_helper = StorageHelperAsync()
-        queue_message = await storage_helper.queue_receive_message_async()
-
-        print("Waiting for request queue_messages")
-        print(queue_message)
-        if queue_message:
-            queue_message_array = queue_message.content.split("|")
-            request_content = queue_message.content
-            correlation_id = queue_message_array[0]
-            class_for_object_detection = queue_message_array[1]
-            threshold_for_object_detection = int(queue_message_array[2])
-            module_key = queue_message_array[3]
-            if module_key == os.getenv("MODULE_KEY"):
-                has_new_message = True
-            else:
-                has_new_message = False
-                print("Module key does not match")
-	
-            while has_new_message:
-                # capture the image
-                # img, width, height = camera.CaptureRGBA()
-                img = input.Capture()
-
-                # classify the image
-                class_idx, confidence = net.Classify(img)
-
-                # find the object description
-                class_desc = net.GetClassDesc(class_idx)
-
-                # overlay the result on the image
-                font.OverlayText(
-                    img,
-                    img.width,
-                    img.height,
-                    "{:05.2f}% {:s}".format(confidence * 100, class_desc),
-                    15,
-                    50,
-                    font.Green,
-                    font.Gray40,
-                )
+    # Responses and stats summaries share the telemetry of the device, the
+    # message type property tells them apart for message routes and for
+    # consumers that decode responses with MessageCodec
+    async def send_telemetry(body, message_type, content_type=None):
+        message = Message(body, content_encoding="utf-8", content_type=content_type)
+        message.custom_properties[MESSAGE_TYPE_PROPERTY] = message_type
+        await device_client.send_message(message)
+
+    async def send_response(response):
+        await send_telemetry(response, RESPONSE_MESSAGE_TYPE)
+
+    async def send_stats(summary):
+        await send_telemetry(summary, STATS_MESSAGE_TYPE, "application/json")
+
+    # Open the storage clients once and reuse them for every poll and upload
+    # One connection is kept free for polling while blocks are staged
+    storage_helper = StorageHelperAsync(
+        max_connections=max(DEFAULT_MAX_CONNECTIONS, opt.uploadConcurrency + 1),
+        block_size=opt.uploadBlockSize * 1024,
+        upload_concurrency=opt.uploadConcurrency,
+    )
+    await storage_helper.open()
 
-                # render the image
-                display.RenderOnce(img, img.width, img.height)
+    # Detections that cannot be delivered are kept on disk and replayed in
+    # the background once storage and IoT Hub can be reached again.
+    spool = None
+    if opt.spoolDirectory:
+        spool = Spool(opt.spoolDirectory, opt.spoolFsync)
 
-                # update the title bar
-                display.SetTitle(
-                    "{:s} | Network {:.0f} FPS | Looking for {:s}".format(
-                        net.GetNetworkName(),
-                        net.GetNetworkFPS(),
-                        opt.classNameForTargetObject,
-                    )
+    async def spool_async(kind, key, body):
+        await asyncio.get_event_loop().run_in_executor(
+            None, spool.append, kind, key, body
+        )
+
+    async def upload(detection):
+        await storage_helper.block_blob_upload_async(
+            detection.upload_path, detection.image
+        )
+        detection.uploaded = True
+
+    def found_response(detection):
+        response = ResponseMessage(
+            detection.request.correlation_id,
+            STATUS_FOUND,
+            detection.class_name,
+            detection.confidence * 100,
+            None if detection.region is None else detection.region.name,
+            detection.stream_id,
+        )
+        return codec.encode_response(response)
+
+    # Correlation ids of answered requests whose queue message could not be
+    # removed, so their redelivery is dropped instead of answered again
+    unremoved = set()
+
+    # Removes a request that has been answered, or whose response has been
+    # spooled, from the queue. Failing that, e.g. with a lost pop receipt,
+    # must not answer it a second time: the queue message shows up again
+    # once the lease runs out and is dropped then.
+    async def complete(request):
+        try:
+            await request.lease.complete()
+        except Exception as ex:
+            print("Unable to remove answered request from the queue: %s" % ex)
+            unremoved.add(request.correlation_id)
+            await request.lease.stop_renewing()
+
+    # The request is only removed from the queue once both the image and the
+    # response have been delivered or spooled. Only a failed delivery goes to
+    # on_error.
+    async def send(detection):
+        await send_response(found_response(detection))
+        await complete(detection.request)
+
+    async def on_error(detection, ex):
+        request = detection.request
+        if spool is None:
+            print("Unable to post detection, request will be retried: %s" % ex)
+            await request.lease.release()
+            return
+        print("Unable to post detection, spooling it: %s" % ex)
+        if not detection.uploaded:
+            await spool_async(BLOB_RECORD, detection.upload_path, detection.image)
+        await spool_async(
+            TELEMETRY_RECORD,
+            request.correlation_id,
+            found_response(detection).encode("utf-8"),
+        )
+        await complete(request)
+
+    # Answers a request that cannot be satisfied with a status instead of a
+    # confidence.
+    async def respond(request, status):
+        response = codec.encode_response(
+            ResponseMessage(request.correlation_id, status, None, None, None, None)
+        )
+        try:
+            await send_response(response)
+        except Exception as ex:
+            if spool is None:
+                print(
+                    "Unable to send %s response, request will be retried: %s"
+                    % (status, ex)
                 )
+                await request.lease.release()
+                return
+            print("Unable to send %s response, spooling it: %s" % (status, ex))
+            await spool_async(
+                TELEMETRY_RECORD, request.correlation_id, response.encode("utf-8")
+            )
+            await complete(request)
+        else:
+            await complete(request)
+
+    # A request nobody could satisfy in time is answered with a timeout.
+    async def on_timeout(request):
+        print("Request %s timed out" % request.correlation_id)
+        await respond(request, STATUS_TIMEOUT)
+
+    def on_drop(detection):
+        print("Detection dropped, request will be retried")
+        asyncio.ensure_future(detection.request.lease.release())
+
+    request_table = RequestTable(opt.requestTimeout)
+    pipeline = DetectionPipeline(
+        request_table,
+        capture,
+        infer,
+        upload,
+        send,
+        on_error,
+        on_timeout,
+        on_drop,
+        release,
+        delivery_queue_size=opt.maxOpenRequests,
+        instrumentation=instrumentation,
+        batch_size=batch_size,
+        batch_delay=batch_delay,
+    )
+    pipeline.start()
+
+    # Cold and warm starts are told apart in the summaries
+    startup = {
+        "engine": backend.startup.engine,
+        "precision": opt.precision,
+        "network_load_s": round(backend.startup.seconds, 2),
+        "model_hash_s": round(backend.startup.hash_seconds, 2),
+        "ready_s": round(time.monotonic() - process_started, 2),
+    }
+    print("Ready %.2f s after start" % startup["ready_s"])
+
+    # Applies desired property patches of the device twin as they arrive
+    twin_listener = asyncio.ensure_future(config.listen(device_client))
+
+    drainer = None
+    if spool is not None:
+
+        async def replay_blob(record):
+            await storage_helper.block_blob_upload_async(record.key, record.body)
+
+        async def replay_telemetry(record):
+            await send_response(record.body.decode("utf-8"))
+
+        drainer = SpoolDrainer(
+            spool,
+            {BLOB_RECORD: replay_blob, TELEMETRY_RECORD: replay_telemetry},
+            opt.spoolDrainConcurrency,
+        )
+        drainer.start()
+
+    # Backs off polling while the request queue stays empty
+    idle_scheduler = IdleScheduler(opt.minPollInterval, opt.maxPollInterval)
+
+    # One summary of the spans and counters per interval instead of printing
+    # them for every poll and frame
+    sources = {
+        "pipeline": pipeline.stats,
+        "polling": idle_scheduler.metrics,
+        "streams": scheduler.stats,
+        "inference": engine.stats,
+        "startup": lambda: startup,
+    }
+    if drainer is not None:
+        sources["spool"] = drainer.stats
+    reporter = SummaryReporter(
+        instrumentation, send_stats, sources, opt.statsInterval
+    )
+    reporter.start()
+    stats_server = None
+    if opt.statsPort:
+        stats_server = StatsServer(reporter, opt.statsHost, opt.statsPort)
+        await stats_server.start()
 
-                # print out performance info
-                net.PrintProfilerTimes()
-                if (
-                    class_desc == class_for_object_detection
-                    and (confidence * 100) >= threshold_for_object_detection
-                ):
-                    message = request_content + "|" + str(confidence * 100)
-                    font.OverlayText(
-                        img,
-                        img.width,
-                        img.height,
-                        "Found {:s} at {:05.2f}% confidence".format(
-                            class_desc, confidence * 100
+    still_looking = True
+    # process frames until user exits
+    while still_looking:
+        settings = config.current()
+        capacity = settings.max_open_requests - len(request_table)
+        if capacity <= 0:
+            # wait for an open request to be answered or to time out
+            await asyncio.sleep(opt.minPollInterval)
+            continue
+
+        with instrumentation.span("poll"):
+            leases = await storage_helper.queue_receive_leases_async(
+                min(settings.queue_batch_size, capacity), opt.visibilityTimeout
+            )
+        await idle_scheduler.poll_completed(len(leases))
+
+        for lease in leases:
+            queue_message = lease.message
+            try:
+                message = codec.decode_request(queue_message.content)
+            except MessageError as ex:
+                # A malformed request can never be answered, drop it.
+                print("Malformed request: %s" % ex)
+                await lease.complete()
+                continue
+            if message.module_key != os.getenv("MODULE_KEY"):
+                print("Module key does not match")
+                await lease.complete()
+                continue
+            if spool is not None and message.correlation_id in spool:
+                # already answered, the response waits in the spool
+                await lease.complete()
+                continue
+            if message.correlation_id in unremoved:
+                # already answered, only removing it from the queue failed
+                try:
+                    await lease.complete()
+                except Exception as ex:
+                    print("Unable to remove answered request from the queue: %s" % ex)
+                else:
+                    unremoved.discard(message.correlation_id)
+                continue
+
+            request = DetectionRequest(
+                lease,
+                message.correlation_id,
+                [
+                    RequestTarget(
+                        target.class_name,
+                        class_index.resolve(target.class_name),
+                        max(
+                            target.threshold,
+                            settings.class_thresholds.get(target.class_name, 0),
                         ),
-                        775,
-                        50,
-                        font.Blue,
-                        font.Gray40,
                     )
-                    display.RenderOnce(img, img.width, img.height)
-                    savedFile = "imageWithDetection.jpg"
-                    jetson.utils.saveImageRGBA(savedFile, img, img.width, img.height)
-
-                    # Create the BlobServiceClient object which will be used to create a container client
-                    blob_service_client = BlobServiceClient.from_connection_string(
-                        os.getenv("STORAGE_CONNECTION_STRING")
-                    )
-                    container_name = "iot-edge-object-classification-responses"
-
-                    # Create a blob client using the local file name as the name for the blob
-                    folderMark = "/"
-                    upload_path = folderMark.join([correlation_id, savedFile])
-
-                    # blob_helper = StorageHelperAsync()
-                    await storage_helper.block_blob_upload_async(upload_path, savedFile)
-
-                    await device_client.send_message(message)
-                    still_looking = True
-                    has_new_message = False
-
+                    for target in message.targets
+                ],
+            )
+
+            # A class the network cannot classify would only ever time out.
+            unknown = [t.class_name for t in request.targets if t.class_idx is None]
+            if unknown:
+                print("Unknown class %s" % ", ".join(unknown))
+                await respond(request, STATUS_UNKNOWN_CLASS)
+                continue
+            if settings.target_classes and any(
+                t.class_name not in settings.target_classes for t in request.targets
+            ):
+                print("Class not allowed by the device twin")
+                await respond(request, STATUS_CLASS_NOT_ALLOWED)
+                continue
+
+            # Every open request is checked against each classified frame,
+            # a new one starting with the next frame whatever the scene does.
+            open_request = pipeline.submit(request)
+            if open_request is request:
+                scheduler.trigger()
+            else:
+                # A redelivery of a request that is still open, keep looking
+                # for it under the lease that is currently valid.
+                await open_request.lease.stop_renewing()
+                open_request.lease = lease
+
+    twin_listener.cancel()
+    await reporter.stop()
+    if stats_server is not None:
+        await stats_server.stop()
+    await pipeline.stop()
+    if drainer is not None:
+        await drainer.stop()
+        spool.close()
+    await storage_helper.close()
     await device_client.disconnect()
 
 
@@ -0,0 +1,93 @@
+from calibration import FP16, FP32, INT8
+
+# Scratch memory TensorRT may use while it picks layer implementations.
+DEFAULT_WORKSPACE_SIZE = 1 << 28
+
+
+# Builds a serialized TensorRT engine of an ONNX model at the given precision,
+# the same kind of engine jetson.inference.imageNet builds itself but with the
+# precision chosen instead of the fastest one the GPU supports.
+# At INT8 the ranges of a CalibrationCache are set as the dynamic ranges of the
+# network tensors, so no calibration runs on the device. Tensors without a
+# range, and layers that have no INT8 implementation, run at FP16.
+# The Jetson Nano has no fast INT8 (TensorRT would only emulate it), building
+# at INT8 there raises ValueError.
+def build_engine(
+    model_path,
+    precision,
+    batch_size=1,
+    calibration=None,
+    workspace_size=DEFAULT_WORKSPACE_SIZE,
+):
+    if precision not in (FP32, FP16, INT8):
+        raise ValueError("TensorRT engines are built at fp32, fp16 or int8")
+    if precision == INT8 and calibration is None:
+        raise ValueError("INT8 needs a calibration cache, see calibrate-int8.py")
+
+    # only on the device
+    import tensorrt as trt
+
+    logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(logger)
+    network = builder.create_network(
+        1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH)
+    )
+    parser = trt.OnnxParser(network, logger)
+    with open(model_path, "rb") as model:
+        if not parser.parse(model.read()):
+            errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+            raise ValueError("Unable to parse %s: %s" % (model_path, "; ".join(errors)))
+
+    config = builder.create_builder_config()
+    if hasattr(config, "set_memory_pool_limit"):
+        config.set_memory_pool_limit(trt.MemoryPoolType.WORKSPACE, workspace_size)
+    else:
+        # TensorRT before 8.4
+        config.max_workspace_size = workspace_size
+
+    if precision in (FP16, INT8):
+        if not builder.platform_has_fast_fp16:
+            raise ValueError("This GPU has no fast FP16, use fp32")
+        config.set_flag(trt.BuilderFlag.FP16)
+    if precision == INT8:
+        if not builder.platform_has_fast_int8:
+            raise ValueError("This GPU has no fast INT8, use fp16")
+        config.set_flag(trt.BuilderFlag.INT8)
+        _set_dynamic_ranges(network, calibration.ranges)
+
+    # a model exported with a dynamic batch dimension gets a profile up to
+    # batch_size, the exported classification models have a batch of 1
+    model_input = network.get_input(0)
+    if model_input.shape[0] == -1:
+        profile = builder.create_optimization_profile()
+        shape = tuple(model_input.shape)[1:]
+        profile.set_shape(
+            model_input.name,
+            (1,) + shape,
+            (batch_size,) + shape,
+            (batch_size,) + shape,
+        )
+        config.add_optimization_profile(profile)
+
+    if hasattr(builder, "build_serialized_network"):
+        engine = builder.build_serialized_network(network, config)
+    else:
+        # TensorRT 7
+        built = builder.build_engine(network, config)
+        engine = built.serialize() if built is not None else None
+    if engine is None:
+        raise ValueError("TensorRT could not build %s at %s" % (model_path, precision))
+    return bytes(engine)
+
+
+def _set_dynamic_ranges(network, ranges):
+    tensors = [network.get_input(i) for i in range(network.num_inputs)]
+    for index in range(network.num_layers):
+        layer = network.get_layer(index)
+        tensors += [layer.get_output(i) for i in range(layer.num_outputs)]
+    for tensor in tensors:
+        bounds = ranges.get(tensor.name)
+        if bounds is not None:
+            # TensorRT quantizes symmetrically around zero
+            limit = max(abs(bounds[0]), abs(bounds[1]))
+            tensor.set_dynamic_range(-limit, limit)
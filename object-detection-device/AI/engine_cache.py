@@ -0,0 +1,142 @@
+import collections
+import hashlib
+import json
+import mmap
+import os
+import platform
+import re
+import shutil
+import time
+
+ENGINE_EXTENSION = ".engine"
+MANIFEST_EXTENSION = ".json"
+
+DEFAULT_ENGINE_CACHE_DIRECTORY = "engine_cache"
+
+# Bytes read at a time while a model is hashed.
+HASH_CHUNK_SIZE = 1 << 20
+
+# What an engine was built from. An engine is only valid for the exact model
+# file, the precision and maximum batch size it was built for and the device
+# and runtime version that built it.
+EngineKey = collections.namedtuple(
+    "EngineKey", "model_sha256 precision batch_size device"
+)
+
+# How the network got loaded: warm from a cached engine, cold when the engine
+# had to be built (and was then cached), or uncached. seconds is the load time,
+# hash_seconds the part of it spent hashing the model.
+StartupReport = collections.namedtuple("StartupReport", "engine seconds hash_seconds")
+
+WARM = "warm"
+COLD = "cold"
+UNCACHED = "uncached"
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Names the hardware, e.g. "NVIDIA Jetson Nano Developer Kit", falling back to
+# the CPU architecture off a Jetson.
+def device_name():
+    try:
+        with open("/proc/device-tree/model") as model:
+            return model.read().strip("\0\n ")
+    except OSError:
+        return platform.machine()
+
+
+# Built engines on disk, next to a manifest with the key and the SHA-256 of
+# the engine. A cached engine is checked against its manifest through a
+# memory map before it is used, so a truncated or corrupted file is rebuilt
+# instead of crashing the runtime. The runtimes only take the path of an
+# engine (imageNet reads the file itself), so the cache hands out paths; the
+# check leaves the file in the page cache for the read that follows.
+#
+#   key = cache.key("resnet18.onnx", "fp16", 1, device)
+#   path = cache.lookup(key)  # None on a miss
+#   ... build the engine ...
+#   cache.store(key, built_engine_path)
+class EngineCache:
+    def __init__(self, directory=DEFAULT_ENGINE_CACHE_DIRECTORY):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, model_path, precision, batch_size, device):
+        return EngineKey(file_sha256(model_path), precision.lower(), batch_size, device)
+
+    def path(self, key):
+        device = re.sub(r"[^A-Za-z0-9.]+", "_", key.device).strip("_")
+        name = "%s-%s-b%d-%s%s" % (
+            key.model_sha256[:16],
+            key.precision,
+            key.batch_size,
+            device,
+            ENGINE_EXTENSION,
+        )
+        return os.path.join(self.directory, name)
+
+    # Returns the path of the verified engine for the key, or None. An entry
+    # that does not verify is removed.
+    def lookup(self, key):
+        path = self.path(key)
+        try:
+            with open(path + MANIFEST_EXTENSION) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("key") != list(key) or not self._verify(path, manifest):
+            print("Cached engine %s does not verify, rebuilding it" % path)
+            self.remove(key)
+            return None
+        return path
+
+    # Moves a freshly built engine into the cache and returns its path. The
+    # manifest is written last, so an engine that was not completely stored is
+    # never used.
+    def store(self, key, engine_path):
+        path = self.path(key)
+        temporary = path + ".tmp"
+        shutil.move(engine_path, temporary)
+        _fsync(temporary)
+        os.replace(temporary, path)
+        manifest = {
+            "key": list(key),
+            "sha256": file_sha256(path),
+            "size": os.path.getsize(path),
+            "created": time.time(),
+        }
+        with open(temporary, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        _fsync(temporary)
+        os.replace(temporary, path + MANIFEST_EXTENSION)
+        return path
+
+    def remove(self, key):
+        path = self.path(key)
+        for stale in (path + MANIFEST_EXTENSION, path):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+
+    def _verify(self, path, manifest):
+        try:
+            with open(path, "rb") as engine:
+                size = os.fstat(engine.fileno()).st_size
+                if not size or size != manifest.get("size"):
+                    return False
+                with mmap.mmap(engine.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return hashlib.sha256(mapped).hexdigest() == manifest.get("sha256")
+        except OSError:
+            return False
+
+
+def _fsync(path):
+    with open(path, "rb") as stored:
+        os.fsync(stored.fileno())
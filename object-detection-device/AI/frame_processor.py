@@ -0,0 +1,235 @@
+import os
+
+from image_encoder import DEFAULT_JPEG_QUALITY, encode_jpeg
+from inference_engine import InferenceEngine
+from instrumentation import Instrumentation
+
+DETECTION_IMAGE_NAME = "imageWithDetection.jpg"
+
+# Number of most confident classes a request can be matched against.
+DEFAULT_TOP_K = 5
+
+
+# A frame that satisfied a request, waiting to be uploaded and reported.
+# class_name is the requested class that was found and image holds the JPEG
+# encoded detection image. region is the region of the frame the class was
+# found in when the frame is classified in regions, stream_id the id of the
+# camera when the detector serves several.
+class Detection:
+    def __init__(
+        self,
+        request,
+        class_name,
+        confidence,
+        image,
+        upload_path,
+        region=None,
+        stream_id=None,
+    ):
+        self.request = request
+        self.class_name = class_name
+        self.confidence = confidence
+        self.image = image
+        self.upload_path = upload_path
+        self.region = region
+        self.stream_id = stream_id
+        self.uploaded = False
+
+
+# Classifies frames for the open requests and prepares the detection image.
+# Requests are matched against the top_k most confident classes of a frame,
+# so a requested class that ranks below the top-1 class still fires once its
+# confidence clears the request threshold.
+# Without a display (headless mode) nothing is drawn or rendered for frames
+# that do not match; the overlays are only drawn when a detection image is
+# actually going to be saved and uploaded.
+# With a cropper every region it crops is classified on its own, so a small
+# object is not lost when the whole frame is scaled down to the network input.
+# A class then has the highest confidence it reached in any region.
+# The frames of a batch and all their regions are classified in one call of the
+# inference engine. The frames are then matched in order, so a request found in
+# one frame is not reported again for a later frame of the same batch.
+# The classify, overlay, render and encode steps are timed as spans of the
+# instrumentation instead of printing the profiler times of every frame.
+class FrameProcessor:
+    # When save_directory is set every detection image is also written to
+    # save_directory/<correlation id>/imageWithDetection.jpg.
+    def __init__(
+        self,
+        net,
+        font,
+        display=None,
+        target_description="",
+        jpeg_quality=DEFAULT_JPEG_QUALITY,
+        save_directory=None,
+        top_k=DEFAULT_TOP_K,
+        cropper=None,
+        instrumentation=None,
+        engine=None,
+        encode=encode_jpeg,
+    ):
+        self.net = net
+        self.font = font
+        self.display = display
+        self.target_description = target_description
+        self.jpeg_quality = jpeg_quality
+        self.save_directory = save_directory
+        self.top_k = top_k
+        self.cropper = cropper
+        self.instrumentation = instrumentation or Instrumentation()
+        self.engine = engine or InferenceEngine(net)
+        self.encode = encode
+
+    def _overlay_classification(self, img, class_desc, confidence):
+        self.font.OverlayText(
+            img,
+            img.width,
+            img.height,
+            "{:05.2f}% {:s}".format(confidence * 100, class_desc),
+            15,
+            50,
+            self.font.Green,
+            self.font.Gray40,
+        )
+
+    # Returns a detection for every request the frame satisfies. The requests
+    # share one encoded detection image. Requests carry the class indices their
+    # class names were resolved to when they arrived.
+    # The image is stored under <correlation id>/imageWithDetection.jpg, where
+    # the web app looks for it, also for a frame from a stream; the stream id
+    # travels in the response.
+    def process(self, img, requests, stream_id=None):
+        return self.process_batch([(img, stream_id)], requests)
+
+    # Same as process() for a list of (frame, stream id).
+    def process_batch(self, frames, requests):
+        with self.instrumentation.span("classify"):
+            classifications = self._classify([img for img, _ in frames])
+        detections = []
+        for (img, stream_id), (confidences, regions) in zip(frames, classifications):
+            frame_detections = self._process_frame(
+                img, stream_id, confidences, regions, requests
+            )
+            if frame_detections:
+                found = set(id(detection.request) for detection in frame_detections)
+                requests = [r for r in requests if id(r) not in found]
+                detections += frame_detections
+        return detections
+
+    def _process_frame(self, img, stream_id, confidences, regions, requests):
+        class_idx, confidence = max(confidences.items(), key=lambda item: item[1])
+
+        # find the object description
+        class_desc = self.net.GetClassDesc(class_idx)
+
+        if self.display is not None:
+            # overlay the result on the image
+            with self.instrumentation.span("overlay"):
+                self._overlay_classification(img, class_desc, confidence)
+
+            # render the image
+            with self.instrumentation.span("render"):
+                self.display.RenderOnce(img, img.width, img.height)
+
+            # update the title bar
+            self.display.SetTitle(
+                "{:s} | Network {:.0f} FPS | Looking for {:s}".format(
+                    self.net.GetNetworkName(),
+                    self.net.GetNetworkFPS(),
+                    self.target_description,
+                )
+            )
+
+        matches = []
+        for request in requests:
+            match = request.match(confidences)
+            if match is not None:
+                target, class_confidence = match
+                matches.append(
+                    (
+                        request,
+                        target.class_name,
+                        class_confidence,
+                        regions.get(target.class_idx),
+                    )
+                )
+        if not matches:
+            return []
+
+        # The detection image names the class of the first satisfied request.
+        _, class_desc, confidence, region = matches[0]
+
+        with self.instrumentation.span("overlay"):
+            # The uploaded image carries the same overlays in headless mode.
+            if self.display is None:
+                self._overlay_classification(img, class_desc, confidence)
+
+            self.font.OverlayText(
+                img,
+                img.width,
+                img.height,
+                "Found {:s} at {:05.2f}% confidence{:s}".format(
+                    class_desc,
+                    confidence * 100,
+                    "" if region is None else " in " + region.name,
+                ),
+                775,
+                50,
+                self.font.Blue,
+                self.font.Gray40,
+            )
+        if self.display is not None:
+            with self.instrumentation.span("render"):
+                self.display.RenderOnce(img, img.width, img.height)
+
+        # The image is uploaded straight from memory, the disk copy is optional.
+        with self.instrumentation.span("encode"):
+            image = self.encode(img, self.jpeg_quality)
+
+        detections = []
+        for request, class_name, class_confidence, class_region in matches:
+            if self.save_directory:
+                self._save(request.correlation_id, image)
+
+            folderMark = "/"
+            upload_path = folderMark.join([request.correlation_id, DETECTION_IMAGE_NAME])
+            detections.append(
+                Detection(
+                    request,
+                    class_name,
+                    class_confidence,
+                    image,
+                    upload_path,
+                    class_region,
+                    stream_id,
+                )
+            )
+        return detections
+
+    # Returns for every image the confidence of every class among the top_k
+    # classes of the image or of any of its regions, and the region each
+    # confidence comes from.
+    def _classify(self, images):
+        tiles = []
+        for slot, img in enumerate(images):
+            if self.cropper is None:
+                crops = [(None, img)]
+            else:
+                crops = self.cropper.crop(img, slot)
+            tiles += [(slot, region, tile) for region, tile in crops]
+        predictions = self.engine.classify([tile for _, _, tile in tiles], self.top_k)
+        classifications = [({}, {}) for _ in images]
+        for (slot, region, _), tile_predictions in zip(tiles, predictions):
+            confidences, regions = classifications[slot]
+            # predictions are sorted by confidence
+            for class_idx, confidence in tile_predictions:
+                if confidence > confidences.get(class_idx, -1.0):
+                    confidences[class_idx] = confidence
+                    regions[class_idx] = region
+        return classifications
+
+    def _save(self, correlation_id, image):
+        directory = os.path.join(self.save_directory, correlation_id)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, DETECTION_IMAGE_NAME), "wb") as saved:
+            saved.write(image)
@@ -0,0 +1,58 @@
+import asyncio
+import random
+
+DEFAULT_MIN_POLL_INTERVAL = 0.2
+DEFAULT_MAX_POLL_INTERVAL = 30.0
+DEFAULT_BACKOFF_MULTIPLIER = 2.0
+DEFAULT_JITTER = 0.2
+
+
+# Paces the request queue polling loop.
+# Every empty poll doubles the wait before the next one, up to max_interval,
+# and a poll that returns requests resets it to the fast min_interval. A random
+# jitter of +/- jitter (as a fraction of the interval) keeps a fleet of devices
+# that went idle together from polling the storage account in lockstep.
+class IdleScheduler:
+    def __init__(
+        self,
+        min_interval=DEFAULT_MIN_POLL_INTERVAL,
+        max_interval=DEFAULT_MAX_POLL_INTERVAL,
+        multiplier=DEFAULT_BACKOFF_MULTIPLIER,
+        jitter=DEFAULT_JITTER,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.interval = 0.0
+        self.empty_polls = 0
+        self.useful_polls = 0
+        self.messages_received = 0
+        self.idle_seconds = 0.0
+
+    # Records the outcome of one poll and sleeps if it came back empty.
+    async def poll_completed(self, message_count):
+        if message_count:
+            self.useful_polls += 1
+            self.messages_received += message_count
+            self.interval = 0.0
+            return
+
+        self.empty_polls += 1
+        if self.interval:
+            self.interval = min(self.interval * self.multiplier, self.max_interval)
+        else:
+            self.interval = self.min_interval
+
+        delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.idle_seconds += delay
+        await asyncio.sleep(delay)
+
+    def metrics(self):
+        return {
+            "empty_polls": self.empty_polls,
+            "useful_polls": self.useful_polls,
+            "messages_received": self.messages_received,
+            "idle_seconds": round(self.idle_seconds, 3),
+            "poll_interval": self.interval,
+        }
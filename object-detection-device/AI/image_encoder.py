@@ -0,0 +1,34 @@
+import io
+
+import numpy
+from PIL import Image
+
+DEFAULT_JPEG_QUALITY = 90
+
+
+# Encodes a CUDA image to JPEG in memory.
+# cudaToNumpy() maps the image without copying it, so 8-bit RGB frames go
+# straight from the mapped CUDA buffer into the encoder. RGBA and floating
+# point frames need one conversion pass first.
+def encode_jpeg(img, quality=DEFAULT_JPEG_QUALITY):
+    # only imported where frames live in CUDA memory
+    import jetson.utils
+
+    # make sure the overlays drawn on the GPU are visible to the CPU
+    jetson.utils.cudaDeviceSynchronize()
+    return encode_array(jetson.utils.cudaToNumpy(img), quality)
+
+
+# Encodes an HWC array of RGB or RGBA pixels to JPEG in memory.
+def encode_array(array, quality=DEFAULT_JPEG_QUALITY):
+    if array.dtype != numpy.uint8:
+        array = numpy.clip(array, 0, 255).astype(numpy.uint8)
+
+    if array.shape[2] == 4:
+        image = Image.fromarray(array, "RGBA").convert("RGB")
+    else:
+        image = Image.fromarray(array, "RGB")
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
@@ -0,0 +1,520 @@
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy
+from PIL import Image, ImageDraw, ImageFont
+
+from calibration import (
+    DEFAULT,
+    FP16,
+    FP32,
+    INT8,
+    CalibrationCache,
+    default_calibration_cache,
+    load_image,
+)
+from engine_cache import (
+    COLD,
+    ENGINE_EXTENSION,
+    UNCACHED,
+    WARM,
+    StartupReport,
+    device_name,
+)
+from image_encoder import DEFAULT_JPEG_QUALITY, encode_array, encode_jpeg
+from motion_gate import DEFAULT_SAMPLE_HEIGHT, DEFAULT_SAMPLE_WIDTH, FrameSampler
+from roi_tiler import FULL_FRAME_REGION, RegionCropper
+
+JETSON = "jetson"
+CPU = "cpu"
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+# Everything the detector needs from jetson.inference and jetson.utils: the
+# network, video sources, the font, the display, region crops, motion samples
+# and JPEG encoding. Frames only travel between the parts of one backend.
+# Frames and crops live in CUDA memory and the network is a TensorRT engine
+# built by jetson.inference.imageNet from the command line (--network, or
+# --model, --labels, --input_blob and --output_blob).
+# load_network() reports how the network got loaded in startup.
+class JetsonBackend:
+    name = JETSON
+
+    def __init__(self, argv):
+        # only imported on the device
+        import jetson.inference
+        import jetson.utils
+
+        self.inference = jetson.inference
+        self.utils = jetson.utils
+        self.argv = argv
+        self.startup = None
+
+    def usage(self):
+        return self.inference.imageNet.Usage()
+
+    # With an engine cache the TensorRT engine of a custom --model is looked
+    # up by the hash of the model and handed to imageNet as the model, which
+    # deserializes a .engine file instead of parsing and optimizing the ONNX
+    # model. On a miss imageNet builds the engine from a link to the model in
+    # a build folder of the cache, from where the engine it saves is moved
+    # into the cache. Files next to the model are left alone.
+    # imageNet always builds at the fastest precision of the GPU. With
+    # --precision fp32, fp16 or int8 the engine is built by engine_builder
+    # instead, at int8 with the ranges of the --calibrationCache.
+    def load_network(self, network, engine_cache=None):
+        started = time.monotonic()
+        model = _option(self.argv, "model")
+        precision = _option(self.argv, "precision", DEFAULT)
+        if not model or model.endswith(ENGINE_EXTENSION):
+            if precision != DEFAULT:
+                raise ValueError("--precision needs the ONNX model as --model")
+            engine_cache = None
+        if engine_cache is None and precision == DEFAULT:
+            net = self.inference.imageNet(network, self.argv)
+            self.startup = StartupReport(UNCACHED, time.monotonic() - started, 0.0)
+            return net
+
+        calibration = None
+        engine_precision = precision
+        if precision == INT8:
+            calibration = load_calibration(self.argv, model)
+            # engines built from different calibrations must not be mixed up
+            engine_precision = "%s-%s" % (INT8, calibration.digest())
+        key, cached, hash_seconds = None, None, 0.0
+        if engine_cache is not None:
+            key = engine_cache.key(
+                model,
+                engine_precision,
+                int(_option(self.argv, "batch_size", 1)),
+                "%s TensorRT %s" % (device_name(), _tensorrt_version()),
+            )
+            hash_seconds = time.monotonic() - started
+            cached = engine_cache.lookup(key)
+
+        if cached is not None:
+            engine = WARM
+            argv = _with_option(self.argv, "model", cached)
+            net = self.inference.imageNet(network, argv)
+        elif precision != DEFAULT:
+            engine = COLD if engine_cache is not None else UNCACHED
+            built = self._build_engine(model, precision, calibration, key, engine_cache)
+            argv = _with_option(self.argv, "model", built)
+            net = self.inference.imageNet(network, argv)
+        else:
+            # imageNet saves the engine next to the model it is given and
+            # reuses an engine found there by its file name alone, also after
+            # the model was retrained. In a fresh build folder there is none.
+            build = tempfile.mkdtemp(dir=engine_cache.directory)
+            try:
+                link = os.path.join(build, os.path.basename(model))
+                os.symlink(os.path.abspath(model), link)
+                argv = _with_option(self.argv, "model", link)
+                net = self.inference.imageNet(network, argv)
+                built = glob.glob(glob.escape(link) + ".*" + ENGINE_EXTENSION)
+                engine = UNCACHED
+                if built:
+                    engine = COLD
+                    engine_cache.store(key, built[0])
+            finally:
+                shutil.rmtree(build)
+        self.startup = StartupReport(engine, time.monotonic() - started, hash_seconds)
+        return net
+
+    # Builds the engine into the cache, or next to the model without a cache,
+    # and returns its path.
+    def _build_engine(self, model, precision, calibration, key, engine_cache):
+        # only on the device, it needs TensorRT
+        from engine_builder import build_engine
+
+        engine = build_engine(
+            model,
+            precision,
+            int(_option(self.argv, "batch_size", 1)),
+            calibration,
+        )
+        path = "%s.%s%s" % (model, precision, ENGINE_EXTENSION)
+        if engine_cache is not None:
+            path = engine_cache.path(key) + ".build"
+        with open(path, "wb") as engine_file:
+            engine_file.write(engine)
+        if engine_cache is None:
+            return path
+        return engine_cache.store(key, path)
+
+    # Opens the source with the resolution of the command line when resolution
+    # is None.
+    def open_source(self, uri, resolution=None):
+        argv = self.argv
+        if resolution is not None:
+            argv = [arg for arg in self.argv if not arg.startswith("--input-")]
+            argv += [
+                "--input-width=%d" % resolution[0],
+                "--input-height=%d" % resolution[1],
+            ]
+        return self.utils.videoSource(uri, argv=argv)
+
+    def load_image(self, path):
+        return self.utils.loadImage(path)
+
+    def create_font(self):
+        return self.utils.cudaFont()
+
+    def create_display(self):
+        return self.utils.glDisplay()
+
+    def create_cropper(self, regions):
+        return RegionCropper(regions)
+
+    def create_sampler(self):
+        return FrameSampler()
+
+    # Captured frames are views into the ring buffer of the video source,
+    # which it overwrites while the pipeline still holds them. The pool copies
+    # them into buffers of its own, which are released when the pipeline is
+    # done with them.
+    def create_frame_pool(self, size):
+        return CudaFramePool(self.utils, size)
+
+    def encode(self, img, quality=DEFAULT_JPEG_QUALITY):
+        return encode_jpeg(img, quality)
+
+
+# Copies frames into size CUDA buffers of its own. A buffer is only reused
+# after it was given back with release(), once its frame has been classified,
+# overlaid and encoded or dropped, so a frame stays intact for as long as the
+# pipeline holds it. When every buffer is in use copy() waits for one. A
+# buffer is allocated again when the size or format of the frames changes.
+class CudaFramePool:
+    def __init__(self, utils, size, timeout=1.0):
+        self.utils = utils
+        self.size = size
+        self.timeout = timeout
+        # buffers that are not in use, None until a buffer is allocated
+        self._free = [None] * size
+        self._available = threading.Condition()
+
+    # Returns None when no buffer was given back within the timeout, so the
+    # capture thread can still stop.
+    def copy(self, img):
+        with self._available:
+            if not self._available.wait_for(lambda: self._free, self.timeout):
+                return None
+            buffer = self._free.pop()
+        if buffer is None or (buffer.width, buffer.height, buffer.format) != (
+            img.width,
+            img.height,
+            img.format,
+        ):
+            buffer = self.utils.cudaAllocMapped(
+                width=img.width, height=img.height, format=img.format
+            )
+        self.utils.cudaMemcpy(buffer, img)
+        return buffer
+
+    def release(self, buffer):
+        with self._available:
+            self._free.append(buffer)
+            self._available.notify()
+
+
+# Runs the detector on a plain Linux machine for development and load tests:
+# the network is the exported ONNX model (--model and --labels as for
+# imageNet) run by ONNX Runtime, video sources are image folders or video
+# files, frames are numpy arrays and there is no display.
+class CpuBackend:
+    name = CPU
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.startup = None
+
+    def usage(self):
+        return (
+            "The cpu backend runs the ONNX model given by --model, --labels,\n"
+            "--input_blob and --output_blob with ONNX Runtime. Inputs are image\n"
+            "files, folders of images or video files (with OpenCV installed)."
+        )
+
+    # --precision int8 runs the INT8 model quantized by calibrate-int8.py,
+    # named in the --calibrationCache. ONNX Runtime has no fast fp16 on the
+    # CPU.
+    def load_network(self, network, engine_cache=None):
+        # imported here so the Jetson does not need ONNX Runtime
+        from onnx_classifier import OnnxClassifier
+
+        model = _option(self.argv, "model")
+        labels = _option(self.argv, "labels")
+        precision = _option(self.argv, "precision", DEFAULT)
+        if not model or not labels:
+            raise ValueError(
+                "The cpu backend cannot load the built-in network %s, it needs "
+                "--model and --labels of an ONNX model" % network
+            )
+        if precision == FP16:
+            raise ValueError("fp16 needs the jetson backend, use fp32 or int8")
+        if precision == INT8:
+            calibration = load_calibration(self.argv, model)
+            if not calibration.cpu_model:
+                raise ValueError(
+                    "The calibration cache names no INT8 model, run "
+                    "calibrate-int8.py again"
+                )
+            model = calibration.cpu_model
+        net = OnnxClassifier(
+            model,
+            labels,
+            _option(self.argv, "input_blob", "input_0"),
+            _option(self.argv, "output_blob", "output_0"),
+            engine_cache=engine_cache,
+            precision=FP32 if precision == DEFAULT else precision,
+        )
+        self.startup = net.startup
+        return net
+
+    def open_source(self, uri, resolution=None):
+        if resolution is None:
+            resolution = _input_resolution(self.argv)
+        return FileSource(uri, resolution)
+
+    def load_image(self, path):
+        return HostImage(load_image(path))
+
+    def create_font(self):
+        return HostFont()
+
+    # Nothing is shown on the CPU, the detector runs headless.
+    def create_display(self):
+        return None
+
+    def create_cropper(self, regions):
+        return HostRegionCropper(regions)
+
+    def create_sampler(self):
+        return HostFrameSampler()
+
+    # FileSource already returns a copy of every frame.
+    def create_frame_pool(self, size):
+        return None
+
+    def encode(self, img, quality=DEFAULT_JPEG_QUALITY):
+        return encode_array(img.array, quality)
+
+
+BACKENDS = {JETSON: JetsonBackend, CPU: CpuBackend}
+
+
+def create_backend(name, argv):
+    return BACKENDS[name](argv)
+
+
+# Reads an option of jetson-inference, like --model, from the command line.
+def _option(argv, name, default=None):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--" + name, default=default)
+    return getattr(parser.parse_known_args(argv[1:])[0], name)
+
+
+# Returns the command line with the option set to value instead.
+def _with_option(argv, name, value):
+    flag = "--" + name
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == flag:
+            skip = True
+        elif not arg.startswith(flag + "="):
+            result.append(arg)
+    return result + ["%s=%s" % (flag, value)]
+
+
+# Loads the --calibrationCache of the model, by default the one next to it,
+# and checks that it was made for this model.
+def load_calibration(argv, model):
+    path = _option(argv, "calibrationCache") or default_calibration_cache(model)
+    if not os.path.exists(path):
+        raise ValueError(
+            "int8 needs the calibration cache %s, make it with calibrate-int8.py"
+            % path
+        )
+    calibration = CalibrationCache.load(path)
+    calibration.check_model(model)
+    return calibration
+
+
+# Engines only load with the TensorRT version that built them.
+def _tensorrt_version():
+    try:
+        import tensorrt
+    except ImportError:
+        return "unknown"
+    return tensorrt.__version__
+
+
+def _input_resolution(argv):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--input-width", type=int, default=0)
+    parser.add_argument("--input-height", type=int, default=0)
+    opt = parser.parse_known_args(argv[1:])[0]
+    if opt.input_width and opt.input_height:
+        return opt.input_width, opt.input_height
+    return None
+
+
+# A frame in host memory: an HWC array of 8-bit RGB pixels with the width,
+# height and format attributes of a CUDA image.
+class HostImage:
+    format = "rgb8"
+
+    def __init__(self, array):
+        self.array = array
+        self.height, self.width = array.shape[:2]
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.array
+        return self.array.astype(dtype)
+
+
+# Stands in for videoSource. Serves the images of a file or folder, in name
+# order, or the frames of a video file read with OpenCV. Images are decoded
+# and scaled to the resolution once, so capturing costs one copy and the
+# classifier is what is measured. Every capture returns a copy, the overlays
+# are drawn into the frame. With loop the input starts over at the end, with
+# fps frames are paced like a camera.
+class FileSource:
+    def __init__(self, uri, resolution=None, loop=True, fps=0):
+        path = uri[len("file://") :] if uri.startswith("file://") else uri
+        self.resolution = resolution
+        self.loop = loop
+        self.interval = 1 / fps if fps else 0
+        self._next_frame = None
+        self._frames = None
+        self._video = None
+        self._index = 0
+        if os.path.isdir(path):
+            names = sorted(
+                name
+                for name in os.listdir(path)
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+            self._frames = [self._load(os.path.join(path, name)) for name in names]
+        elif path.lower().endswith(IMAGE_EXTENSIONS):
+            self._frames = [self._load(path)]
+        else:
+            # optional, only needed for video files
+            import cv2
+
+            self._cv2 = cv2
+            self._video = cv2.VideoCapture(path)
+            if not self._video.isOpened():
+                raise ValueError("Unable to open video source %s" % uri)
+        if self._frames is not None and not self._frames:
+            raise ValueError("No images in %s" % uri)
+
+    def _load(self, path):
+        with Image.open(path) as image:
+            image = image.convert("RGB")
+            if self.resolution is not None and image.size != tuple(self.resolution):
+                image = image.resize(tuple(self.resolution), Image.BILINEAR)
+            return numpy.asarray(image)
+
+    # Returns None at the end of the input when it does not loop.
+    def Capture(self):
+        if self.interval:
+            now = time.monotonic()
+            if self._next_frame is not None and now < self._next_frame:
+                time.sleep(self._next_frame - now)
+                now = self._next_frame
+            self._next_frame = now + self.interval
+        if self._video is not None:
+            return self._read_video()
+        if self._index == len(self._frames):
+            if not self.loop:
+                return None
+            self._index = 0
+        frame = self._frames[self._index]
+        self._index += 1
+        return HostImage(frame.copy())
+
+    def _read_video(self):
+        ok, frame = self._video.read()
+        if not ok and self.loop:
+            self._video.set(self._cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self._video.read()
+        if not ok:
+            return None
+        if self.resolution is not None:
+            frame = self._cv2.resize(frame, tuple(self.resolution))
+        return HostImage(self._cv2.cvtColor(frame, self._cv2.COLOR_BGR2RGB))
+
+    def IsStreaming(self):
+        return self.loop or self._video is not None or self._index < len(self._frames)
+
+    def Close(self):
+        if self._video is not None:
+            self._video.release()
+
+
+# Draws text with a background box into a host frame, like cudaFont.
+class HostFont:
+    Green = (0, 255, 0)
+    Blue = (0, 0, 255)
+    Gray40 = (40, 40, 40)
+
+    def __init__(self, size=32):
+        try:
+            self.font = ImageFont.load_default(size)
+        except TypeError:
+            # Pillow before 10.1 only has the small bitmap font
+            self.font = ImageFont.load_default()
+
+    def OverlayText(self, img, width, height, text, x, y, color, background):
+        image = Image.fromarray(img.array)
+        draw = ImageDraw.Draw(image)
+        left, top, right, bottom = draw.textbbox((x, y), text, font=self.font)
+        draw.rectangle((left - 5, top - 5, right + 5, bottom + 5), fill=background)
+        draw.text((x, y), text, fill=color, font=self.font)
+        img.array[...] = numpy.asarray(image)
+
+
+# Crops regions out of host frames. The crops are views of the frame, nothing
+# is copied or allocated.
+class HostRegionCropper:
+    def __init__(self, regions):
+        self.regions = regions
+
+    def crop(self, frame, slot=0):
+        crops = []
+        for region in self.regions:
+            if region == FULL_FRAME_REGION:
+                crops.append((region, frame))
+                continue
+            top = int(round(region.top * frame.height))
+            bottom = int(round(region.bottom * frame.height))
+            left = int(round(region.left * frame.width))
+            right = int(round(region.right * frame.width))
+            crops.append((region, HostImage(frame.array[top:bottom, left:right])))
+        return crops
+
+
+# Samples host frames on a grid for the motion gate, like FrameSampler does
+# for frames of the older CaptureRGBA() API.
+class HostFrameSampler:
+    def __init__(self, width=DEFAULT_SAMPLE_WIDTH, height=DEFAULT_SAMPLE_HEIGHT):
+        self.width = width
+        self.height = height
+
+    def sample(self, frame, width=None, height=None):
+        pixels = frame.array[
+            :: max(1, frame.height // self.height), :: max(1, frame.width // self.width)
+        ]
+        return pixels[:, :, :3].mean(axis=2)
@@ -0,0 +1,69 @@
+import threading
+
+# Images classified in one pass of the network.
+DEFAULT_MAX_BATCH_SIZE = 4
+
+# Seconds the inference thread waits for more frames to fill a batch once the
+# first one has arrived.
+DEFAULT_BATCH_DELAY = 0.01
+
+
+# Whether the network classifies several images in one pass. imageNet does not,
+# waiting for a batch of frames to fill would only delay them.
+def classifies_batches(net):
+    return getattr(net, "ClassifyBatch", None) is not None
+
+
+# Runs the network on batches of images: the frames of several cameras that
+# are waiting at the same time and the regions or tiles of those frames.
+# A network with ClassifyBatch(images, topK), like OnnxClassifier, gets up to
+# max_batch_size images per call, limited further by its own max_batch_size
+# when the model has a fixed batch dimension. jetson.inference.imageNet only
+# classifies one image per call from Python, so its batches are run image by
+# image on the one thread; the batch is still the unit the engine counts, and
+# callers run imageNet on single frames (see classifies_batches()).
+class InferenceEngine:
+    def __init__(self, net, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        self.net = net
+        self.max_batch_size = max(1, max_batch_size)
+        net_batch_size = getattr(net, "max_batch_size", None)
+        if net_batch_size:
+            self.max_batch_size = min(self.max_batch_size, net_batch_size)
+        self._classify_batch = getattr(net, "ClassifyBatch", None)
+        self.batches = 0
+        self.images = 0
+        self._lock = threading.Lock()
+
+    # Returns one list of (class index, confidence) per image, sorted by
+    # confidence, whatever top_k is.
+    def classify(self, images, top_k):
+        predictions = []
+        for start in range(0, len(images), self.max_batch_size):
+            batch = images[start : start + self.max_batch_size]
+            predictions += self._run(batch, top_k)
+        return predictions
+
+    def _run(self, batch, top_k):
+        with self._lock:
+            self.batches += 1
+            self.images += len(batch)
+        if self._classify_batch is not None:
+            return self._classify_batch(batch, topK=top_k)
+        predictions = []
+        for image in batch:
+            image_predictions = self.net.Classify(image, topK=top_k)
+            if top_k == 1:
+                image_predictions = [image_predictions]
+            predictions.append(list(image_predictions))
+        return predictions
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_batch_size": self.max_batch_size,
+                "batches": self.batches,
+                "images": self.images,
+                "avg_batch_size": round(self.images / self.batches, 2)
+                if self.batches
+                else 0.0,
+            }
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import threading
+import time
+
+from module_metrics import DEFAULT_RESERVOIR_SIZE, Histogram, HttpExporter, Timer
+
+DEFAULT_SUMMARY_INTERVAL = 60.0
+DEFAULT_STATS_PORT = 8008
+
+
+# Named latency histograms shared by the capture and inference threads and
+# the event loop. Replaces printing the profiler times of every frame:
+#
+#   with instrumentation.span("encode"):
+#       image = encode_jpeg(img)
+#
+# and collect() returns one summary per span name for the interval since the
+# last call.
+class Instrumentation:
+    def __init__(self, reservoir_size=DEFAULT_RESERVOIR_SIZE, clock=time.monotonic):
+        self.reservoir_size = reservoir_size
+        self.clock = clock
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(
+                    name, Histogram(self.reservoir_size)
+                )
+        return histogram
+
+    def span(self, name):
+        return Timer(self.histogram(name).record, self.clock)
+
+    def record(self, name, seconds):
+        self.histogram(name).record(seconds)
+
+    def collect(self):
+        with self._lock:
+            histograms = list(self._histograms.items())
+        return {
+            name: histogram.snapshot(reset=True) for name, histogram in histograms
+        }
+
+
+# Every interval seconds collects the spans and the stats of the other parts
+# of the detector, keeps the summary for the local stats endpoint and sends it
+# as telemetry. sources maps a key of the summary to a function returning the
+# stats of one part, e.g. the pipeline or the spool.
+class SummaryReporter:
+    def __init__(
+        self, instrumentation, send, sources, interval=DEFAULT_SUMMARY_INTERVAL
+    ):
+        self.instrumentation = instrumentation
+        self.send = send
+        self.sources = sources
+        self.interval = interval
+        self.started = time.time()
+        self.latest = None
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def summarize(self):
+        summary = {
+            "type": "stats",
+            "time": round(time.time(), 3),
+            "uptime": round(time.time() - self.started, 1),
+            "interval": self.interval,
+            "spans": self.instrumentation.collect(),
+        }
+        for key, source in self.sources.items():
+            summary[key] = source()
+        return summary
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.latest = self.summarize()
+            print("Stats", json.dumps(self.latest["spans"], separators=(",", ":")))
+            try:
+                await self.send(json.dumps(self.latest, separators=(",", ":")))
+            except Exception as ex:
+                print("Unable to send stats: %s" % ex)
+
+
+# Serves the latest summary of a SummaryReporter as JSON over HTTP, for
+# looking at a device without going through IoT Hub:
+#
+#   curl http://localhost:8008/stats
+class StatsServer(HttpExporter):
+    def __init__(self, reporter, host="127.0.0.1", port=DEFAULT_STATS_PORT):
+        routes = {"/": self._render, "/stats": self._render}
+        super().__init__(routes, host, port)
+        self.reporter = reporter
+
+    def _render(self):
+        # empty until the first interval has passed
+        return "application/json", json.dumps(self.reporter.latest or {"type": "stats"})
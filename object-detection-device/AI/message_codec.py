@@ -0,0 +1,228 @@
+import base64
+import binascii
+import collections
+import json
+import re
+
+# Version of the message schema, carried in every message as "v".
+MESSAGE_VERSION = 1
+
+JSON_ENCODING = "json"
+MSGPACK_ENCODING = "msgpack"
+CBOR_ENCODING = "cbor"
+ENCODINGS = (JSON_ENCODING, MSGPACK_ENCODING, CBOR_ENCODING)
+
+# Storage queue messages are limited to 64 KiB, anything longer is not ours.
+MAX_MESSAGE_SIZE = 64 * 1024
+
+# Correlation ids are GUIDs. They name the folder of the detection image in
+# blob storage and on disk, so only letters, digits and dashes are accepted.
+CORRELATION_ID_PATTERN = re.compile(r"[A-Za-z0-9-]{1,64}")
+
+STATUS_FOUND = "found"
+STATUS_TIMEOUT = "timeout"
+STATUS_UNKNOWN_CLASS = "unknown-class"
+STATUS_CLASS_NOT_ALLOWED = "class-not-allowed"
+
+# Application property of the device telemetry telling responses apart from
+# the stats summaries sent on the same channel. Only responses decode with
+# decode_response().
+MESSAGE_TYPE_PROPERTY = "messageType"
+RESPONSE_MESSAGE_TYPE = "response"
+STATS_MESSAGE_TYPE = "stats"
+
+# One class a request looks for and the confidence in percent it needs.
+ClassTarget = collections.namedtuple("ClassTarget", "class_name threshold")
+
+# A detection request, satisfied by any one of its targets.
+RequestMessage = collections.namedtuple(
+    "RequestMessage", "correlation_id targets module_key"
+)
+
+# The answer to a request. class_name and confidence are only set for
+# STATUS_FOUND, tile only when the class was found in a region of the frame
+# and stream_id only when the detector serves several cameras.
+ResponseMessage = collections.namedtuple(
+    "ResponseMessage", "correlation_id status class_name confidence tile stream_id"
+)
+
+
+# Raised for a message that cannot be decoded or does not follow the schema.
+class MessageError(ValueError):
+    pass
+
+
+# Encodes and decodes the request and response messages exchanged between the
+# edge module, the storage queue and the detector.
+#
+#   request   {"v":1,"id":"<correlation id>","c":[["hulk",95],...],"k":"<module key>"}
+#   response  {"v":1,"id":"<correlation id>","s":"found","c":"hulk","p":97.5,
+#              "t":"tile1x0","sid":"door"}
+#
+# Messages are written as compact JSON, or as base64 encoded msgpack or CBOR
+# when that encoding is chosen and the package is installed. Decoding accepts
+# all three whatever the encoding, as well as the pipe-delimited
+# "correlation id|class|threshold|module key" requests of earlier versions.
+# Every check is a cheap type or length test, a malformed message raises
+# MessageError before anything else looks at it.
+class MessageCodec:
+    def __init__(self, encoding=JSON_ENCODING):
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown message encoding %s" % encoding)
+        self.encoding = encoding
+        if encoding != JSON_ENCODING:
+            # fail at startup rather than on the first message
+            _binary_module(encoding)
+
+    def encode_request(self, request):
+        return self._encode(
+            {
+                "v": MESSAGE_VERSION,
+                "id": request.correlation_id,
+                "c": [[target.class_name, target.threshold] for target in request.targets],
+                "k": request.module_key,
+            }
+        )
+
+    def decode_request(self, content):
+        if "|" in content and not content.startswith("{"):
+            return _decode_legacy_request(content)
+        fields = self._decode(content)
+        targets = fields.get("c")
+        if not isinstance(targets, list) or not targets:
+            raise MessageError("request has no classes")
+        module_key = fields.get("k")
+        if not isinstance(module_key, str):
+            raise MessageError("request has no module key")
+        return RequestMessage(
+            fields["id"], [_check_target(target) for target in targets], module_key
+        )
+
+    def encode_response(self, response):
+        fields = {"v": MESSAGE_VERSION, "id": response.correlation_id, "s": response.status}
+        if response.class_name is not None:
+            fields["c"] = response.class_name
+        if response.confidence is not None:
+            fields["p"] = round(response.confidence, 2)
+        if response.tile is not None:
+            fields["t"] = response.tile
+        if response.stream_id is not None:
+            fields["sid"] = response.stream_id
+        return self._encode(fields)
+
+    def decode_response(self, content):
+        fields = self._decode(content)
+        status = fields.get("s")
+        if not isinstance(status, str):
+            raise MessageError("response has no status")
+        return ResponseMessage(
+            fields["id"],
+            status,
+            fields.get("c"),
+            fields.get("p"),
+            fields.get("t"),
+            fields.get("sid"),
+        )
+
+    def _encode(self, fields):
+        if self.encoding == JSON_ENCODING:
+            return json.dumps(fields, separators=(",", ":"))
+        if self.encoding == MSGPACK_ENCODING:
+            data = _binary_module(MSGPACK_ENCODING).packb(fields)
+        else:
+            data = _binary_module(CBOR_ENCODING).dumps(fields)
+        return base64.b64encode(data).decode("ascii")
+
+    # Returns the fields of a message after checking the common header.
+    def _decode(self, content):
+        if not content or len(content) > MAX_MESSAGE_SIZE:
+            raise MessageError("message is empty or too long")
+        if content[0] == "{":
+            try:
+                fields = json.loads(content)
+            except ValueError:
+                raise MessageError("message is not valid JSON")
+        else:
+            fields = _decode_binary(content)
+        if not isinstance(fields, dict):
+            raise MessageError("message is not an object")
+        if fields.get("v") != MESSAGE_VERSION:
+            raise MessageError("unsupported message version %r" % fields.get("v"))
+        _check_correlation_id(fields.get("id"))
+        return fields
+
+
+def _check_correlation_id(correlation_id):
+    if not isinstance(correlation_id, str) or not correlation_id:
+        raise MessageError("message has no correlation id")
+    if not CORRELATION_ID_PATTERN.fullmatch(correlation_id):
+        raise MessageError(
+            "correlation id %r is not a GUID, it may only hold letters, digits "
+            "and dashes" % correlation_id[:64]
+        )
+
+
+def _check_target(target):
+    if not isinstance(target, (list, tuple)) or len(target) != 2:
+        raise MessageError("class entry is not a [class, threshold] pair")
+    class_name, threshold = target
+    if not isinstance(class_name, str) or not class_name:
+        raise MessageError("class name is missing")
+    if isinstance(threshold, bool) or not isinstance(threshold, (int, float)):
+        raise MessageError("threshold of %s is not a number" % class_name)
+    if not 0 <= threshold <= 100:
+        raise MessageError("threshold of %s is not a percentage" % class_name)
+    return ClassTarget(class_name, threshold)
+
+
+def _decode_legacy_request(content):
+    parts = content.split("|")
+    if len(parts) != 4:
+        raise MessageError("request does not have 4 fields")
+    _check_correlation_id(parts[0])
+    try:
+        threshold = int(parts[2])
+    except ValueError:
+        raise MessageError("threshold is not a number")
+    return RequestMessage(
+        parts[0], [_check_target([parts[1], threshold])], parts[3]
+    )
+
+
+def _decode_binary(content):
+    try:
+        data = base64.b64decode(content, validate=True)
+    except (binascii.Error, ValueError):
+        raise MessageError("message is neither JSON nor base64")
+    if not data:
+        raise MessageError("message is empty")
+    # the first byte of a msgpack map is 0x80-0x8f or 0xde-0xdf,
+    # the first byte of a CBOR map is 0xa0-0xbf
+    first = data[0]
+    if 0x80 <= first <= 0x8F or first in (0xDE, 0xDF):
+        module = _binary_module(MSGPACK_ENCODING, MessageError)
+        loads = module.unpackb
+    elif 0xA0 <= first <= 0xBF:
+        module = _binary_module(CBOR_ENCODING, MessageError)
+        loads = module.loads
+    else:
+        raise MessageError("message is not a msgpack or CBOR map")
+    try:
+        return loads(data)
+    except Exception:
+        raise MessageError("message is not valid %s" % module.__name__)
+
+
+# msgpack and cbor2 are optional, they are only imported when used.
+def _binary_module(encoding, error=ImportError):
+    try:
+        if encoding == MSGPACK_ENCODING:
+            import msgpack
+
+            return msgpack
+        import cbor2
+
+        return cbor2
+    except ImportError:
+        package = "msgpack" if encoding == MSGPACK_ENCODING else "cbor2"
+        raise error("%s messages need the %s package" % (encoding, package))
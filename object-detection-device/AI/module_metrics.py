@@ -0,0 +1,333 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+# The same file is vendored into every module and into the detector
+# (object-detection-device/AI), which only uses Histogram and HttpExporter.
+# Change all copies together.
+
+DEFAULT_METRICS_PORT = 9600
+
+# Durations kept per histogram, whatever the number of recorded durations.
+DEFAULT_RESERVOIR_SIZE = 1024
+
+PERCENTILES = (50, 90, 99)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+# Returns the percentile of sorted samples, 0.0 without samples.
+def percentile(samples, percent):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, len(samples) * percent // 100)]
+
+
+# Fixed-memory latency histogram.
+# Count, total and maximum are exact. The percentiles come from a uniform
+# reservoir sample of at most size durations (Algorithm R), so recording is
+# O(1) and the memory does not grow with the frame rate. Thread-safe.
+class Histogram:
+    def __init__(self, size=DEFAULT_RESERVOIR_SIZE):
+        self.size = size
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        self._reset()
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            if len(self._samples) < self.size:
+                self._samples.append(seconds)
+            else:
+                slot = self._random.randrange(self.count)
+                if slot < self.size:
+                    self._samples[slot] = seconds
+
+    # Returns count, total and maximum in seconds and the sorted samples. With
+    # reset the histogram starts over, so the next read covers the time since
+    # this one.
+    def read(self, reset=False):
+        with self._lock:
+            state = self.count, self.total, self.max, sorted(self._samples)
+            if reset:
+                self._reset()
+        return state
+
+    # Durations are reported in milliseconds.
+    def snapshot(self, reset=False):
+        count, total, maximum, samples = self.read(reset)
+        summary = {
+            "count": count,
+            "avg_ms": round(total / count * 1000, 2) if count else 0.0,
+            "max_ms": round(maximum * 1000, 2),
+        }
+        for percent in PERCENTILES:
+            summary["p%d_ms" % percent] = round(percentile(samples, percent) * 1000, 2)
+        return summary
+
+    def _reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._samples = []
+
+
+# Times a block of code with the monotonic clock and records the duration.
+class Timer:
+    def __init__(self, record, clock=time.monotonic):
+        self.record = record
+        self.clock = clock
+        self.started = None
+
+    def __enter__(self):
+        self.started = self.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.record(self.clock() - self.started)
+        return False
+
+
+# A value that only goes up, one per combination of label values.
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels[name]) for name in self.labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name, _format_labels(self.labels, key), value
+
+
+# A value read when the metrics are scraped.
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        yield self.name, "", self.read()
+
+
+# Latencies as a Prometheus summary, one Histogram per combination of label
+# values. Count and sum are cumulative, the quantiles cover the time since
+# the previous scrape.
+class Summary:
+    kind = "summary"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # label values -> [histogram, count, sum]
+        self._series = {}
+
+    def observe(self, seconds, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [Histogram(), 0, 0.0]
+        series[0].record(seconds)
+
+    # with metrics_summary.time(method="x"): ...
+    def time(self, **labels):
+        return Timer(lambda seconds: self.observe(seconds, **labels))
+
+    def samples(self):
+        for key, series in sorted(self._series.items()):
+            count, total, _, samples = series[0].read(reset=True)
+            series[1] += count
+            series[2] += total
+            for percent in PERCENTILES:
+                quantile = [("quantile", str(percent / 100))]
+                yield self.name, _format_labels(
+                    self.labels, key, quantile
+                ), percentile(samples, percent)
+            yield self.name + "_sum", _format_labels(self.labels, key), series[2]
+            yield self.name + "_count", _format_labels(self.labels, key), series[1]
+
+
+# Resident set size of this process in bytes.
+def process_rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        # the peak rather than the current size, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# The metrics of a module in the Prometheus text format. Every module gets
+# the process metrics and the event loop lag, the module adds its own
+# counters and summaries. Metrics are only changed on the event loop.
+class ModuleMetrics:
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.started = time.time()
+        self._metrics = []
+        self.gauge(
+            "process_resident_memory_bytes", "Resident memory size", process_rss_bytes
+        )
+        self.gauge(
+            "process_start_time_seconds",
+            "Start time since the epoch",
+            lambda: self.started,
+        )
+        self.gauge(
+            "uptime_seconds",
+            "Seconds since the module started",
+            lambda: time.time() - self.started,
+        )
+        self.event_loop_lag = self.summary(
+            "event_loop_lag_seconds",
+            "How late the event loop ran a timer, i.e. how long something blocked it",
+        )
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self._name(name), help, labels))
+
+    def gauge(self, name, help, read):
+        return self._add(Gauge(self._name(name), help, read))
+
+    def summary(self, name, help, labels=()):
+        return self._add(Summary(self._name(name), help, labels))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, labels, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    # Measures how late a timer fires, every interval seconds.
+    async def watch_event_loop(self, interval=0.5):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.event_loop_lag.observe(max(0.0, loop.time() - expected))
+
+    def _name(self, name):
+        # the process metrics keep their standard names
+        if name.startswith("process_"):
+            return name
+        return "%s_%s" % (self.namespace, name)
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+# Answers HTTP GET requests with asyncio alone, as not every module installs
+# a web framework. routes maps a path to a function returning the content
+# type and the body of the response.
+class HttpExporter:
+    def __init__(self, routes, host, port):
+        self.routes = routes
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # the headers are not needed
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            route = self.routes.get(parts[1]) if len(parts) >= 2 else None
+            content_type = "text/plain"
+            if not parts or parts[0] != "GET":
+                status, body = "405 Method Not Allowed", "only GET\n"
+            elif route is None:
+                status, body = "404 Not Found", "not found\n"
+            else:
+                status = "200 OK"
+                content_type, body = route()
+            payload = body.encode("utf-8")
+            writer.write(
+                (
+                    "HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n"
+                    "Connection: close\r\n\r\n" % (status, content_type, len(payload))
+                ).encode("latin-1")
+                + payload
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+# Serves the metrics of a module for a Prometheus scraper or curl, and
+# watches the event loop lag while it runs:
+#
+#   curl http://<device>:9600/metrics
+class MetricsServer(HttpExporter):
+    def __init__(self, metrics, host="0.0.0.0", port=DEFAULT_METRICS_PORT):
+        routes = {"/": self._render, "/metrics": self._render}
+        super().__init__(routes, host, port)
+        self.metrics = metrics
+        self._watcher = None
+
+    async def start(self):
+        await super().start()
+        self._watcher = asyncio.ensure_future(self.metrics.watch_event_loop())
+        print("Serving metrics on port %d" % self.port)
+
+    async def stop(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+        await super().stop()
+
+    def _render(self):
+        return CONTENT_TYPE, self.metrics.render()
@@ -0,0 +1,137 @@
+import time
+
+# Size frames are shrunk to before they are compared. Shrinking averages out
+# sensor noise and makes a comparison cost a few thousand pixels.
+DEFAULT_SAMPLE_WIDTH = 64
+DEFAULT_SAMPLE_HEIGHT = 36
+
+# A sample pixel counts as changed when its brightness moved by more than this
+# many levels (0-255).
+DEFAULT_PIXEL_DELTA = 12
+
+
+# Shrinks camera frames into a small mapped buffer on the GPU and returns the
+# brightness of every pixel of it as a numpy array. The buffer is allocated
+# once and reused for every frame.
+# Frames of the older CaptureRGBA() API come with their width and height and
+# have to be captured with zeroCopy, they are sampled on a grid instead.
+class FrameSampler:
+    def __init__(self, width=DEFAULT_SAMPLE_WIDTH, height=DEFAULT_SAMPLE_HEIGHT):
+        # only imported when frames are actually sampled
+        import jetson.utils
+        self.utils = jetson.utils
+        self.width = width
+        self.height = height
+        self.buffer = None
+
+    def sample(self, frame, width=None, height=None):
+        if width is not None:
+            pixels = self.utils.cudaToNumpy(frame, width, height, 4)
+            pixels = pixels[
+                :: max(1, height // self.height), :: max(1, width // self.width)
+            ]
+        else:
+            if self.buffer is None or self.buffer.format != frame.format:
+                self.buffer = self.utils.cudaAllocMapped(
+                    width=self.width, height=self.height, format=frame.format
+                )
+            self.utils.cudaResize(frame, self.buffer)
+            self.utils.cudaDeviceSynchronize()
+            pixels = self.utils.cudaToNumpy(self.buffer)
+        # mean of the colour channels, copied out of the frame or of the
+        # buffer reused for the next one
+        return pixels[:, :, :3].mean(axis=2)
+
+
+# Decides which frames are worth classifying.
+# Every frame is shrunk and compared with the frame that was classified last.
+# When more than motion_threshold (a fraction) of the pixels changed, the scene
+# is moving and frames are classified at full rate until it has been still for
+# hold seconds. A still scene is still classified every min_interval seconds,
+# so an object that appears without enough motion to pass the threshold is
+# found eventually. Comparing with the last classified frame rather than the
+# previous one also catches slow changes that no two frames show.
+# A motion_threshold of 0 lets every frame through without sampling it.
+class MotionGate:
+    def __init__(
+        self,
+        motion_threshold=0.01,
+        min_interval=1.0,
+        hold=2.0,
+        pixel_delta=DEFAULT_PIXEL_DELTA,
+        sampler=None,
+        clock=time.monotonic,
+    ):
+        self.motion_threshold = motion_threshold
+        self.min_interval = min_interval
+        self.hold = hold
+        self.pixel_delta = pixel_delta
+        self.sampler = sampler
+        self.clock = clock
+        self.reference = None
+        self.last_motion = None
+        self.last_classified = None
+        self.forced = False
+
+        self.frames = 0
+        self.classified = 0
+        self.motion_frames = 0
+        self.score = 0.0
+
+    # Returns True when the frame should be classified. width and height are
+    # only given for frames of CaptureRGBA().
+    def admit(self, frame, width=None, height=None):
+        if not self.motion_threshold:
+            self.frames += 1
+            self.classified += 1
+            return True
+        if self.sampler is None:
+            self.sampler = FrameSampler()
+        return self.update(self.sampler.sample(frame, width, height))
+
+    # Same as admit() for a frame that has already been sampled.
+    def update(self, sample):
+        now = self.clock()
+        self.frames += 1
+        if self.reference is None or self.reference.shape != sample.shape:
+            classify = True
+        else:
+            changed = abs(sample - self.reference) > self.pixel_delta
+            self.score = float(changed.mean())
+            if self.score >= self.motion_threshold:
+                self.motion_frames += 1
+                self.last_motion = now
+            classify = (
+                self.forced
+                or (
+                    self.last_motion is not None
+                    and now - self.last_motion <= self.hold
+                )
+                or (
+                    self.min_interval is not None
+                    and now - self.last_classified >= self.min_interval
+                )
+            )
+        if classify:
+            self.forced = False
+            self.reference = sample
+            self.last_classified = now
+            self.classified += 1
+        return classify
+
+    # Lets the next frame through whatever it shows, e.g. when a new request
+    # starts looking at a scene that has been still.
+    def trigger(self):
+        self.forced = True
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "classified": self.classified,
+            "skipped": self.frames - self.classified,
+            "motion_frames": self.motion_frames,
+            "duty_cycle": round(self.classified / self.frames, 3)
+            if self.frames
+            else 1.0,
+            "score": round(self.score, 4),
+        }
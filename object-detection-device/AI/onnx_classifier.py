@@ -0,0 +1,176 @@
+import os
+import time
+
+import numpy
+
+from class_index import ClassIndex
+from engine_cache import COLD, UNCACHED, WARM, StartupReport, device_name
+
+# jetson-inference normalizes the input of ONNX classification models the way
+# torchvision trained them: pixels scaled to 0-1, then per channel mean and
+# standard deviation.
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+# Input size used when the model leaves it open.
+DEFAULT_INPUT_SIZE = 224
+
+
+def _axis_weights(in_size, out_size):
+    # pixel centres of the output in input coordinates
+    positions = (numpy.arange(out_size) + 0.5) * in_size / out_size - 0.5
+    positions = numpy.clip(positions, 0, in_size - 1)
+    low = numpy.floor(positions).astype(numpy.intp)
+    high = numpy.minimum(low + 1, in_size - 1)
+    return low, high, (positions - low).astype(numpy.float32)
+
+
+# Bilinear resize of an HWC image with numpy, one gather and one blend per
+# axis instead of a loop over pixels.
+def resize_bilinear(image, width, height):
+    top, bottom, y_weights = _axis_weights(image.shape[0], height)
+    left, right, x_weights = _axis_weights(image.shape[1], width)
+    image = image.astype(numpy.float32, copy=False)
+    y_weights = y_weights[:, None, None]
+    rows = image[top] * (1 - y_weights) + image[bottom] * y_weights
+    x_weights = x_weights[:, None]
+    return rows[:, left] * (1 - x_weights) + rows[:, right] * x_weights
+
+
+# Turns HWC frames with 0-255 RGB or RGBA pixels into one normalized NCHW
+# float32 batch.
+def preprocess(images, width, height, mean=IMAGENET_MEAN, std=IMAGENET_STD):
+    batch = numpy.stack(
+        [
+            resize_bilinear(numpy.asarray(image)[:, :, :3], width, height)
+            for image in images
+        ]
+    )
+    scale = 1 / (255 * numpy.asarray(std, dtype=numpy.float32))
+    offset = numpy.asarray(mean, dtype=numpy.float32) / numpy.asarray(
+        std, dtype=numpy.float32
+    )
+    batch = batch * scale - offset
+    return numpy.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+
+
+def softmax(logits):
+    exponents = numpy.exp(logits - logits.max(axis=1, keepdims=True))
+    return exponents / exponents.sum(axis=1, keepdims=True)
+
+
+# The CPU counterpart of jetson.inference.imageNet for a model exported by the
+# jetson-inference training scripts (e.g. gil_background_hulk/resnet18.onnx),
+# run with ONNX Runtime. It answers the calls FrameProcessor and ClassIndex make
+# on the network, so it takes the place of imageNet where there is no Jetson,
+# and adds ClassifyBatch() for the inference engine. Frames are HWC numpy
+# arrays or anything numpy.asarray() turns into one, like the frames of the
+# cpu backend.
+# The training scripts export the model with a batch size of 1; only a model
+# exported with a dynamic or larger batch dimension runs several images in one
+# pass, max_batch_size is None when the batch dimension is dynamic.
+# ONNX Runtime builds no engine. With an engine cache the model is stored after
+# the graph optimizations of the first start, so later starts skip them.
+# precision labels the cached model, e.g. int8 for the quantized model made by
+# calibrate-int8.py; the model itself decides the precision it runs at.
+class OnnxClassifier:
+    def __init__(
+        self,
+        model_path,
+        labels_path,
+        input_blob="input_0",
+        output_blob="output_0",
+        providers=None,
+        session_options=None,
+        engine_cache=None,
+        precision="fp32",
+    ):
+        # only needed where the model runs on the CPU
+        import onnxruntime
+
+        started = time.monotonic()
+        self.model_path = model_path
+        options = session_options or onnxruntime.SessionOptions()
+        providers = providers or ["CPUExecutionProvider"]
+        engine, hash_seconds = UNCACHED, 0.0
+        if engine_cache is None:
+            self.session = onnxruntime.InferenceSession(model_path, options, providers)
+        else:
+            key = engine_cache.key(
+                model_path,
+                precision,
+                # the optimized model keeps the batch dimension of the export
+                0,
+                "%s onnxruntime %s" % (device_name(), onnxruntime.__version__),
+            )
+            hash_seconds = time.monotonic() - started
+            cached = engine_cache.lookup(key)
+            if cached is not None:
+                engine = WARM
+                # only the layout optimizations for this CPU are left to do
+                self.session = onnxruntime.InferenceSession(cached, options, providers)
+            else:
+                engine = COLD
+                # the layout optimizations of the highest level are specific
+                # to the CPU, they are not stored
+                build_options = onnxruntime.SessionOptions()
+                build_options.graph_optimization_level = (
+                    onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+                )
+                optimized = engine_cache.path(key) + ".build"
+                build_options.optimized_model_filepath = optimized
+                onnxruntime.InferenceSession(model_path, build_options, providers)
+                stored = engine_cache.store(key, optimized)
+                self.session = onnxruntime.InferenceSession(stored, options, providers)
+        self.startup = StartupReport(engine, time.monotonic() - started, hash_seconds)
+        inputs = {i.name: i for i in self.session.get_inputs()}
+        model_input = inputs.get(input_blob) or self.session.get_inputs()[0]
+        self.input_blob = model_input.name
+        self.output_blob = output_blob
+        if output_blob not in [o.name for o in self.session.get_outputs()]:
+            self.output_blob = self.session.get_outputs()[0].name
+
+        batch, _, height, width = model_input.shape
+        self.max_batch_size = batch if isinstance(batch, int) else None
+        self.height = height if isinstance(height, int) else DEFAULT_INPUT_SIZE
+        self.width = width if isinstance(width, int) else DEFAULT_INPUT_SIZE
+        self.class_names = ClassIndex.from_labels_file(labels_path).class_names
+        self.fps = 0.0
+
+    def GetNumClasses(self):
+        return len(self.class_names)
+
+    def GetClassDesc(self, class_idx):
+        return self.class_names[class_idx]
+
+    def GetNetworkName(self):
+        return os.path.basename(self.model_path)
+
+    # Images per second of the last batch, preprocessing included.
+    def GetNetworkFPS(self):
+        return self.fps
+
+    # Same results as imageNet.Classify(): (class index, confidence), or a
+    # list of them sorted by confidence when topK is not 1.
+    def Classify(self, image, topK=1):
+        predictions = self.ClassifyBatch([image], topK)[0]
+        return predictions[0] if topK == 1 else predictions
+
+    # A list of predictions per image, each sorted by confidence.
+    def ClassifyBatch(self, images, topK=1):
+        started = time.perf_counter()
+        batch = preprocess(images, self.width, self.height)
+        if self.max_batch_size and len(images) < self.max_batch_size:
+            # a fixed batch dimension is filled up with copies of the last image
+            padding = numpy.repeat(batch[-1:], self.max_batch_size - len(images), 0)
+            batch = numpy.concatenate([batch, padding])
+        logits = self.session.run([self.output_blob], {self.input_blob: batch})[0]
+        # the exported models end in the last linear layer, as with imageNet
+        # the confidences are softmax probabilities of its outputs
+        probabilities = softmax(logits[: len(images)])
+        self.fps = len(images) / (time.perf_counter() - started)
+        top = numpy.argsort(-probabilities, axis=1)[:, :topK]
+        return [
+            [(int(class_idx), float(row[class_idx])) for class_idx in classes]
+            for row, classes in zip(probabilities, top)
+        ]
@@ -0,0 +1,375 @@
+import asyncio
+import collections
+import threading
+import time
+
+from instrumentation import Instrumentation
+
+# Frames and detections waiting between two stages. Kept small so a slow
+# stage always works on recent data instead of a growing backlog.
+DEFAULT_STAGE_QUEUE_SIZE = 2
+
+
+# Captured frames that can be alive at once: the ones waiting in the frame
+# queue, the batch being classified and the one being captured. A frame
+# dropped from the full queue is released before the new one is queued.
+def frames_held(queue_size=DEFAULT_STAGE_QUEUE_SIZE, batch_size=1):
+    return max(queue_size, batch_size) + batch_size + 1
+
+
+# Per-stage counters: items handled, items dropped because the next stage
+# could not keep up and items the stage failed on. How long each item, or
+# each batch of items, took in the stage is recorded in the stage's latency
+# histogram.
+class StageStats:
+    def __init__(self, name, histogram):
+        self.name = name
+        self.histogram = histogram
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, items=1):
+        with self._lock:
+            self.processed += items
+        self.histogram.record(seconds)
+
+    def record_drop(self):
+        with self._lock:
+            self.dropped += 1
+
+    def record_error(self, items=1):
+        with self._lock:
+            self.errors += items
+
+    def snapshot(self, depth):
+        with self._lock:
+            return {
+                "depth": depth,
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "errors": self.errors,
+            }
+
+
+# Bounded queue between two threads. When it is full the oldest item is
+# discarded so the producer never blocks.
+class DropOldestQueue:
+    def __init__(self, stats, maxsize=DEFAULT_STAGE_QUEUE_SIZE, on_drop=None):
+        self.stats = stats
+        self._items = collections.deque()
+        self._maxsize = maxsize
+        self._on_drop = on_drop
+        self._not_empty = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        with self._not_empty:
+            if len(self._items) >= self._maxsize:
+                dropped = self._items.popleft()
+                self.stats.record_drop()
+                if self._on_drop:
+                    self._on_drop(dropped)
+            self._items.append(item)
+            self._not_empty.notify()
+
+    # Returns None when nothing arrived within the timeout.
+    def get(self, timeout=None):
+        with self._not_empty:
+            if not self._items:
+                self._not_empty.wait(timeout)
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+    # Returns up to max_items items, an empty list when nothing arrived within
+    # the timeout. Once there is an item it waits up to max_delay seconds for
+    # the batch to fill.
+    def get_batch(self, max_items, timeout=None, max_delay=0.0):
+        with self._not_empty:
+            if not self._items:
+                self._not_empty.wait(timeout)
+            if not self._items:
+                return []
+            deadline = time.monotonic() + max_delay
+            while len(self._items) < max_items:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._not_empty.wait(remaining):
+                    break
+            count = min(max_items, len(self._items))
+            return [self._items.popleft() for _ in range(count)]
+
+
+# Bounded queue feeding an asyncio stage, with the same drop-oldest policy.
+# Worker threads hand items over with put_threadsafe().
+class AsyncDropOldestQueue:
+    def __init__(self, loop, stats, maxsize=DEFAULT_STAGE_QUEUE_SIZE, on_drop=None):
+        self.stats = stats
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize)
+        self._on_drop = on_drop
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def put_nowait(self, item):
+        if self._queue.full():
+            dropped = self._queue.get_nowait()
+            self._queue.task_done()
+            self.stats.record_drop()
+            if self._on_drop:
+                self._on_drop(dropped)
+        self._queue.put_nowait(item)
+
+    def put_threadsafe(self, item):
+        self._loop.call_soon_threadsafe(self.put_nowait, item)
+
+    async def get(self):
+        return await self._queue.get()
+
+    def task_done(self):
+        self._queue.task_done()
+
+    async def join(self):
+        await self._queue.join()
+
+
+# Runs capture, inference, upload and telemetry as separate stages so that
+# blocking CUDA work never stalls the event loop and network latency never
+# lowers the classification frame rate.
+#
+#   capture thread -> frames -> inference thread -> uploads -> upload task
+#       -> telemetry -> telemetry task
+#
+# Every classified frame is checked against all open requests in the request
+# table, so any number of pending requests share one inference stream.
+# Requests that are not satisfied before their deadline are expired.
+#
+# The stages are plain callables supplied by the caller:
+#   capture()                   blocking, returns the next frame or None for a
+#                               frame that is not worth classifying
+#   infer(frames, requests)     blocking, returns the detections for the requests
+#                               in a batch of frames
+#   upload(detection)           coroutine
+#   send(detection)             coroutine, the last stage for a detection
+#   on_error(detection, ex)     coroutine, called when upload or send fails
+#   on_timeout(request)         coroutine, called for every expired request
+#   on_drop(detection)          called when a detection is dropped by backpressure
+#   on_release(frames)          called with captured frames the pipeline is done
+#                               with, from the capture and inference threads
+# The inference thread takes up to batch_size frames at a time, waiting up to
+# batch_delay seconds for a batch to fill once the first frame is there, so
+# frames of several cameras are classified in one pass of the network.
+# Capture only runs while at least one request is open. Frames are held until
+# their batch is classified, overlaid and encoded or until they are dropped,
+# at most frames_held() of them, so capture() has to return frames the video
+# source does not reuse before on_release() gives them back. The time each
+# item spends in a stage is recorded as the capture, inference, upload and
+# send spans of the instrumentation.
+class DetectionPipeline:
+    def __init__(
+        self,
+        requests,
+        capture,
+        infer,
+        upload,
+        send,
+        on_error,
+        on_timeout,
+        on_drop=None,
+        on_release=None,
+        queue_size=DEFAULT_STAGE_QUEUE_SIZE,
+        delivery_queue_size=DEFAULT_STAGE_QUEUE_SIZE,
+        instrumentation=None,
+        batch_size=1,
+        batch_delay=0.0,
+    ):
+        self.requests = requests
+        self._capture = capture
+        self._infer = infer
+        self._upload = upload
+        self._send = send
+        self._on_error = on_error
+        self._on_timeout = on_timeout
+        self._on_drop = on_drop
+        self._on_release = on_release
+        self._queue_size = queue_size
+        self._delivery_queue_size = delivery_queue_size
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+
+        self.instrumentation = instrumentation or Instrumentation()
+        self.capture_stats = StageStats(
+            "capture", self.instrumentation.histogram("capture")
+        )
+        self.inference_stats = StageStats(
+            "inference", self.instrumentation.histogram("inference")
+        )
+        self.upload_stats = StageStats(
+            "upload", self.instrumentation.histogram("upload")
+        )
+        self.telemetry_stats = StageStats(
+            "telemetry", self.instrumentation.histogram("send")
+        )
+
+        self._loop = None
+        self._frames = None
+        self._uploads = None
+        self._telemetry = None
+        self._threads = []
+        self._tasks = []
+        self._running = threading.Event()
+        self._work = threading.Condition()
+
+    def start(self):
+        self._loop = asyncio.get_event_loop()
+        # room for a whole batch of frames
+        self._frames = DropOldestQueue(
+            self.capture_stats,
+            max(self._queue_size, self._batch_size),
+            lambda frame: self._release([frame]),
+        )
+        self._uploads = AsyncDropOldestQueue(
+            self._loop, self.inference_stats, self._delivery_queue_size, self._on_drop
+        )
+        self._telemetry = AsyncDropOldestQueue(
+            self._loop, self.upload_stats, self._delivery_queue_size, self._on_drop
+        )
+        self._running.set()
+        self._threads = [
+            threading.Thread(target=self._capture_loop, name="capture", daemon=True),
+            threading.Thread(
+                target=self._inference_loop, name="inference", daemon=True
+            ),
+        ]
+        for thread in self._threads:
+            thread.start()
+        self._tasks = [
+            asyncio.ensure_future(self._upload_loop()),
+            asyncio.ensure_future(self._telemetry_loop()),
+            asyncio.ensure_future(self._expiry_loop()),
+        ]
+
+    # Starts looking for the request. Returns the request that is actually
+    # open, which is an earlier one if the correlation id is already known.
+    def submit(self, request):
+        open_request = self.requests.add(request)
+        with self._work:
+            self._work.notify_all()
+        return open_request
+
+    async def stop(self):
+        self._running.clear()
+        with self._work:
+            self._work.notify_all()
+        for thread in self._threads:
+            await self._loop.run_in_executor(None, thread.join)
+        await self._uploads.join()
+        await self._telemetry.join()
+        for task in self._tasks:
+            task.cancel()
+
+    def stats(self):
+        return {
+            "open_requests": len(self.requests),
+            "capture": self.capture_stats.snapshot(len(self._frames)),
+            "inference": self.inference_stats.snapshot(len(self._uploads)),
+            "upload": self.upload_stats.snapshot(len(self._telemetry)),
+            "telemetry": self.telemetry_stats.snapshot(0),
+        }
+
+    def _capture_loop(self):
+        while self._running.is_set():
+            with self._work:
+                if not len(self.requests):
+                    # the timeout covers a request added just before waiting
+                    self._work.wait(0.5)
+                    continue
+            started = time.monotonic()
+            frame = self._capture()
+            self.capture_stats.record(time.monotonic() - started)
+            if frame is not None:
+                self._frames.put(frame)
+
+    def _inference_loop(self):
+        while self._running.is_set():
+            frames = self._frames.get_batch(
+                self._batch_size, timeout=0.5, max_delay=self._batch_delay
+            )
+            if not frames:
+                continue
+            open_requests = self.requests.open_requests()
+            if not open_requests:
+                self._release(frames)
+                continue
+            started = time.monotonic()
+            try:
+                detections = self._infer(frames, open_requests)
+            except Exception as ex:
+                # a bad batch must not end the inference thread, the open
+                # requests are served from the next frames
+                print("Unable to classify %d frames: %s" % (len(frames), ex))
+                self.inference_stats.record_error(len(frames))
+                continue
+            finally:
+                # the detections carry encoded images, not the frames
+                self._release(frames)
+            self.inference_stats.record(time.monotonic() - started, len(frames))
+            for detection in detections:
+                # skip requests that timed out while the frames were classified
+                if self.requests.remove(detection.request.correlation_id) is not None:
+                    self._uploads.put_threadsafe(detection)
+
+    def _release(self, frames):
+        if self._on_release is not None:
+            self._on_release(frames)
+
+    async def _expiry_loop(self):
+        while True:
+            await asyncio.sleep(1)
+            for request in self.requests.pop_expired():
+                try:
+                    await self._on_timeout(request)
+                except Exception as ex:
+                    # e.g. a lease that was lost, the other requests still
+                    # have to expire
+                    print("Unable to answer expired request: %s" % ex)
+
+    async def _upload_loop(self):
+        while True:
+            detection = await self._uploads.get()
+            started = time.monotonic()
+            try:
+                await self._upload(detection)
+            except Exception as ex:
+                await self._fail(self.upload_stats, detection, ex)
+            else:
+                self.upload_stats.record(time.monotonic() - started)
+                self._telemetry.put_nowait(detection)
+            finally:
+                self._uploads.task_done()
+
+    async def _telemetry_loop(self):
+        while True:
+            detection = await self._telemetry.get()
+            started = time.monotonic()
+            try:
+                await self._send(detection)
+            except Exception as ex:
+                await self._fail(self.telemetry_stats, detection, ex)
+            else:
+                self.telemetry_stats.record(time.monotonic() - started)
+            finally:
+                self._telemetry.task_done()
+
+    # Hands a failed detection to on_error. The fallback can fail as well,
+    # e.g. spooling on a full disk, which must not end the stage.
+    async def _fail(self, stats, detection, ex):
+        stats.record_error()
+        try:
+            await self._on_error(detection, ex)
+        except Exception as error_ex:
+            print("Unable to handle failed detection: %s" % error_ex)
@@ -0,0 +1,80 @@
+import collections
+import threading
+import time
+
+DEFAULT_REQUEST_TIMEOUT = 120
+
+
+# One class a request looks for. class_idx is the network class index of
+# class_name, resolved once when the request arrives, and threshold the
+# confidence in percent the class needs.
+RequestTarget = collections.namedtuple("RequestTarget", "class_name class_idx threshold")
+
+
+# A request read from the storage queue, leased until it has been answered.
+# It is satisfied by any one of its targets.
+class DetectionRequest:
+    def __init__(self, lease, correlation_id, targets):
+        self.lease = lease
+        self.correlation_id = correlation_id
+        self.targets = targets
+        self.deadline = None
+
+    # Takes the confidences of a frame by class index, returns the most
+    # confident satisfied target with its confidence, or None.
+    def match(self, confidences):
+        best = None
+        for target in self.targets:
+            confidence = confidences.get(target.class_idx, 0.0)
+            if confidence * 100 >= target.threshold and (
+                best is None or confidence > best[1]
+            ):
+                best = (target, confidence)
+        return best
+
+
+# The requests that are currently being looked for, keyed by correlation id.
+# Shared between the event loop, which adds and expires requests, and the
+# inference thread, which checks every classified frame against all of them.
+class RequestTable:
+    def __init__(self, timeout=DEFAULT_REQUEST_TIMEOUT):
+        self.timeout = timeout
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._requests)
+
+    # Returns the request that is already open under the same correlation id
+    # instead of adding a second one, e.g. for a redelivered queue message.
+    def add(self, request):
+        with self._lock:
+            existing = self._requests.get(request.correlation_id)
+            if existing is not None:
+                return existing
+            request.deadline = time.monotonic() + self.timeout
+            self._requests[request.correlation_id] = request
+            return request
+
+    # Returns the removed request, or None if it was already answered or
+    # timed out.
+    def remove(self, correlation_id):
+        with self._lock:
+            return self._requests.pop(correlation_id, None)
+
+    def open_requests(self):
+        with self._lock:
+            return list(self._requests.values())
+
+    # Removes and returns the requests whose deadline has passed.
+    def pop_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                request
+                for request in self._requests.values()
+                if request.deadline <= now
+            ]
+            for request in expired:
+                del self._requests[request.correlation_id]
+            return expired
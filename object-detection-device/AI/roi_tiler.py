@@ -0,0 +1,104 @@
+import collections
+
+FULL_FRAME = "frame"
+
+# A part of the frame that is classified on its own. The edges are fractions
+# of the frame width and height, so regions keep their place when the
+# resolution changes.
+Region = collections.namedtuple("Region", "name left top right bottom")
+
+# The whole frame, for classifying it next to the regions.
+FULL_FRAME_REGION = Region(FULL_FRAME, 0.0, 0.0, 1.0, 1.0)
+
+
+# Parses "name=left,top,width,height;..." where every number is a fraction of
+# the frame. The name is optional, unnamed regions are called roi0, roi1, ...
+def parse_regions(spec):
+    regions = []
+    for index, part in enumerate(p for p in spec.split(";") if p.strip()):
+        name, _, box = part.rpartition("=")
+        try:
+            left, top, width, height = (float(value) for value in box.split(","))
+        except ValueError:
+            raise ValueError("Region %r is not left,top,width,height" % part)
+        if width <= 0 or height <= 0:
+            raise ValueError("Region %r is empty" % part)
+        if min(left, top) < 0 or max(left + width, top + height) > 1 + 1e-9:
+            raise ValueError("Region %r is not within the frame" % part)
+        regions.append(
+            Region(
+                name.strip() or "roi%d" % index, left, top, left + width, top + height
+            )
+        )
+    return regions
+
+
+# Covers the frame with columns x rows tiles that overlap by overlap (a
+# fraction of a tile), so an object on the edge between two tiles is still
+# whole in one of them. Tiles are named by column and row, e.g. tile1x0.
+def grid_regions(columns, rows, overlap=0.0):
+    width = 1 / (columns - (columns - 1) * overlap)
+    height = 1 / (rows - (rows - 1) * overlap)
+    return [
+        Region(
+            "tile%dx%d" % (column, row),
+            column * width * (1 - overlap),
+            row * height * (1 - overlap),
+            min(1.0, column * width * (1 - overlap) + width),
+            min(1.0, row * height * (1 - overlap) + height),
+        )
+        for row in range(rows)
+        for column in range(columns)
+    ]
+
+
+# Crops the regions out of a frame into buffers that are allocated once per
+# resolution and reused for every frame, so tiling allocates nothing while
+# frames are classified. A crop stays valid until the next call of crop() with
+# the same slot; the frames of one batch are cropped into slots 0, 1, ... so
+# their tiles are classified together.
+class RegionCropper:
+    def __init__(self, regions):
+        # only imported where frames live in CUDA memory
+        import jetson.utils
+
+        self.utils = jetson.utils
+        self.regions = regions
+        self._key = None
+        # slot -> [(region, pixel rectangle, buffer)], None for the full frame
+        self._slots = {}
+
+    def crop(self, frame, slot=0):
+        key = (frame.width, frame.height, frame.format)
+        if key != self._key:
+            self._slots = {}
+            self._key = key
+        tiles = self._slots.get(slot)
+        if tiles is None:
+            tiles = self._slots[slot] = self._allocate(frame)
+        crops = []
+        for region, rect, buffer in tiles:
+            if buffer is None:
+                crops.append((region, frame))
+                continue
+            self.utils.cudaCrop(frame, buffer, rect)
+            crops.append((region, buffer))
+        return crops
+
+    def _allocate(self, frame):
+        tiles = []
+        for region in self.regions:
+            if region == FULL_FRAME_REGION:
+                tiles.append((region, None, None))
+                continue
+            rect = (
+                int(round(region.left * frame.width)),
+                int(round(region.top * frame.height)),
+                int(round(region.right * frame.width)),
+                int(round(region.bottom * frame.height)),
+            )
+            buffer = self.utils.cudaAllocMapped(
+                width=rect[2] - rect[0], height=rect[3] - rect[1], format=frame.format
+            )
+            tiles.append((region, rect, buffer))
+        return tiles
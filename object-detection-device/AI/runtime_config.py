@@ -0,0 +1,181 @@
+import asyncio
+import threading
+
+# Seconds before the twin is read again after the connection to it failed.
+DEFAULT_TWIN_RETRY_DELAY = 10.0
+
+
+# Raised for a twin property whose value cannot be used.
+class SettingsError(ValueError):
+    pass
+
+
+def parse_int(minimum=None, maximum=None):
+    def parse(value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise SettingsError("%r is not a number" % (value,))
+        if int(value) != value:
+            raise SettingsError("%r is not a whole number" % (value,))
+        return _check_range(int(value), minimum, maximum)
+
+    return parse
+
+
+def parse_float(minimum=None, maximum=None):
+    def parse(value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise SettingsError("%r is not a number" % (value,))
+        return _check_range(float(value), minimum, maximum)
+
+    return parse
+
+
+def parse_string(value):
+    if not isinstance(value, str):
+        raise SettingsError("%r is not a string" % (value,))
+    return value
+
+
+def parse_choice(choices):
+    def parse(value):
+        if value not in choices:
+            raise SettingsError("%r is not one of %s" % (value, ", ".join(choices)))
+        return value
+
+    return parse
+
+
+# A list of names, or one comma separated string, as twin properties cannot
+# hold arrays.
+def parse_string_list(value):
+    if isinstance(value, str):
+        return tuple(name.strip() for name in value.split(",") if name.strip())
+    if isinstance(value, (list, tuple)) and all(isinstance(name, str) for name in value):
+        return tuple(value)
+    raise SettingsError("%r is not a list of names" % (value,))
+
+
+# An object mapping class names to a confidence in percent. A class set to
+# null is removed, as for any nested twin property.
+def parse_thresholds(value):
+    if not isinstance(value, dict):
+        raise SettingsError("%r is not an object" % (value,))
+    parse_percentage = parse_float(0, 100)
+    return {
+        class_name: None if threshold is None else parse_percentage(threshold)
+        for class_name, threshold in value.items()
+        if not class_name.startswith("$")
+    }
+
+
+def _check_range(value, minimum, maximum):
+    if minimum is not None and value < minimum:
+        raise SettingsError("%r is below %r" % (value, minimum))
+    if maximum is not None and value > maximum:
+        raise SettingsError("%r is above %r" % (value, maximum))
+    return value
+
+
+# Settings that can be changed at runtime through desired properties of the
+# device or module twin.
+#
+# The settings are an immutable namedtuple. A patch is parsed and checked as a
+# whole and then swapped in as a new tuple, so a reader that took current()
+# never sees half of a patch, and a patch with one bad value changes nothing.
+# schema maps twin property names to (settings field, parser). Properties
+# that are not in the schema are ignored, a property set to null goes back to
+# its initial value. Objects are merged into the current value the way the
+# twin merges nested properties of a patch.
+class RuntimeConfig:
+    def __init__(self, settings, schema):
+        self.schema = schema
+        self.defaults = settings
+        self.version = 0
+        self._settings = settings
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def current(self):
+        return self._settings
+
+    # listener(settings, changed_fields) is called on the event loop after
+    # every patch that changed something.
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    # Returns the names of the fields the patch changed.
+    def apply_patch(self, patch):
+        values = {}
+        merges = {}
+        for name, value in patch.items():
+            if name not in self.schema:
+                continue
+            field, parse = self.schema[name]
+            if value is None:
+                values[field] = getattr(self.defaults, field)
+                continue
+            try:
+                value = parse(value)
+            except SettingsError as ex:
+                raise SettingsError("%s: %s" % (name, ex))
+            if isinstance(value, dict):
+                merges[field] = value
+            else:
+                values[field] = value
+
+        with self._lock:
+            for field, patch_value in merges.items():
+                merged = dict(getattr(self._settings, field))
+                merged.update(patch_value)
+                values[field] = {k: v for k, v in merged.items() if v is not None}
+            changed = [
+                field
+                for field, value in values.items()
+                if getattr(self._settings, field) != value
+            ]
+            if not changed:
+                return []
+            self._settings = self._settings._replace(**values)
+            self.version += 1
+            settings = self._settings
+        for listener in self._listeners:
+            listener(settings, changed)
+        return changed
+
+    # Applies the desired properties stored in the twin, then every patch
+    # as it arrives. The outcome is reported back as reported properties.
+    # When reading the twin or a patch fails, e.g. on a disconnect, the whole
+    # twin is read again after retry_delay seconds, so patches missed in the
+    # meantime are applied as well.
+    async def listen(self, client, retry_delay=DEFAULT_TWIN_RETRY_DELAY):
+        while True:
+            try:
+                twin = await client.get_twin()
+                await self.apply_and_report(client, twin.get("desired", {}))
+                while True:
+                    patch = await client.receive_twin_desired_properties_patch()
+                    await self.apply_and_report(client, patch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                print(
+                    "Unable to read the device twin, reading it again in %s s: %s"
+                    % (retry_delay, ex)
+                )
+                await asyncio.sleep(retry_delay)
+
+    # For listeners that receive the patches themselves.
+    async def apply_and_report(self, client, patch):
+        try:
+            changed = self.apply_patch(patch)
+        except SettingsError as ex:
+            print("Rejected desired properties patch: %s" % ex)
+            reported = {"settingsVersion": self.version, "settingsError": str(ex)}
+        else:
+            if changed:
+                print("Applied settings %s: %s" % (", ".join(changed), self.current()))
+            reported = {"settingsVersion": self.version, "settingsError": None}
+        try:
+            await client.patch_twin_reported_properties(reported)
+        except Exception as ex:
+            print("Unable to report applied settings: %s" % ex)
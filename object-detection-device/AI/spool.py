@@ -0,0 +1,316 @@
+import asyncio
+import collections
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Kinds of spooled records.
+BLOB_RECORD = 1
+TELEMETRY_RECORD = 2
+
+# When appended records are forced to disk:
+#   always    before append() returns, nothing is lost on power failure
+#   interval  at most fsync_interval seconds after the append
+#   never     whenever the operating system writes them back
+FSYNC_ALWAYS = "always"
+FSYNC_INTERVAL = "interval"
+FSYNC_NEVER = "never"
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+DEFAULT_FSYNC_INTERVAL = 1.0
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+DEFAULT_DRAIN_CONCURRENCY = 4
+
+# kind, key length, body length, crc32 of key and body
+_HEADER = struct.Struct(">BHII")
+_SEGMENT_SUFFIX = ".spool"
+
+SpoolRecord = collections.namedtuple("SpoolRecord", "kind key body")
+
+
+# Append-only store for blobs and telemetry that could not be delivered.
+# Records are appended to the newest segment file in the spool directory and
+# a new segment is started once it exceeds segment_size. Segments are sealed
+# before they are replayed and deleted once every record in them has been
+# delivered, so the spool survives restarts and delivers every record at
+# least once. A record torn by a crash fails its checksum and ends the
+# segment.
+# All methods are blocking and thread-safe, call them from an executor when
+# on the event loop.
+class Spool:
+    def __init__(
+        self,
+        directory,
+        fsync=FSYNC_INTERVAL,
+        fsync_interval=DEFAULT_FSYNC_INTERVAL,
+        segment_size=DEFAULT_SEGMENT_SIZE,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy %s" % fsync)
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        # keys of the records not delivered yet
+        self._keys = collections.Counter()
+        self._records = 0
+
+        os.makedirs(directory, exist_ok=True)
+        # every segment left by an earlier run is sealed
+        self._sealed = sorted(
+            int(name[: -len(_SEGMENT_SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(_SEGMENT_SUFFIX)
+        )
+        for segment in self._sealed:
+            for record in self.read_segment(segment):
+                self._keys[record.key] += 1
+                self._records += 1
+        self._next_segment = self._sealed[-1] + 1 if self._sealed else 0
+
+        self._writer = None
+        self._writer_segment = None
+        self._writer_size = 0
+        self._dirty = False
+        self._last_fsync = time.monotonic()
+
+    def __len__(self):
+        return self._records
+
+    # True while a record with the key waits to be delivered.
+    def __contains__(self, key):
+        with self._lock:
+            return self._keys[key] > 0
+
+    def append(self, kind, key, body):
+        key_bytes = key.encode("utf-8")
+        header = _HEADER.pack(
+            kind, len(key_bytes), len(body), zlib.crc32(body, zlib.crc32(key_bytes))
+        )
+        with self._lock:
+            if self._writer is None or self._writer_size >= self.segment_size:
+                self._seal()
+                self._open_writer()
+            self._writer.write(header + key_bytes + body)
+            self._writer_size += len(header) + len(key_bytes) + len(body)
+            self._dirty = True
+            self._keys[key] += 1
+            self._records += 1
+            if self.fsync == FSYNC_ALWAYS or (
+                self.fsync == FSYNC_INTERVAL
+                and time.monotonic() - self._last_fsync >= self.fsync_interval
+            ):
+                self._sync()
+            elif self.fsync == FSYNC_NEVER:
+                self._writer.flush()
+
+    # Forces appended records to disk, unless the policy is never.
+    def sync(self):
+        with self._lock:
+            if self.fsync == FSYNC_NEVER:
+                return
+            self._sync()
+
+    # Closes the segment being written so it can be replayed.
+    def seal(self):
+        with self._lock:
+            self._seal()
+
+    def has_unsealed_records(self):
+        with self._lock:
+            return self._writer is not None and self._writer_size > 0
+
+    def sealed_segments(self):
+        with self._lock:
+            return list(self._sealed)
+
+    def read_segment(self, segment):
+        records = []
+        with open(self._path(segment), "rb") as reader:
+            data = reader.read()
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            kind, key_length, body_length, crc = _HEADER.unpack_from(data, offset)
+            start = offset + _HEADER.size
+            end = start + key_length + body_length
+            if end > len(data):
+                break
+            key_bytes = data[start : start + key_length]
+            body = data[start + key_length : end]
+            if zlib.crc32(body, zlib.crc32(key_bytes)) != crc:
+                break
+            records.append(SpoolRecord(kind, key_bytes.decode("utf-8"), body))
+            offset = end
+        return records
+
+    # Deletes a sealed segment once its records have been delivered.
+    def remove_segment(self, segment, records):
+        with self._lock:
+            os.remove(self._path(segment))
+            self._sealed.remove(segment)
+            for record in records:
+                self._keys[record.key] -= 1
+                if self._keys[record.key] <= 0:
+                    del self._keys[record.key]
+            self._records -= len(records)
+
+    def close(self):
+        with self._lock:
+            self._seal()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, "%012d%s" % (segment, _SEGMENT_SUFFIX))
+
+    def _open_writer(self):
+        self._writer_segment = self._next_segment
+        self._next_segment += 1
+        self._writer = open(self._path(self._writer_segment), "ab")
+        self._writer_size = 0
+
+    def _sync(self):
+        if self._writer is not None and self._dirty:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._dirty = False
+        self._last_fsync = time.monotonic()
+
+    def _seal(self):
+        if self._writer is None:
+            return
+        if self.fsync == FSYNC_NEVER:
+            self._writer.flush()
+        else:
+            self._sync()
+        self._writer.close()
+        if self._writer_size:
+            self._sealed.append(self._writer_segment)
+        else:
+            os.remove(self._path(self._writer_segment))
+        self._writer = None
+        self._writer_segment = None
+
+
+# Replays the spool in the background, oldest segment first, with at most
+# concurrency records in flight. handlers maps a record kind to the coroutine
+# that delivers it. When a delivery fails the segment is retried after a
+# delay that doubles up to max_retry_interval, so an unreachable uplink is not
+# hammered, and records of the segment already delivered are not sent again.
+# The records of one correlation id are replayed in order, the image before
+# the response, and the response only once the image is stored, so a
+# response never points at an image that does not exist.
+class SpoolDrainer:
+    def __init__(
+        self,
+        spool,
+        handlers,
+        concurrency=DEFAULT_DRAIN_CONCURRENCY,
+        retry_interval=5.0,
+        max_retry_interval=300.0,
+    ):
+        self.spool = spool
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.replayed = 0
+        self.failed_attempts = 0
+        self._delivered = {}
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [
+            asyncio.ensure_future(self._run()),
+            asyncio.ensure_future(self._sync_loop()),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "spooled": len(self.spool),
+            "segments": len(self.spool.sealed_segments()),
+            "replayed": self.replayed,
+            "failed_attempts": self.failed_attempts,
+        }
+
+    # Keeps the interval fsync policy when nothing is appended for a while.
+    async def _sync_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.spool.fsync_interval)
+            await loop.run_in_executor(None, self.spool.sync)
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        delay = self.retry_interval
+        while True:
+            segments = self.spool.sealed_segments()
+            if not segments:
+                if self.spool.has_unsealed_records():
+                    await loop.run_in_executor(None, self.spool.seal)
+                    continue
+                await asyncio.sleep(self.retry_interval)
+                continue
+
+            segment = segments[0]
+            records = await loop.run_in_executor(
+                None, self.spool.read_segment, segment
+            )
+            if await self._replay(segment, records):
+                await loop.run_in_executor(
+                    None, self.spool.remove_segment, segment, records
+                )
+                self._delivered.pop(segment, None)
+                delay = self.retry_interval
+            else:
+                self.failed_attempts += 1
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_interval)
+
+    # Returns True once every record of the segment has been delivered.
+    # After the first failure the records still waiting are left for the
+    # next attempt.
+    async def _replay(self, segment, records):
+        delivered = self._delivered.setdefault(segment, set())
+        slots = asyncio.Semaphore(self.concurrency)
+        failed = []
+        requests = collections.OrderedDict()
+        for index, record in enumerate(records):
+            if index not in delivered:
+                requests.setdefault(_correlation_id(record), []).append(
+                    (index, record)
+                )
+
+        async def deliver(request_records):
+            # blob records sort before telemetry records
+            for index, record in sorted(request_records, key=lambda r: r[1].kind):
+                async with slots:
+                    if failed:
+                        return
+                    try:
+                        await self.handlers[record.kind](record)
+                    except Exception as ex:
+                        print(
+                            "Unable to replay spooled record %s: %s" % (record.key, ex)
+                        )
+                        failed.append(index)
+                        return
+                    delivered.add(index)
+                    self.replayed += 1
+
+        await asyncio.gather(*[deliver(group) for group in requests.values()])
+        return len(delivered) == len(records)
+
+
+# The correlation id a record belongs to: the key of a response, the first
+# folder of the blob path of an image.
+def _correlation_id(record):
+    if record.kind == BLOB_RECORD:
+        return record.key.split("/", 1)[0]
+    return record.key
@@ -0,0 +1,223 @@
+import asyncio
+import hashlib
+import os
+
+import aiohttp
+from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.storage.queue.aio import QueueClient
+from azure.storage.blob.aio import BlobServiceClient
+
+REQUEST_QUEUE_NAME = "iot-edge-object-classification-requests"
+RESPONSE_CONTAINER_NAME = "iot-edge-object-classification-responses"
+
+# Upper bound on the number of pooled HTTP connections shared by the queue
+# and blob clients.
+DEFAULT_MAX_CONNECTIONS = 4
+
+# Number of requests pulled from the queue per receive call and the number of
+# seconds they stay invisible to other consumers before the lease is renewed.
+DEFAULT_RECEIVE_BATCH_SIZE = 4
+DEFAULT_VISIBILITY_TIMEOUT = 30
+
+# Blobs larger than one block are uploaded as separately staged blocks, with
+# up to DEFAULT_UPLOAD_CONCURRENCY blocks in flight.
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_UPLOAD_CONCURRENCY = 4
+
+
+# Block ids must have the same length within a blob, the SDK base64 encodes
+# them. The id carries the position and a digest of the content, so a block
+# staged by an earlier attempt is only reused if it holds the same bytes.
+def _block_id(index, block):
+    return "{:06d}-{}".format(index, hashlib.md5(block).hexdigest()[:16])
+
+
+# Keeps a received queue message invisible while it is being processed.
+# The message is only deleted by complete(), so a request is never lost if the
+# detector crashes part way through: once the lease stops being renewed the
+# message becomes visible again and is delivered to the next poll.
+class QueueMessageLease:
+    def __init__(self, queue_client, message, visibility_timeout):
+        self.message = message
+        self._queue_client = queue_client
+        self._visibility_timeout = visibility_timeout
+        self._renew_task = None
+
+    def start(self):
+        self._renew_task = asyncio.ensure_future(self._renew())
+
+    async def _renew(self):
+        while True:
+            # Renew well before the current visibility timeout runs out.
+            await asyncio.sleep(self._visibility_timeout / 2)
+            try:
+                updated = await self._queue_client.update_message(
+                    self.message, visibility_timeout=self._visibility_timeout
+                )
+            except Exception as ex:
+                print("Unable to renew lease for message %s: %s" % (self.message.id, ex))
+                return
+            self.message.pop_receipt = updated.pop_receipt
+
+    async def stop_renewing(self):
+        if self._renew_task is None:
+            return
+        self._renew_task.cancel()
+        try:
+            await self._renew_task
+        except asyncio.CancelledError:
+            pass
+        self._renew_task = None
+
+    # The request has been fully handled, remove it from the queue.
+    async def complete(self):
+        await self.stop_renewing()
+        await self._queue_client.delete_message(self.message)
+
+    # The request could not be handled, make it visible again right away.
+    async def release(self):
+        await self.stop_renewing()
+        try:
+            await self._queue_client.update_message(self.message, visibility_timeout=0)
+        except Exception as ex:
+            print("Unable to release message %s: %s" % (self.message.id, ex))
+
+
+# A helper class to support async blob and queue actions.
+# The queue and blob clients are created once by open() and share a single
+# HTTP transport, so every poll and upload reuses an already established
+# connection instead of paying for TLS setup and connection string parsing.
+class StorageHelperAsync:
+    def __init__(
+        self,
+        connection_string=None,
+        queue_name=REQUEST_QUEUE_NAME,
+        container_name=RESPONSE_CONTAINER_NAME,
+        max_connections=DEFAULT_MAX_CONNECTIONS,
+        block_size=DEFAULT_BLOCK_SIZE,
+        upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+    ):
+        self.connection_string = connection_string or os.getenv(
+            "STORAGE_CONNECTION_STRING"
+        )
+        self.queue_name = queue_name
+        self.container_name = container_name
+        self.max_connections = max_connections
+        self.block_size = block_size
+        self.upload_concurrency = upload_concurrency
+        self._session = None
+        self._transport = None
+        self._queue_client = None
+        self._blob_service_client = None
+        self._container_client = None
+
+    async def open(self):
+        if self._session is not None:
+            return
+
+        # One aiohttp session with a bounded connector backs both clients.
+        # The transport does not own the session, so closing one client
+        # does not tear down the connections used by the other.
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections)
+        )
+        self._transport = AioHttpTransport(session=self._session, session_owner=False)
+
+        self._queue_client = QueueClient.from_connection_string(
+            self.connection_string, self.queue_name, transport=self._transport
+        )
+        self._blob_service_client = BlobServiceClient.from_connection_string(
+            self.connection_string, transport=self._transport
+        )
+        self._container_client = self._blob_service_client.get_container_client(
+            self.container_name
+        )
+
+    async def close(self):
+        if self._session is None:
+            return
+
+        await self._queue_client.close()
+        await self._blob_service_client.close()
+        await self._session.close()
+        self._queue_client = None
+        self._blob_service_client = None
+        self._container_client = None
+        self._transport = None
+        self._session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # data is the blob content as bytes or a readable file object.
+    # Content of up to block_size bytes goes up in a single request. Larger
+    # content is split into blocks that are staged in parallel and committed
+    # once all of them are stored. A retry after a failed upload only stages
+    # the blocks that are not already stored uncommitted on the service.
+    async def block_blob_upload_async(self, upload_path, data):
+        blob_client = self._container_client.get_blob_client(blob=upload_path)
+        if hasattr(data, "read"):
+            data = data.read()
+
+        # Upload content to block blob. A redelivered request overwrites the
+        # image left behind by an earlier, incomplete attempt.
+        if len(data) <= self.block_size:
+            await blob_client.upload_blob(data, overwrite=True)
+            return
+
+        blocks = []
+        for index, offset in enumerate(range(0, len(data), self.block_size)):
+            block = data[offset : offset + self.block_size]
+            blocks.append((_block_id(index, block), block))
+
+        staged = await self._uncommitted_block_ids(blob_client)
+        slots = asyncio.Semaphore(self.upload_concurrency)
+
+        async def stage(block_id, block):
+            async with slots:
+                await blob_client.stage_block(block_id, block, length=len(block))
+
+        await asyncio.gather(
+            *[
+                stage(block_id, block)
+                for block_id, block in blocks
+                if block_id not in staged
+            ]
+        )
+        await blob_client.commit_block_list([block_id for block_id, _ in blocks])
+
+    async def _uncommitted_block_ids(self, blob_client):
+        try:
+            _, uncommitted = await blob_client.get_block_list("uncommitted")
+        except ResourceNotFoundError:
+            return set()
+        return {block.id for block in uncommitted}
+
+    # Code for listening to Storage queue
+    # Pulls up to max_messages requests in a single round-trip and returns a
+    # started lease for each of them.
+    async def queue_receive_leases_async(
+        self,
+        max_messages=DEFAULT_RECEIVE_BATCH_SIZE,
+        visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT,
+    ):
+        response = self._queue_client.receive_messages(
+            messages_per_page=max_messages, visibility_timeout=visibility_timeout
+        )
+        pages = response.by_page()
+        try:
+            page = await pages.__anext__()
+        except StopAsyncIteration:
+            return []
+
+        leases = []
+        async for message in page:
+            lease = QueueMessageLease(self._queue_client, message, visibility_timeout)
+            lease.start()
+            leases.append(lease)
+        return leases
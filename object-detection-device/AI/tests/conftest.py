@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The detector modules are plain scripts next to each other, not a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
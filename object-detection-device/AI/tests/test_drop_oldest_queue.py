@@ -0,0 +1,53 @@
+import threading
+import time
+
+from module_metrics import Histogram
+from pipeline import DropOldestQueue, StageStats, frames_held
+
+
+def queue(maxsize, on_drop=None):
+    return DropOldestQueue(StageStats("test", Histogram()), maxsize, on_drop)
+
+
+def test_get_batch_takes_at_most_max_items():
+    frames = queue(4)
+    for item in range(3):
+        frames.put(item)
+    assert frames.get_batch(2) == [0, 1]
+    assert frames.get_batch(2) == [2]
+
+
+def test_get_batch_returns_empty_after_timeout():
+    assert queue(2).get_batch(2, timeout=0.01) == []
+
+
+def test_get_batch_waits_for_the_batch_to_fill():
+    frames = queue(4)
+    frames.put(0)
+    filler = threading.Timer(0.05, frames.put, (1,))
+    filler.start()
+    assert frames.get_batch(2, timeout=1, max_delay=1) == [0, 1]
+    filler.join()
+
+
+def test_get_batch_does_not_wait_past_max_delay():
+    frames = queue(4)
+    frames.put(0)
+    started = time.monotonic()
+    assert frames.get_batch(2, timeout=1, max_delay=0.05) == [0]
+    assert time.monotonic() - started < 0.5
+
+
+def test_full_queue_drops_the_oldest_item():
+    dropped = []
+    frames = queue(2, dropped.append)
+    for item in range(4):
+        frames.put(item)
+    assert dropped == [0, 1]
+    assert frames.stats.dropped == 2
+    assert frames.get_batch(4) == [2, 3]
+
+
+def test_frames_held_covers_queue_batch_and_capture():
+    assert frames_held(2, 1) == 4
+    assert frames_held(2, 4) == 9
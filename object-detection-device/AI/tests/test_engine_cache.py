@@ -0,0 +1,29 @@
+from engine_cache import EngineCache
+
+
+def test_stored_engine_is_found_and_a_corrupted_one_removed(tmp_path):
+    model = tmp_path / "resnet18.onnx"
+    model.write_bytes(b"model")
+    cache = EngineCache(str(tmp_path / "cache"))
+    key = cache.key(str(model), "FP16", 1, "Jetson Nano TensorRT 8")
+    assert cache.lookup(key) is None
+
+    built = tmp_path / "built.engine"
+    built.write_bytes(b"engine")
+    path = cache.store(key, str(built))
+    assert not built.exists()
+    assert cache.lookup(key) == path
+
+    with open(path, "wb") as engine:
+        engine.write(b"broken")
+    assert cache.lookup(key) is None
+    assert cache.lookup(key) is None
+
+
+def test_key_changes_with_the_model(tmp_path):
+    model = tmp_path / "resnet18.onnx"
+    model.write_bytes(b"model")
+    cache = EngineCache(str(tmp_path / "cache"))
+    before = cache.key(str(model), "fp16", 1, "device")
+    model.write_bytes(b"retrained")
+    assert cache.key(str(model), "fp16", 1, "device") != before
@@ -0,0 +1,52 @@
+from inference_engine import InferenceEngine, classifies_batches
+
+
+# Predicts the class of every image from the image itself, an int.
+class BatchNet:
+    def __init__(self, max_batch_size=None):
+        self.max_batch_size = max_batch_size
+        self.batches = []
+
+    def ClassifyBatch(self, images, topK=1):
+        self.batches.append(len(images))
+        return [[(image, 0.9), (image + 1, 0.1)][:topK] for image in images]
+
+
+class SingleNet:
+    def __init__(self):
+        self.calls = 0
+
+    def Classify(self, image, topK=1):
+        self.calls += 1
+        if topK == 1:
+            return image, 0.9
+        return [(image, 0.9), (image + 1, 0.1)][:topK]
+
+
+def test_batches_are_limited_by_the_fixed_batch_of_the_net():
+    net = BatchNet(max_batch_size=2)
+    engine = InferenceEngine(net, 4)
+    predictions = engine.classify(list(range(5)), 2)
+    assert net.batches == [2, 2, 1]
+    assert [p[0][0] for p in predictions] == [0, 1, 2, 3, 4]
+    assert engine.stats()["batches"] == 3
+    assert engine.stats()["images"] == 5
+
+
+def test_batches_are_limited_by_the_engine():
+    net = BatchNet()
+    InferenceEngine(net, 3).classify(list(range(7)), 1)
+    assert net.batches == [3, 3, 1]
+
+
+def test_single_image_net_is_run_image_by_image():
+    net = SingleNet()
+    engine = InferenceEngine(net, 4)
+    assert engine.classify([3, 5], 1) == [[(3, 0.9)], [(5, 0.9)]]
+    assert engine.classify([3], 2) == [[(3, 0.9), (4, 0.1)]]
+    assert net.calls == 3
+
+
+def test_classifies_batches():
+    assert classifies_batches(BatchNet())
+    assert not classifies_batches(SingleNet())
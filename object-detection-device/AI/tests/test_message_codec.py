@@ -0,0 +1,88 @@
+import pytest
+
+from message_codec import (
+    CBOR_ENCODING,
+    JSON_ENCODING,
+    MSGPACK_ENCODING,
+    STATUS_FOUND,
+    STATUS_TIMEOUT,
+    ClassTarget,
+    MessageCodec,
+    MessageError,
+    RequestMessage,
+    ResponseMessage,
+)
+
+CORRELATION_ID = "0f8fad5b-d9cb-469f-a165-70867728950e"
+
+
+def codec(encoding):
+    if encoding == MSGPACK_ENCODING:
+        pytest.importorskip("msgpack")
+    elif encoding == CBOR_ENCODING:
+        pytest.importorskip("cbor2")
+    return MessageCodec(encoding)
+
+
+@pytest.mark.parametrize("encoding", [JSON_ENCODING, MSGPACK_ENCODING, CBOR_ENCODING])
+def test_request_round_trip(encoding):
+    request = RequestMessage(
+        CORRELATION_ID, [ClassTarget("hulk", 95), ClassTarget("gil", 80.5)], "0x1"
+    )
+    encoded = codec(encoding).encode_request(request)
+    # any encoding decodes whatever the codec writes
+    assert MessageCodec().decode_request(encoded) == request
+
+
+@pytest.mark.parametrize("encoding", [JSON_ENCODING, MSGPACK_ENCODING, CBOR_ENCODING])
+def test_response_round_trip(encoding):
+    found = ResponseMessage(CORRELATION_ID, STATUS_FOUND, "hulk", 97.5, "t1", "door")
+    timeout = ResponseMessage(CORRELATION_ID, STATUS_TIMEOUT, None, None, None, None)
+    for response in (found, timeout):
+        encoded = codec(encoding).encode_response(response)
+        assert MessageCodec().decode_response(encoded) == response
+
+
+def test_legacy_request():
+    request = MessageCodec().decode_request(CORRELATION_ID + "|hulk|95|0x1")
+    assert request == RequestMessage(CORRELATION_ID, [ClassTarget("hulk", 95)], "0x1")
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "",
+        "x" * (64 * 1024 + 1),
+        "{not json",
+        "!!not base64!!",
+        "[1, 2]",
+        '{"v":2,"id":"abc","c":[["hulk",95]],"k":"k"}',
+        '{"v":1,"c":[["hulk",95]],"k":"k"}',
+        '{"v":1,"id":"abc","c":[],"k":"k"}',
+        '{"v":1,"id":"abc","c":[["hulk"]],"k":"k"}',
+        '{"v":1,"id":"abc","c":[["",95]],"k":"k"}',
+        '{"v":1,"id":"abc","c":[["hulk","95"]],"k":"k"}',
+        '{"v":1,"id":"abc","c":[["hulk",true]],"k":"k"}',
+        '{"v":1,"id":"abc","c":[["hulk",101]],"k":"k"}',
+        '{"v":1,"id":"abc","c":[["hulk",95]]}',
+        '{"v":1,"id":"../../etc","c":[["hulk",95]],"k":"k"}',
+        '{"v":1,"id":"a/b","c":[["hulk",95]],"k":"k"}',
+        "abc|hulk|95",
+        "abc|hulk|high|k",
+        "|hulk|95|k",
+        "../../etc|hulk|95|k",
+    ],
+)
+def test_malformed_request_is_rejected(content):
+    with pytest.raises(MessageError):
+        MessageCodec().decode_request(content)
+
+
+def test_response_with_unsafe_correlation_id_is_rejected():
+    with pytest.raises(MessageError):
+        MessageCodec().decode_response('{"v":1,"id":"..\\\\x","s":"found"}')
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        MessageCodec("xml")
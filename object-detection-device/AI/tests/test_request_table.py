@@ -0,0 +1,34 @@
+from request_table import DetectionRequest, RequestTable, RequestTarget
+
+
+def request(correlation_id):
+    return DetectionRequest(None, correlation_id, [RequestTarget("hulk", 1, 95)])
+
+
+def test_redelivered_request_returns_the_open_one():
+    table = RequestTable(60)
+    first = request("a")
+    assert table.add(first) is first
+    assert table.add(request("a")) is first
+    assert len(table) == 1
+
+
+def test_expired_requests_are_popped_once():
+    table = RequestTable(0)
+    table.add(request("a"))
+    table.add(request("b"))
+    expired = table.pop_expired()
+    assert sorted(r.correlation_id for r in expired) == ["a", "b"]
+    assert len(table) == 0
+    assert table.pop_expired() == []
+    # an expired request is no longer answered by a late detection
+    assert table.remove("a") is None
+
+
+def test_open_requests_do_not_expire_before_their_deadline():
+    table = RequestTable(60)
+    table.add(request("a"))
+    assert table.pop_expired() == []
+    assert [r.correlation_id for r in table.open_requests()] == ["a"]
+    assert table.remove("a").correlation_id == "a"
+    assert len(table) == 0
@@ -0,0 +1,122 @@
+import asyncio
+import os
+
+import pytest
+
+from spool import (
+    BLOB_RECORD,
+    FSYNC_NEVER,
+    TELEMETRY_RECORD,
+    Spool,
+    SpoolDrainer,
+    SpoolRecord,
+)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_records_survive_a_restart(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(BLOB_RECORD, "abc/imageWithDetection.jpg", b"jpeg")
+    spool.append(TELEMETRY_RECORD, "abc", b"{}")
+    assert "abc" in spool
+    spool.close()
+
+    reopened = Spool(str(tmp_path))
+    assert len(reopened) == 2
+    assert "abc" in reopened
+    [segment] = reopened.sealed_segments()
+    assert reopened.read_segment(segment) == [
+        SpoolRecord(BLOB_RECORD, "abc/imageWithDetection.jpg", b"jpeg"),
+        SpoolRecord(TELEMETRY_RECORD, "abc", b"{}"),
+    ]
+
+
+def test_removed_segment_forgets_its_records(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(TELEMETRY_RECORD, "abc", b"{}")
+    spool.seal()
+    [segment] = spool.sealed_segments()
+    spool.remove_segment(segment, spool.read_segment(segment))
+    assert len(spool) == 0
+    assert "abc" not in spool
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_torn_record_ends_the_segment(tmp_path):
+    spool = Spool(str(tmp_path), FSYNC_NEVER)
+    spool.append(TELEMETRY_RECORD, "a", b"first")
+    spool.append(TELEMETRY_RECORD, "b", b"second")
+    spool.close()
+    [name] = os.listdir(str(tmp_path))
+    path = os.path.join(str(tmp_path), name)
+    with open(path, "r+b") as segment:
+        segment.truncate(os.path.getsize(path) - 1)
+    reopened = Spool(str(tmp_path))
+    [segment] = reopened.sealed_segments()
+    assert reopened.read_segment(segment) == [
+        SpoolRecord(TELEMETRY_RECORD, "a", b"first")
+    ]
+
+
+def test_full_segment_starts_a_new_one(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=1)
+    spool.append(TELEMETRY_RECORD, "a", b"first")
+    spool.append(TELEMETRY_RECORD, "b", b"second")
+    spool.close()
+    assert len(spool.sealed_segments()) == 2
+
+
+def test_unknown_fsync_policy(tmp_path):
+    with pytest.raises(ValueError):
+        Spool(str(tmp_path), "sometimes")
+
+
+def test_replay_sends_the_image_before_the_response(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(TELEMETRY_RECORD, "a", b"{}")
+    spool.append(BLOB_RECORD, "a/imageWithDetection.jpg", b"jpeg")
+    spool.append(TELEMETRY_RECORD, "b", b"{}")
+    spool.seal()
+    [segment] = spool.sealed_segments()
+    records = spool.read_segment(segment)
+    sent = []
+
+    async def deliver(record):
+        sent.append(record.key)
+
+    drainer = SpoolDrainer(spool, {BLOB_RECORD: deliver, TELEMETRY_RECORD: deliver})
+    assert run(drainer._replay(segment, records))
+    assert sent.index("a/imageWithDetection.jpg") < sent.index("a")
+    assert sorted(sent) == ["a", "a/imageWithDetection.jpg", "b"]
+
+
+def test_response_waits_for_a_failed_image(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(BLOB_RECORD, "a/imageWithDetection.jpg", b"jpeg")
+    spool.append(TELEMETRY_RECORD, "a", b"{}")
+    spool.seal()
+    [segment] = spool.sealed_segments()
+    records = spool.read_segment(segment)
+    sent = []
+
+    async def fail(record):
+        raise ConnectionError("storage is unreachable")
+
+    async def send(record):
+        sent.append(record.key)
+
+    drainer = SpoolDrainer(spool, {BLOB_RECORD: fail, TELEMETRY_RECORD: send})
+    assert not run(drainer._replay(segment, records))
+    assert sent == []
+
+    # the next attempt delivers both
+    drainer.handlers[BLOB_RECORD] = send
+    assert run(drainer._replay(segment, records))
+    assert sent == ["a/imageWithDetection.jpg", "a"]
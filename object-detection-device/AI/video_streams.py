@@ -0,0 +1,109 @@
+import threading
+
+ROUND_ROBIN = "round-robin"
+PRIORITY = "priority"
+SCHEDULES = (ROUND_ROBIN, PRIORITY)
+
+
+# Parses the repeated "ID=VALUE" options of the stream arguments.
+def parse_assignments(values, convert=str):
+    assignments = {}
+    for value in values or []:
+        name, separator, setting = value.partition("=")
+        if not separator or not name:
+            raise ValueError("%r is not ID=VALUE" % value)
+        assignments[name] = convert(setting)
+    return assignments
+
+
+# One camera or video input. open_source(uri, resolution) opens the source,
+# with the resolution of the command line when resolution is None, and it is
+# reopened on the capture thread when the resolution changes. Every stream
+# has its own motion gate, as a still scene on one camera says nothing about
+# the others.
+# stream_id is None when the detector reads a single input.
+class VideoStream:
+    def __init__(self, stream_id, uri, open_source, gate, resolution, priority=1):
+        self.stream_id = stream_id
+        self.uri = uri
+        self.open_source = open_source
+        self.gate = gate
+        self.resolution = resolution
+        self.priority = priority
+        self.source = None
+        self.captured = 0
+        self.admitted = 0
+
+    def open(self):
+        self.source = self.open_source(self.uri, None)
+
+    # Returns the next frame, or None when the motion gate holds it back or the
+    # source has no frame.
+    def capture(self, width, height, frame_skip=0):
+        if (width, height) != self.resolution:
+            self.source.Close()
+            self.source = self.open_source(self.uri, (width, height))
+            self.resolution = (width, height)
+        for _ in range(frame_skip):
+            self.source.Capture()
+        frame = self.source.Capture()
+        if frame is None:
+            return None
+        self.captured += 1
+        if not self.gate.admit(frame):
+            return None
+        self.admitted += 1
+        return frame
+
+    def stats(self):
+        stats = self.gate.stats()
+        stats.update(
+            {
+                "priority": self.priority,
+                "captured": self.captured,
+                "admitted": self.admitted,
+            }
+        )
+        return stats
+
+
+# Picks the stream the next frame is captured from, so one network serves
+# every camera.
+# With the priority schedule streams are picked in proportion to their
+# priority with smooth weighted round-robin: a stream of priority 3 next to
+# one of priority 1 gets three frames out of four, spread out rather than in
+# a burst. The round-robin schedule gives every stream the same turn.
+class StreamScheduler:
+    def __init__(self, streams, schedule=ROUND_ROBIN):
+        if schedule not in SCHEDULES:
+            raise ValueError("Unknown stream schedule %s" % schedule)
+        if not streams:
+            raise ValueError("No video streams")
+        self.streams = streams
+        self.schedule = schedule
+        self._weights = [
+            stream.priority if schedule == PRIORITY else 1 for stream in streams
+        ]
+        if min(self._weights) <= 0:
+            raise ValueError("Stream priorities have to be positive")
+        self._current = [0] * len(streams)
+        self._lock = threading.Lock()
+
+    def next_stream(self):
+        with self._lock:
+            total = sum(self._weights)
+            for index, weight in enumerate(self._weights):
+                self._current[index] += weight
+            index = max(range(len(self.streams)), key=self._current.__getitem__)
+            self._current[index] -= total
+            return self.streams[index]
+
+    # Lets the next frame of every stream through its motion gate.
+    def trigger(self):
+        for stream in self.streams:
+            stream.gate.trigger()
+
+    def stats(self):
+        return {
+            stream.stream_id or "default": stream.stats() for stream in self.streams
+        }
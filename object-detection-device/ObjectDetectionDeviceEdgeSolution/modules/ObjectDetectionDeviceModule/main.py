@@ -4,7 +4,7 @@
 
 import uuid
 import re
-import json
+import collections
 import time
 import types
 import os
@@ -15,10 +15,38 @@ import threading
 from azure.iot.device.aio import IoTHubModuleClient
 from azure.iot.device import MethodResponse
 from azure.storage.queue.aio import QueueClient
-
-# global counters
-TWIN_CALLBACKS = 0
-RECEIVED_MESSAGES = 0
+from message_codec import ENCODINGS, ClassTarget, MessageCodec, RequestMessage
+from module_metrics import DEFAULT_METRICS_PORT, MetricsServer, ModuleMetrics
+from runtime_config import RuntimeConfig, parse_choice, parse_int
+
+# Metrics served for Prometheus, replacing the global counters
+METRICS = ModuleMetrics("object_detection_module")
+METHOD_REQUESTS = METRICS.counter("method_requests_total", "Direct method requests by method and response status", ("method", "status"))
+METHOD_REQUEST_SECONDS = METRICS.summary("method_request_seconds", "Time from receiving a direct method request to answering it", ("method",))
+METHOD_RESPONSE_SECONDS = METRICS.summary("method_response_seconds", "Time to send a direct method response")
+QUEUE_SEND_SECONDS = METRICS.summary("queue_send_seconds", "Time to post a detection request to the storage queue")
+QUEUE_SEND_FAILURES = METRICS.counter("queue_send_failures_total", "Detection requests that could not be posted to the storage queue")
+TWIN_PATCHES = METRICS.counter("twin_patches_total", "Desired properties patches received")
+
+# Settings the module twin changes while the module runs
+#   message_encoding   encoding of the requests posted to the queue
+#   default_threshold  threshold of a class that comes without ThresholdPercentage
+ModuleSettings = collections.namedtuple("ModuleSettings", "message_encoding default_threshold")
+TWIN_SETTINGS = {
+    "MessageEncoding": ("message_encoding", parse_choice(ENCODINGS)),
+    "DefaultThresholdPercentage": ("default_threshold", parse_int(0, 100)),
+}
+
+# Builds the detection request from a direct method payload. The payload
+# names one class with "ClassName" and "ThresholdPercentage", or several with
+# "Classes": [{"ClassName": ..., "ThresholdPercentage": ...}, ...].
+def request_from_payload(payload, module_key, default_threshold):
+    classes = payload.get("Classes") or [payload]
+    targets = [
+        ClassTarget(str(entry["ClassName"]), int(entry.get("ThresholdPercentage", default_threshold)))
+        for entry in classes
+    ]
+    return RequestMessage(str(payload["CoorelationId"]), targets, module_key)
 
 # A helper class to support async queue actions.
 class StorageHelperAsync:
@@ -43,12 +71,30 @@ async def main():
         # connect the client.
         await module_client.connect()
 
+        # The environment gives the initial settings, the module twin can
+        # change them later on
+        config = RuntimeConfig(
+            ModuleSettings(os.getenv("message_encoding", "json"), 90),
+            TWIN_SETTINGS,
+        )
+        twin = await module_client.get_twin()
+        await config.apply_and_report(module_client, twin.get("desired", {}))
+
+        # metrics_port=0 turns the metrics endpoint off
+        metrics_server = None
+        metrics_port = int(os.getenv("metrics_port", DEFAULT_METRICS_PORT))
+        if metrics_port:
+            metrics_server = MetricsServer(METRICS, port=metrics_port)
+            await metrics_server.start()
+
         # define behavior for receiving an input message on input1
         async def input1_listener(module_client):
-            global RECEIVED_MESSAGES
             while True:
+                method_name = "unknown"
                 try:
                     method_request = await module_client.receive_method_request()
+                    method_name = method_request.name
+                    started = time.monotonic()
                     print (
                         "\nMethod callback called with:\nrequestID={request_id}\nmethodName = {method_name}\npayload = {payload}".format(
                             request_id=method_request.request_id,
@@ -56,40 +102,53 @@ async def main():
                             payload=method_request.payload
                         )
                     )
-                    json_object = json.dumps(method_request.payload)
-                    json_deserialized = json.loads(json_object)
                     module_key = hex(uuid.getnode())
-                    correlation_id = json_deserialized["CoorelationId"]
-                    class_name = json_deserialized["ClassName"]
-                    threshold_percentage = json_deserialized["ThresholdPercentage"]
-                    module_payload = correlation_id + "|" + class_name + "|" + str(threshold_percentage) + "|" + module_key
-                    print(module_payload)
-                    storage_helper = StorageHelperAsync()
-                    await storage_helper.queue_send_message_async(module_payload)
-                    print("message sent to queue")
-                    response_payload = {"Response": "Executed direct method {}".format(method_request.name)}
-                    response_status = 200                    
+                    settings = config.current()
+                    try:
+                        # the payload arrives already deserialized
+                        request = request_from_payload(method_request.payload, module_key, settings.default_threshold)
+                        module_payload = MessageCodec(settings.message_encoding).encode_request(request)
+                    except (KeyError, TypeError, ValueError, AttributeError) as ex:
+                        print("Malformed direct method payload: %s" % ex)
+                        response_payload = {"Response": "Malformed payload for direct method {}".format(method_request.name)}
+                        response_status = 400
+                    else:
+                        print(module_payload)
+                        storage_helper = StorageHelperAsync()
+                        try:
+                            with QUEUE_SEND_SECONDS.time():
+                                await storage_helper.queue_send_message_async(module_payload)
+                        except Exception:
+                            QUEUE_SEND_FAILURES.inc()
+                            raise
+                        print("message sent to queue")
+                        response_payload = {"Response": "Executed direct method {}".format(method_request.name)}
+                        response_status = 200                    
 
                     # Creating a method response.
                     methodResponse = MethodResponse.create_from_method_request(method_request, response_status, response_payload)
 
                     # Responding back to the direct method call.                 
-                    await module_client.send_method_response(methodResponse)
+                    with METHOD_RESPONSE_SECONDS.time():
+                        await module_client.send_method_response(methodResponse)
+                    METHOD_REQUESTS.inc(method=method_name, status=response_status)
+                    METHOD_REQUEST_SECONDS.observe(time.monotonic() - started, method=method_name)
 
                     
                 except Exception as ex:
+                    METHOD_REQUESTS.inc(method=method_name, status="error")
                     print ("Unexpected error in input1_listener: %s" % ex)
                                      
 
         # twin_patch_listener is invoked when the module twin's desired properties are updated.
         async def twin_patch_listener(module_client):
-            global TWIN_CALLBACKS
             while True:
                 try:
                     data = await module_client.receive_twin_desired_properties_patch()  # blocking call
                     print( "The data in the desired properties patch was: %s" % data)
-                    TWIN_CALLBACKS += 1
-                    print ( "Total calls confirmed: %d\n" % TWIN_CALLBACKS )
+                    await config.apply_and_report(module_client, data)
+                    TWIN_PATCHES.inc()
+                    print ( "Total calls confirmed: %d\n" % TWIN_PATCHES.value() )
                 except Exception as ex:
                     print ( "Unexpected error in twin_patch_listener: %s" % ex )
 
@@ -118,6 +177,8 @@ async def main():
 
         # Cancel listening
         listeners.cancel()
+        if metrics_server is not None:
+            await metrics_server.stop()
 
         # Finally, disconnect
         await module_client.disconnect()
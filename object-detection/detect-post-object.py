@@ -12,6 +12,8 @@ from azure.iot.device.aio import IoTHubDeviceClient
 from azure.storage.queue.aio import QueueClient
 from azure.storage.blob.aio import BlobServiceClient, BlobClient, ContainerClient
 
+from idle_scheduler import IdleScheduler
+
 # A helper class to support async blob and queue actions.
 class StorageHelperAsync:
     async def block_blob_upload_async(self, upload_path, savedFile):
@@ -99,6 +101,23 @@ async def main():
         default=90,
         help="The threshold value 'in percentage' for object detection",
     )
+    parser.add_argument(
+        "--minPollInterval",
+        type=float,
+        default=0.2,
+        help="Seconds to wait after the first empty poll of the request queue",
+    )
+    parser.add_argument(
+        "--maxPollInterval",
+        type=float,
+        default=30.0,
+        help="Upper bound in seconds for the backoff between empty polls of the request queue",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="Run without a display window, only drawing overlays on detection images",
+    )
 
     try:
         opt = parser.parse_known_args()[0]
@@ -109,10 +128,9 @@ async def main():
     # load the recognition network
     net = jetson.inference.imageNet(opt.network, sys.argv)
 
-    # create the camera and display
+    # create the video source and, unless running headless, the display
     font = jetson.utils.cudaFont()
-    camera = jetson.utils.gstCamera(opt.width, opt.height, opt.camera)
-    display = jetson.utils.glDisplay()
+    display = None if opt.headless else jetson.utils.glDisplay()
     input = jetson.utils.videoSource(opt.input_URI, argv=sys.argv)
 
     # Fetch the connection string from an environment variable
@@ -121,14 +139,18 @@ async def main():
     device_client = IoTHubDeviceClient.create_from_connection_string(conn_str)
     await device_client.connect()
 
+    # Backs off polling while the request queue stays empty
+    idle_scheduler = IdleScheduler(opt.minPollInterval, opt.maxPollInterval)
+
     counter = 1
     still_looking = True
     # process frames until user exits
     while still_looking:
         storage_helper = StorageHelperAsync()
         queue_message = await storage_helper.queue_receive_message_async()
+        await idle_scheduler.poll_completed(1 if queue_message else 0)
 
-        print("Waiting for request queue_messages")
+        print("Waiting for request queue_messages", idle_scheduler.metrics())
         print(queue_message)
         if queue_message:
             has_new_message = True
@@ -149,29 +171,33 @@ async def main():
                 # find the object description
                 class_desc = net.GetClassDesc(class_idx)
 
-                # overlay the result on the image
-                font.OverlayText(
-                    img,
-                    img.width,
-                    img.height,
-                    "{:05.2f}% {:s}".format(confidence * 100, class_desc),
-                    15,
-                    50,
-                    font.Green,
-                    font.Gray40,
-                )
-
-                # render the image
-                display.RenderOnce(img, img.width, img.height)
-
-                # update the title bar
-                display.SetTitle(
-                    "{:s} | Network {:.0f} FPS | Looking for {:s}".format(
-                        net.GetNetworkName(),
-                        net.GetNetworkFPS(),
-                        opt.classNameForTargetObject,
+                status_text = "{:05.2f}% {:s}".format(confidence * 100, class_desc)
+
+                # nothing is drawn for frames that are not shown when running headless
+                if display is not None:
+                    # overlay the result on the image
+                    font.OverlayText(
+                        img,
+                        img.width,
+                        img.height,
+                        status_text,
+                        15,
+                        50,
+                        font.Green,
+                        font.Gray40,
+                    )
+
+                    # render the image
+                    display.RenderOnce(img, img.width, img.height)
+
+                    # update the title bar
+                    display.SetTitle(
+                        "{:s} | Network {:.0f} FPS | Looking for {:s}".format(
+                            net.GetNetworkName(),
+                            net.GetNetworkFPS(),
+                            opt.classNameForTargetObject,
+                        )
                     )
-                )
 
                 # print out performance info
                 net.PrintProfilerTimes()
@@ -180,6 +206,18 @@ async def main():
                     and (confidence * 100) >= threshold_for_object_detection
                 ):
                     message = request_content + "|" + str(confidence * 100)
+                    # the uploaded image carries the same overlays in headless mode
+                    if display is None:
+                        font.OverlayText(
+                            img,
+                            img.width,
+                            img.height,
+                            status_text,
+                            15,
+                            50,
+                            font.Green,
+                            font.Gray40,
+                        )
                     font.OverlayText(
                         img,
                         img.width,
@@ -192,7 +230,8 @@ async def main():
                         font.Blue,
                         font.Gray40,
                     )
-                    display.RenderOnce(img, img.width, img.height)
+                    if display is not None:
+                        display.RenderOnce(img, img.width, img.height)
                     savedFile = "imageWithDetection.jpg"
                     jetson.utils.saveImageRGBA(savedFile, img, img.width, img.height)
 